@@ -6,15 +6,36 @@ import asyncio
 import datetime
 import os
 import json
+import math
+import multiprocessing
 import re
+import hashlib
+import gzip
+import sqlite3
+import struct
+import sys
+import threading
 import logging
 import traceback
+import time
+import io
+import weakref
+import csv
+import tempfile
+import zipfile
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from copy import deepcopy
+from urllib.parse import quote, unquote
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton,
-    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile
+    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BufferedInputFile, FSInputFile
 )
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.fsm.state import StatesGroup, State
@@ -35,6 +56,7 @@ try:
     # Основные настройки
     BOT_TOKEN = config.BOT_TOKEN
     ADMIN_CHAT_ID = getattr(config, 'ADMIN_CHAT_ID', None)
+    ADMIN_USER_IDS = {str(u) for u in getattr(config, 'ADMIN_USER_IDS', ())}
     
     # VK.ОРД API настройки
     VK_ORD_API_TOKEN = getattr(config, 'VK_ORD_API_TOKEN', None)
@@ -43,6 +65,11 @@ try:
     VK_ORD_PERSON_TYPE_IP = getattr(config, 'VK_ORD_PERSON_TYPE_IP', 'ip')
     VK_ORD_PERSON_TYPE_INDIVIDUAL = getattr(config, 'VK_ORD_PERSON_TYPE_INDIVIDUAL', 'physical')
     VK_ORD_PERSON_TYPE_DEFAULT = getattr(config, 'VK_ORD_PERSON_TYPE_DEFAULT', 'juridical')
+    VK_ORD_HTTP_CONNECT_TIMEOUT = getattr(config, 'VK_ORD_HTTP_CONNECT_TIMEOUT', 10)
+    VK_ORD_HTTP_READ_TIMEOUT = getattr(config, 'VK_ORD_HTTP_READ_TIMEOUT', 60)
+    VK_ORD_HTTP_DEADLINE = getattr(config, 'VK_ORD_HTTP_DEADLINE', 90)
+    VK_ORD_HTTP_LIMIT_PER_HOST = getattr(config, 'VK_ORD_HTTP_LIMIT_PER_HOST', 10)
+    VK_ORD_HTTP_KEEPALIVE = getattr(config, 'VK_ORD_HTTP_KEEPALIVE', 30)
     TEMPLATE_INVOICE_SINGLE = getattr(config, 'TEMPLATE_INVOICE_SINGLE', 'templates/schet-oferta.docx')
     TEMPLATE_INVOICE_MULTI = getattr(config, 'TEMPLATE_INVOICE_MULTI', 'templates/schet-oferta2-multi.docx')
     TEMPLATE_INVOICE_MULTI_PRO = getattr(config, 'TEMPLATE_INVOICE_MULTI_PRO', 'templates/schet-oferta2-multiPRO.docx')
@@ -50,9 +77,36 @@ try:
     TEMPLATE_CONTRACT_MULTI = getattr(config, 'TEMPLATE_CONTRACT_MULTI', 'templates/dogovor_rim2-multi.docx')
     OUTPUT_DIR = getattr(config, 'OUTPUT_DIR', 'generated')
     COUNTERS_FILE = getattr(config, 'COUNTERS_FILE', 'counters.json')
+    COUNTERS_BACKEND = getattr(config, 'COUNTERS_BACKEND', 'sqlite')
+    COUNTERS_DB = getattr(config, 'COUNTERS_DB', 'secrets/counters.sqlite3')
+    COUNTERS_ARCHIVE_DIR = getattr(config, 'COUNTERS_ARCHIVE_DIR', 'secrets/counters_archive')
+    COUNTERS_ARCHIVE_INTERVAL = getattr(config, 'COUNTERS_ARCHIVE_INTERVAL', 3600)
     METRICS_FILE = getattr(config, 'METRICS_FILE', 'metrics.json')
-    MAX_ITEMS_FOR_TEMPLATE = getattr(config, 'MAX_ITEMS_FOR_TEMPLATE', 50)
+    METRICS_FLUSH_INTERVAL = getattr(config, 'METRICS_FLUSH_INTERVAL', 5)
+    JOURNAL_COMPACT_RECORDS = getattr(config, 'JOURNAL_COMPACT_RECORDS', 1000)
+    JOURNAL_FSYNC = getattr(config, 'JOURNAL_FSYNC', False)
+    ACTIVITY_TRACKING = getattr(config, 'ACTIVITY_TRACKING', True)
+    ACTIVITY_DIR = getattr(config, 'ACTIVITY_DIR', 'secrets/activity')
+    ACTIVITY_MAX_DAYS = getattr(config, 'ACTIVITY_MAX_DAYS', 366)
+    MAX_ITEMS_FOR_TEMPLATE = getattr(config, 'MAX_ITEMS_FOR_TEMPLATE', 2000)
+    RENDER_WORKERS = getattr(config, 'RENDER_WORKERS', min(4, os.cpu_count() or 1))
+    RENDER_QUEUE_LIMIT = getattr(config, 'RENDER_QUEUE_LIMIT', 16)
+    RENDER_TIMEOUT = getattr(config, 'RENDER_TIMEOUT', 120)
+    RENDER_SLOW_MS = getattr(config, 'RENDER_SLOW_MS', 5000)
+    ARCHIVE_DOCUMENTS = getattr(config, 'ARCHIVE_DOCUMENTS', True)
+    SUBMIT_DEDUP_WINDOW = getattr(config, 'SUBMIT_DEDUP_WINDOW', 600)
+    BULK_MAX_INVOICES = getattr(config, 'BULK_MAX_INVOICES', 500)
+    BULK_MAX_FILE_SIZE = getattr(config, 'BULK_MAX_FILE_SIZE', 10 * 1024 * 1024)
+    BULK_ZIP_PART_LIMIT = getattr(config, 'BULK_ZIP_PART_LIMIT', 45 * 1024 * 1024)
+    BULK_PROGRESS_INTERVAL = getattr(config, 'BULK_PROGRESS_INTERVAL', 2)
     CAPTION_LIMIT = getattr(config, 'CAPTION_LIMIT', 1024)
+    STORAGE_BACKEND = getattr(config, 'STORAGE_BACKEND', 'json')
+    STORAGE_DIR = getattr(config, 'STORAGE_DIR', 'secrets')
+    STORAGE_SQLITE_PATH = getattr(config, 'STORAGE_SQLITE_PATH', 'secrets/state.sqlite3')
+    STORAGE_REDIS_URL = getattr(config, 'STORAGE_REDIS_URL', 'redis://localhost:6379/0')
+    STORAGE_REDIS_PREFIX = getattr(config, 'STORAGE_REDIS_PREFIX', 'promo:')
+    STORAGE_CACHE_TTL = getattr(config, 'STORAGE_CACHE_TTL', 0)
+    STORAGE_STATE_CACHE_USERS = getattr(config, 'STORAGE_STATE_CACHE_USERS', 1000)
 except ImportError:
     raise SystemExit("Файл config.py не найден! Создайте его на основе config.example.py") from None
 
@@ -62,6 +116,8 @@ if not BOT_TOKEN:
 try:
     from docx import Document
     from docx.shared import Pt
+    from docx.oxml.ns import qn
+    from docx.text.paragraph import Paragraph
 except Exception as e:
     raise SystemExit("Нужен python-docx: pip install python-docx") from e
 
@@ -107,6 +163,10 @@ class ContractForm(StatesGroup):
     amount             = State()
     confirm            = State()
 
+
+class BulkInvoiceForm(StatesGroup):
+    waiting_file = State()
+
 # ── Хелперы ──
 def match_contains(substr: str):
     # Нормализуем пробелы и регистр для устойчивого матчинга по подстроке
@@ -246,6 +306,7 @@ def main_kb() -> ReplyKeyboardMarkup:
              KeyboardButton(text="📃 Составить «Договор РИМ»"), ],
             [KeyboardButton(text="🔄 Сброс нумерации"),
              KeyboardButton(text="🔍 Поиск по ИНН")],
+            [KeyboardButton(text="📦 Счета из таблицы")],
             [KeyboardButton(text="➦ Перейти в кабинет «VK.ОРД»")],
             [KeyboardButton(text="⚙️              Обратная связь                  ⚙️")]
         ],
@@ -320,152 +381,1526 @@ def inline_new_contract() -> InlineKeyboardMarkup:
         inline_keyboard=[[InlineKeyboardButton(text="🆕  Создать ещё один договор", callback_data="new_contract")]]
     )
 
-# ── Счётчики ──
-def load_counters() -> dict:
-    if not os.path.exists(COUNTERS_FILE):
-        return {}
-    try:
-        with open(COUNTERS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+# ── Журнал изменений (снимок JSON + JSON Lines) ──
+class JsonJournal:
+    """
+    Хранение в JSON-файле без перезаписи на каждое изменение: каждое событие —
+    одна строка в <файл>.journal, а сжатие время от времени сворачивает журнал
+    в снимок (сам <файл>). При загрузке читается снимок и дочитывается журнал.
+
+    Записи журнала задают итоговое значение («у пользователя стало N»), а не
+    приращение, поэтому повторное применение записи ничего не ломает — это и
+    делает безопасным падение в любой момент сжатия. Оборванная при падении
+    последняя строка отбрасывается.
+
+    Сжатие в два шага: rotate() откладывает текущий журнал в .journal.old (новые
+    события идут уже в свежий журнал), write_snapshot() атомарно пишет снимок и
+    удаляет .journal.old. Синхронизацию обеспечивает вызывающий код.
+    """
 
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.old_path = self.journal_path + ".old"
+        self.fsync = fsync
+        self.records = 0  # записей в журнале с последнего сжатия
+        self._fh = None
+
+    def read_snapshot(self, empty) -> dict:
+        """Снимок из файла; повреждённый файл откладывается в сторону, а не затирается."""
+        if not os.path.exists(self.path):
+            return empty()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("ожидался JSON-объект")
+            return data
+        except Exception:
+            broken = f"{self.path}.corrupt-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
+            logging.error(f"❌ Файл {self.path} повреждён, перенесён в {broken}; восстанавливаю из журнала")
+            logging.error(traceback.format_exc())
+            os.replace(self.path, broken)
+            return empty()
+
+    def replay(self, data: dict, apply, truncate: bool = False) -> int:
+        """
+        Применяет к data записи отложенного и текущего журнала; возвращает их число.
+        Оборванная последняя запись пропускается; truncate=True (только владелец
+        журнала, который будет в него дописывать) ещё и отрезает её в файле.
+        """
+        count = 0
+        for path in (self.old_path, self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb+" if truncate else "rb") as f:
+                raw = f.read()
+                if raw and not raw.endswith(b"\n"):
+                    cut = raw.rfind(b"\n") + 1
+                    if truncate:
+                        # Отрезаем, чтобы следующая запись не склеилась с оборванной
+                        logging.warning("Журнал %s: отброшена оборванная запись (%s байт)", path, len(raw) - cut)
+                        f.truncate(cut)
+                    raw = raw[:cut]
+            for line in raw.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning("Журнал %s: пропущена нечитаемая запись", path)
+                    continue
+                apply(data, record)
+                count += 1
+        self.records = count
+        return count
+
+    def append(self, record: dict) -> None:
+        """Дописывает одну запись (одна короткая строка, без перезаписи файла)."""
+        if self._fh is None:
+            os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+            self._fh = open(self.journal_path, "a", encoding="utf-8")
+        self._fh.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._fh.flush()
+        if self.fsync:
+            os.fsync(self._fh.fileno())
+        self.records += 1
+
+    def rotate(self) -> None:
+        """Откладывает текущий журнал перед записью снимка."""
+        self.close()
+        if os.path.exists(self.journal_path):
+            if os.path.exists(self.old_path):
+                # Прошлое сжатие не дописало снимок — дописываем журнал к отложенному
+                with open(self.journal_path, "rb") as src, open(self.old_path, "ab") as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.old_path)
+        self.records = 0
+
+    def write_snapshot(self, data: dict) -> None:
+        """Атомарно пишет снимок и удаляет отложенный журнал, уже вошедший в него."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+# ── Хранилище состояния ──
+# Общий асинхронный интерфейс к состоянию бота: пространства имён (ns) с парами
+# ключ → JSON-значение. Реализацию выбирает STORAGE_BACKEND:
+#   "json"   — JSON-файлы на диске, одно пространство — один файл (один процесс бота);
+#   "sqlite" — база STORAGE_SQLITE_PATH, общая для процессов на одной машине;
+#   "redis"  — сервер с протоколом Redis (STORAGE_REDIS_URL), общий для нескольких машин.
+# Нумерация документов, архив счётчиков и метрики тоже лежат в хранилище — один и тот
+# же код для всех трёх вариантов (нумерация при "json" — см. counters_storage).
+# Значения отдаются копиями: изменить полученный словарь, не вызвав set(), безопасно.
+class StorageStats:
+    """Операции хранилища с запуска бота: число, ошибки, задержки и попадания в кэш."""
+
+    def __init__(self):
+        self._ops: dict[str, list] = {}  # операция → [ошибки, LatencyHistogram]
+        self.cache: dict[str, list[int]] = {}  # пространство имён → [попадания, промахи]
+
+    def observe(self, op: str, ms: float, ok: bool) -> None:
+        entry = self._ops.setdefault(op, [0, LatencyHistogram()])
+        entry[1].add(ms)
+        if not ok:
+            entry[0] += 1
+
+    def cached(self, ns: str, hit: bool) -> None:
+        self.cache.setdefault(ns, [0, 0])[0 if hit else 1] += 1
+
+    def report(self, backend: str, cache_ttl: float) -> str:
+        lines = [f"🗄 Хранилище «{backend}» с запуска бота"]
+        if not self._ops:
+            lines.append("Операций ещё не было.")
+        for op in sorted(self._ops):
+            errors, h = self._ops[op]
+            lines.append(
+                f"{op}: n={h.count} · ошибок {errors} · p50 {h.percentile(0.5):.1f} · "
+                f"p99 {h.percentile(0.99):.1f} · max {h.max:.1f} мс"
+            )
+        if cache_ttl > 0:
+            lines.append(f"кэш чтения: {cache_ttl:g} с")
+        for ns in sorted(self.cache):
+            hits, misses = self.cache[ns]
+            lines.append(f"кэш {ns}: попаданий {hits}, промахов {misses}")
+        return "\n".join(lines)
 
-def save_counters(data: dict) -> None:
-    with open(COUNTERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
 
+class Storage:
+    """
+    Базовый класс хранилища: замер операций и кэш чтения с записью насквозь
+    (STORAGE_CACHE_TTL; при нескольких процессах чужие изменения видны с этой задержкой).
+    Наследники реализуют _get/_set/_getset/_delete/_delete_many/_all/_count/_incr/_add/_set_many.
+    """
 
-# ── Метрики уникальных пользователей ──
-def load_metrics() -> dict:
-    """Загружает метрики уникальных пользователей из файла."""
-    if not os.path.exists(METRICS_FILE):
-        return {"unique_users": {}, "total_count": 0, "daily_registrations": {}}
-    try:
-        with open(METRICS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            # Инициализация структуры для обратной совместимости
-            if "unique_users" not in data:
-                data["unique_users"] = {}
-            if "total_count" not in data:
-                data["total_count"] = len(data.get("unique_users", {}))
-            if "daily_registrations" not in data:
-                data["daily_registrations"] = {}
+    name = "base"
+    shared = False  # True — состояние общее для всех процессов бота
+    CACHE_LIMIT = 10000
+
+    def __init__(self, cache_ttl: float = 0):
+        self.cache_ttl = cache_ttl
+        self.stats = StorageStats()
+        self._cache: dict[tuple[str, str], tuple[float, object]] = {}
+
+    async def _timed(self, op: str, coro):
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = await coro
+            ok = True
+            return result
+        finally:
+            self.stats.observe(op, (time.perf_counter() - started) * 1000, ok)
+
+    def _remember(self, ns: str, key: str, value) -> None:
+        if self.cache_ttl <= 0:
+            return
+        if len(self._cache) >= self.CACHE_LIMIT:
+            self._cache.clear()
+        self._cache[(ns, key)] = (time.monotonic() + self.cache_ttl, deepcopy(value))
+
+    async def get(self, ns: str, key: str, default=None):
+        if self.cache_ttl > 0:
+            hit = self._cache.get((ns, key))
+            if hit is not None and hit[0] > time.monotonic():
+                self.stats.cached(ns, True)
+                return deepcopy(hit[1]) if hit[1] is not None else default
+            self.stats.cached(ns, False)
+        value = await self._timed("get", self._get(ns, key))
+        self._remember(ns, key, value)
+        return value if value is not None else default
+
+    async def set(self, ns: str, key: str, value) -> None:
+        await self._timed("set", self._set(ns, key, value))
+        self._remember(ns, key, value)
+
+    async def getset(self, ns: str, key: str, value):
+        """Атомарно записывает значение и возвращает прежнее (None — ключа не было)."""
+        self._cache.pop((ns, key), None)
+        return await self._timed("getset", self._getset(ns, key, value))
+
+    async def delete(self, ns: str, key: str) -> None:
+        self._cache.pop((ns, key), None)
+        await self._timed("delete", self._delete(ns, key))
+
+    async def delete_many(self, ns: str, keys: list[str]) -> None:
+        for key in keys:
+            self._cache.pop((ns, key), None)
+        if keys:
+            await self._timed("delete_many", self._delete_many(ns, keys))
+
+    async def all(self, ns: str) -> dict:
+        """Всё пространство имён целиком (для небольших пространств и переноса данных)."""
+        return await self._timed("all", self._all(ns))
+
+    async def count(self, ns: str) -> int:
+        return await self._timed("count", self._count(ns))
+
+    async def incr(self, ns: str, key: str, amount: int = 1) -> int:
+        """Атомарно увеличивает целое значение и возвращает новое."""
+        self._cache.pop((ns, key), None)
+        return await self._timed("incr", self._incr(ns, key, amount))
+
+    async def add(self, ns: str, key: str, value) -> bool:
+        """Записывает значение, только если ключа ещё нет (атомарно). True — записано."""
+        self._cache.pop((ns, key), None)
+        return await self._timed("add", self._add(ns, key, value))
+
+    async def set_many(self, ns: str, mapping: dict) -> None:
+        for key in mapping:
+            self._cache.pop((ns, key), None)
+        if mapping:
+            await self._timed("set_many", self._set_many(ns, mapping))
+
+    async def close(self) -> None:
+        pass
+
+
+class JsonShards:
+    """
+    Пространство имён «файл на ключ»: <каталог>/<ключ>.json с тем же {ключ: значение},
+    что и в общем файле. Изменение одного ключа (для состояния VK.ОРД — одного
+    пользователя) читает и пишет только его файл, сколько бы ключей ни было.
+    Недавние ключи держатся в памяти (LRU на cache_size ключей); записи одного ключа
+    идут по очереди, одновременные склеиваются в одну. Прежний общий файл
+    пространства при первом обращении раскладывается по ключам и переименовывается
+    в <файл>.migrated.
+    """
+
+    def __init__(self, directory: str, legacy_path: str | None, cache_size: int):
+        self.directory = directory
+        self.legacy_path = legacy_path
+        self.cache_size = max(1, int(cache_size))
+        self._cache: OrderedDict[str, object] = OrderedDict()
+        self._pending: dict[str, object] = {}  # ключ → значение, ещё не записанное на диск (None — удаление)
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+        self._migrated = False
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, quote(key, safe="") + ".json")
+
+    def _migrate(self) -> None:
+        if self._migrated:
+            return
+        self._migrated = True
+        if not self.legacy_path or not os.path.exists(self.legacy_path):
+            return
+        data = JsonJournal(self.legacy_path).read_snapshot(dict)
+        for key, value in data.items():
+            if not os.path.exists(self._path(key)):  # уже разложенный ключ новее общего файла
+                JsonJournal(self._path(key)).write_snapshot({key: value})
+        os.replace(self.legacy_path, self.legacy_path + ".migrated")
+        logging.info("Хранилище: %s разложен по файлам в %s (%s записей)", self.legacy_path, self.directory, len(data))
+
+    def _remember(self, key: str, value) -> None:
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, key: str):
+        if key in self._pending:
+            return self._pending[key]
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self._migrate()
+        value = JsonJournal(self._path(key)).read_snapshot(dict).get(key)
+        self._remember(key, value)
+        return value
+
+    def _write(self, key: str, value) -> None:
+        if value is not None:
+            JsonJournal(self._path(key)).write_snapshot({key: value})
+        elif os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+    async def put(self, key: str, value) -> None:
+        """Записывает значение ключа (None — удаляет ключ)."""
+        self._migrate()
+        self._remember(key, value)
+        self._pending[key] = value
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            if key not in self._pending:
+                return  # значение уже записал предыдущий вызов
+            value = self._pending[key]
+            await asyncio.to_thread(self._write, key, value)
+            if key in self._pending and self._pending[key] is value:
+                del self._pending[key]
+
+    def all(self) -> dict:
+        self._migrate()
+        data = {}
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    data.update(JsonJournal(os.path.join(self.directory, name)).read_snapshot(dict))
+        for key, value in self._pending.items():
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        return data
+
+    def count(self) -> int:
+        """Число ключей — по именам файлов, без их чтения."""
+        self._migrate()
+        keys = set()
+        if os.path.isdir(self.directory):
+            with os.scandir(self.directory) as entries:
+                keys = {unquote(entry.name[:-5]) for entry in entries if entry.name.endswith(".json")}
+        for key, value in self._pending.items():
+            if value is None:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return len(keys)
+
+
+def _apply_storage_record(data: dict, record: dict) -> None:
+    if record["v"] is None:
+        data.pop(record["k"], None)
+    else:
+        data[record["k"]] = record["v"]
+
+
+class JsonStorage(Storage):
+    """
+    Пространство имён — JSON-файл (для VK.ОРД — прежний файл токенов).
+    Файл читается один раз, дальше данные в памяти; каждое изменение атомарно
+    переписывает файл в потоке, одновременные записи одного файла склеиваются в одну.
+    При каждом обращении сверяются время изменения и размер файла: правка файла
+    вне бота (например, токенов VK.ОРД вручную) подхватывается без перезапуска.
+    Пространства из sharded хранятся по файлу на ключ (JsonShards): состояние VK.ОРД —
+    по файлу на пользователя в <directory>/vk_ord_state/.
+    Пространства из journaled (частые мелкие изменения: нумерация, метрики) пишутся
+    журналом (JsonJournal): изменение — строка в <файл>.journal, снимок переписывается
+    раз в JOURNAL_COMPACT_RECORDS записей и при закрытии. Правки их файлов вне бота не
+    подхватываются.
+    """
+
+    name = "json"
+
+    def __init__(self, directory: str, files: dict[str, str], cache_ttl: float = 0,
+                 sharded: tuple[str, ...] = (), shard_cache: int = 1000,
+                 journaled: tuple[str, ...] = (), fsync: bool = False):
+        super().__init__(cache_ttl=0)  # данные и так в памяти
+        self.directory = directory
+        self.files = files
+        self._data: dict[str, dict] = {}
+        self._dirty: set[str] = set()
+        self._write_locks: dict[str, asyncio.Lock] = {}
+        self._stamps: dict[str, tuple[int, int] | None] = {}  # ns → (mtime_ns, размер) файла при чтении/записи
+        self._shards = {ns: JsonShards(os.path.join(directory, ns), files.get(ns), shard_cache) for ns in sharded}
+        self._journals = {ns: JsonJournal(self._path(ns), fsync=fsync) for ns in journaled}
+
+    def _path(self, ns: str) -> str:
+        return self.files.get(ns) or os.path.join(self.directory, f"{ns}.json")
+
+    def _stamp(self, ns: str) -> tuple[int, int] | None:
+        try:
+            st = os.stat(self._path(ns))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _ns(self, ns: str) -> dict:
+        data = self._data.get(ns)
+        journal = self._journals.get(ns)
+        if journal is not None:
+            self.stats.cached(ns, data is not None)
+            if data is None:
+                data = self._data[ns] = journal.read_snapshot(dict)
+                journal.replay(data, _apply_storage_record, truncate=True)
             return data
-    except Exception:
-        return {"unique_users": {}, "total_count": 0, "daily_registrations": {}}
+        if data is not None:
+            lock = self._write_locks.get(ns)
+            if ns in self._dirty or (lock is not None and lock.locked()) or self._stamp(ns) == self._stamps.get(ns):
+                self.stats.cached(ns, True)  # своя запись ещё идёт или файл не менялся
+                return data
+            logging.info("Хранилище: %s изменён вне бота, перечитываю", self._path(ns))
+        self.stats.cached(ns, False)
+        self._stamps[ns] = self._stamp(ns)
+        data = self._data[ns] = JsonJournal(self._path(ns)).read_snapshot(dict)
+        return data
+
+    def _write_snapshot(self, ns: str, snapshot: dict) -> tuple[int, int] | None:
+        JsonJournal(self._path(ns)).write_snapshot(snapshot)
+        return self._stamp(ns)
+
+    async def _compact(self, ns: str, journal: JsonJournal) -> None:
+        async with self._write_locks.setdefault(ns, asyncio.Lock()):
+            if not journal.records:
+                return
+            # Снимок и поворот журнала — без await между ними: новые записи идут в свежий журнал
+            snapshot = dict(self._data[ns])
+            journal.rotate()
+            await asyncio.to_thread(journal.write_snapshot, snapshot)
+
+    async def _save(self, ns: str, changes: dict) -> None:
+        """Сохраняет пространство после изменения changes ({ключ: значение}, None — удалён)."""
+        journal = self._journals.get(ns)
+        if journal is not None:
+            for key, value in changes.items():
+                journal.append({"k": key, "v": value})
+            lock = self._write_locks.get(ns)
+            if journal.records >= JOURNAL_COMPACT_RECORDS and not (lock is not None and lock.locked()):
+                await self._compact(ns, journal)
+            return
+        self._dirty.add(ns)
+        async with self._write_locks.setdefault(ns, asyncio.Lock()):
+            if ns not in self._dirty:
+                return  # изменения уже записал предыдущий вызов
+            self._dirty.discard(ns)
+            # Значения в памяти только заменяются целиком, поэтому неглубокой копии достаточно
+            snapshot = dict(self._data[ns])
+            try:
+                self._stamps[ns] = await asyncio.to_thread(self._write_snapshot, ns, snapshot)
+            except Exception:
+                self._dirty.add(ns)
+                raise
+
+    async def _get(self, ns: str, key: str):
+        shards = self._shards.get(ns)
+        return deepcopy(shards.get(key) if shards else self._ns(ns).get(key))
+
+    async def _set(self, ns: str, key: str, value) -> None:
+        shards = self._shards.get(ns)
+        if shards:
+            await shards.put(key, deepcopy(value))
+            return
+        self._ns(ns)[key] = deepcopy(value)
+        await self._save(ns, {key: value})
+
+    async def _getset(self, ns: str, key: str, value):
+        shards = self._shards.get(ns)
+        if shards:
+            prev = shards.get(key)
+            await shards.put(key, deepcopy(value))
+            return deepcopy(prev)
+        data = self._ns(ns)
+        prev = data.get(key)
+        data[key] = deepcopy(value)
+        await self._save(ns, {key: value})
+        return prev
+
+    async def _delete(self, ns: str, key: str) -> None:
+        await self._delete_many(ns, [key])
+
+    async def _delete_many(self, ns: str, keys: list[str]) -> None:
+        shards = self._shards.get(ns)
+        if shards:
+            await asyncio.gather(*(shards.put(key, None) for key in keys if shards.get(key) is not None))
+            return
+        data = self._ns(ns)
+        removed = [key for key in keys if data.pop(key, None) is not None]
+        if removed:
+            await self._save(ns, dict.fromkeys(removed))
+
+    async def _all(self, ns: str) -> dict:
+        shards = self._shards.get(ns)
+        return deepcopy(shards.all() if shards else self._ns(ns))
+
+    async def _count(self, ns: str) -> int:
+        shards = self._shards.get(ns)
+        return shards.count() if shards else len(self._ns(ns))
+
+    async def _incr(self, ns: str, key: str, amount: int) -> int:
+        shards = self._shards.get(ns)
+        if shards:
+            value = int(shards.get(key) or 0) + amount
+            await shards.put(key, value)
+            return value
+        data = self._ns(ns)
+        data[key] = int(data.get(key) or 0) + amount
+        value = data[key]
+        await self._save(ns, {key: value})
+        return value
+
+    async def _add(self, ns: str, key: str, value) -> bool:
+        shards = self._shards.get(ns)
+        if shards:
+            if shards.get(key) is not None:
+                return False
+            await shards.put(key, deepcopy(value))
+            return True
+        data = self._ns(ns)
+        if key in data:
+            return False
+        data[key] = deepcopy(value)
+        await self._save(ns, {key: value})
+        return True
+
+    async def _set_many(self, ns: str, mapping: dict) -> None:
+        shards = self._shards.get(ns)
+        if shards:
+            await asyncio.gather(*(shards.put(key, deepcopy(value)) for key, value in mapping.items()))
+            return
+        self._ns(ns).update(deepcopy(mapping))
+        await self._save(ns, mapping)
+
+    async def close(self) -> None:
+        """Сворачивает журналы в снимки."""
+        for ns, journal in self._journals.items():
+            if ns in self._data:
+                await self._compact(ns, journal)
+            journal.close()
+
+
+class SqliteStorage(Storage):
+    """
+    Все пространства имён в одной таблице SQLite (WAL). Запросы идут в потоке;
+    incr, getset и add атомарны и между процессами (BEGIN IMMEDIATE / INSERT OR IGNORE).
+    """
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, path: str, cache_ttl: float = 0):
+        super().__init__(cache_ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+
+    def _run(self, fn, *args):
+        def call():
+            with self._lock:
+                return fn(*args)
+        return asyncio.to_thread(call)
+
+    def _transaction(self, fn, *args):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return result
+
+    def _get_sync(self, ns: str, key: str):
+        row = self._db.execute("SELECT value FROM kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _incr_sync(self, ns: str, key: str, amount: int) -> int:
+        self._db.execute(
+            "INSERT INTO kv (ns, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(ns, key) DO UPDATE SET value = CAST(value AS INTEGER) + CAST(excluded.value AS INTEGER)",
+            (ns, key, str(amount)),
+        )
+        return int(self._get_sync(ns, key))
+
+    def _getset_sync(self, ns: str, key: str, value):
+        prev = self._get_sync(ns, key)
+        self._set_many_sync(ns, {key: value})
+        return prev
+
+    def _set_many_sync(self, ns: str, mapping: dict) -> None:
+        self._db.executemany(
+            "INSERT INTO kv (ns, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(ns, key) DO UPDATE SET value = excluded.value",
+            [(ns, key, json.dumps(value, ensure_ascii=False)) for key, value in mapping.items()],
+        )
+
+    async def _get(self, ns: str, key: str):
+        return await self._run(self._get_sync, ns, key)
+
+    async def _set(self, ns: str, key: str, value) -> None:
+        await self._run(self._set_many_sync, ns, {key: value})
+
+    async def _getset(self, ns: str, key: str, value):
+        return await self._run(self._transaction, self._getset_sync, ns, key, value)
 
+    def _delete_many_sync(self, ns: str, keys: list[str]) -> None:
+        self._db.executemany("DELETE FROM kv WHERE ns = ? AND key = ?", [(ns, key) for key in keys])
 
-def save_metrics(data: dict) -> None:
-    """Сохраняет метрики уникальных пользователей в файл."""
-    with open(METRICS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    async def _delete(self, ns: str, key: str) -> None:
+        await self._run(self._db.execute, "DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+
+    async def _delete_many(self, ns: str, keys: list[str]) -> None:
+        await self._run(self._transaction, self._delete_many_sync, ns, keys)
+
+    async def _all(self, ns: str) -> dict:
+        rows = await self._run(
+            lambda: self._db.execute("SELECT key, value FROM kv WHERE ns = ?", (ns,)).fetchall()
+        )
+        return {key: json.loads(value) for key, value in rows}
+
+    async def _count(self, ns: str) -> int:
+        return await self._run(lambda: self._db.execute("SELECT COUNT(*) FROM kv WHERE ns = ?", (ns,)).fetchone()[0])
+
+    async def _incr(self, ns: str, key: str, amount: int) -> int:
+        return await self._run(self._transaction, self._incr_sync, ns, key, amount)
+
+    async def _add(self, ns: str, key: str, value) -> bool:
+        cursor = await self._run(
+            self._db.execute,
+            "INSERT OR IGNORE INTO kv (ns, key, value) VALUES (?, ?, ?)",
+            (ns, key, json.dumps(value, ensure_ascii=False)),
+        )
+        return cursor.rowcount == 1
+
+    async def _set_many(self, ns: str, mapping: dict) -> None:
+        await self._run(self._transaction, self._set_many_sync, ns, mapping)
+
+    async def close(self) -> None:
+        await self._run(self._db.close)
+
+
+class RedisStorage(Storage):
+    """
+    Пространство имён — хэш STORAGE_REDIS_PREFIX + ns на сервере с протоколом Redis
+    (Redis, Valkey, KeyDB…). incr и add — HINCRBY и HSETNX, getset — HGET и HSET
+    в одной транзакции MULTI; всё атомарно на сервере.
+    Нужен пакет redis (pip install redis).
+    """
+
+    name = "redis"
+    shared = True
+    BATCH = 1000
+
+    def __init__(self, url: str, prefix: str, cache_ttl: float = 0):
+        super().__init__(cache_ttl)
+        try:
+            import redis.asyncio as _redis_asyncio
+        except ImportError:
+            raise SystemExit('Для STORAGE_BACKEND = "redis" нужен пакет redis: pip install redis') from None
+        self.prefix = prefix
+        self._redis = _redis_asyncio.from_url(url, decode_responses=True)
+
+    def _key(self, ns: str) -> str:
+        return self.prefix + ns
+
+    async def _get(self, ns: str, key: str):
+        raw = await self._redis.hget(self._key(ns), key)
+        return json.loads(raw) if raw is not None else None
+
+    async def _set(self, ns: str, key: str, value) -> None:
+        await self._redis.hset(self._key(ns), key, json.dumps(value, ensure_ascii=False))
+
+    async def _getset(self, ns: str, key: str, value):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hget(self._key(ns), key)
+            pipe.hset(self._key(ns), key, json.dumps(value, ensure_ascii=False))
+            raw, _ = await pipe.execute()
+        return json.loads(raw) if raw is not None else None
+
+    async def _delete(self, ns: str, key: str) -> None:
+        await self._redis.hdel(self._key(ns), key)
+
+    async def _delete_many(self, ns: str, keys: list[str]) -> None:
+        for i in range(0, len(keys), self.BATCH):
+            await self._redis.hdel(self._key(ns), *keys[i:i + self.BATCH])
+
+    async def _all(self, ns: str) -> dict:
+        raw = await self._redis.hgetall(self._key(ns))
+        return {key: json.loads(value) for key, value in raw.items()}
+
+    async def _count(self, ns: str) -> int:
+        return await self._redis.hlen(self._key(ns))
+
+    async def _incr(self, ns: str, key: str, amount: int) -> int:
+        return int(await self._redis.hincrby(self._key(ns), key, amount))
+
+    async def _add(self, ns: str, key: str, value) -> bool:
+        return bool(await self._redis.hsetnx(self._key(ns), key, json.dumps(value, ensure_ascii=False)))
+
+    async def _set_many(self, ns: str, mapping: dict) -> None:
+        items = [(key, json.dumps(value, ensure_ascii=False)) for key, value in mapping.items()]
+        for i in range(0, len(items), self.BATCH):
+            await self._redis.hset(self._key(ns), mapping=dict(items[i:i + self.BATCH]))
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+_storage: Storage | None = None
+
+
+def _json_storage() -> JsonStorage:
+    return JsonStorage(
+        STORAGE_DIR,
+        {
+            "vk_ord_tokens": VK_ORD_TOKENS_FILE,
+            "vk_ord_state": VK_ORD_STATE_FILE,
+            # Не путать с прежним COUNTERS_FILE (другой формат; переносится import_local_state)
+            "counters": os.path.join(STORAGE_DIR, "daily_counters.json"),
+        },
+        sharded=("vk_ord_state",),
+        shard_cache=STORAGE_STATE_CACHE_USERS,
+        journaled=("counters", "unique_users", "daily_registrations"),
+        fsync=JOURNAL_FSYNC,
+    )
+
+
+def storage() -> Storage:
+    """Хранилище состояния процесса (создаётся при первом обращении)."""
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == "sqlite":
+            _storage = SqliteStorage(STORAGE_SQLITE_PATH, cache_ttl=STORAGE_CACHE_TTL)
+        elif STORAGE_BACKEND == "redis":
+            _storage = RedisStorage(STORAGE_REDIS_URL, STORAGE_REDIS_PREFIX, cache_ttl=STORAGE_CACHE_TTL)
+        else:
+            _storage = _json_storage()
+    return _storage
+
+
+_counters_storage: Storage | None = None
+
+
+def counters_storage() -> Storage:
+    """
+    Хранилище нумерации документов и архива счётчиков. При общем хранилище и при
+    COUNTERS_BACKEND = "json" — само storage(); при "sqlite" с хранилищем "json" —
+    отдельная база COUNTERS_DB, чтобы номера были уникальны и при нескольких процессах бота.
+    """
+    global _counters_storage
+    if storage().shared or COUNTERS_BACKEND != "sqlite":
+        return storage()
+    if _counters_storage is None:
+        _counters_storage = SqliteStorage(COUNTERS_DB)
+    return _counters_storage
+
+
+async def close_storage() -> None:
+    global _storage, _counters_storage
+    if _counters_storage is not None:
+        await _counters_storage.close()
+        _counters_storage = None
+    if _storage is not None:
+        await _storage.close()
+        _storage = None
+
+
+# ── Прежние локальные счётчики и метрики ──
+# До переноса в хранилище нумерация жила в COUNTERS_FILE (с журналом) или в таблице
+# counters базы COUNTERS_DB, закрытые дни — в COUNTERS_ARCHIVE_DIR/counters-ГГГГ-ММ.json.gz,
+# метрики — в METRICS_FILE. Эти функции только читают их для import_local_state.
+def _apply_counter_record(data: dict, record: dict) -> None:
+    data.setdefault(record["d"], {})[record["u"]] = record["v"]
+
+
+def load_counters(journal: JsonJournal | None = None) -> dict:
+    """Прежние счётчики нумерации: снимок COUNTERS_FILE плюс его журнал."""
+    journal = journal or JsonJournal(COUNTERS_FILE)
+    data = journal.read_snapshot(dict)
+    journal.replay(data, _apply_counter_record)
+    return data
+
+
+def _counters_archive_path(month: str) -> str:
+    return os.path.join(COUNTERS_ARCHIVE_DIR, f"counters-{month}.json.gz")
+
+
+def read_counters_archive(month: str) -> dict:
+    """Прежний архив счётчиков за месяц ГГГГ-ММ: {день: {пользователь: номер}}."""
+    path = _counters_archive_path(month)
+    if not os.path.exists(path):
+        return {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def counters_archive_months() -> list[str]:
+    if not os.path.isdir(COUNTERS_ARCHIVE_DIR):
+        return []
+    rx = re.compile(r"^counters-(\d{4}-\d{2})\.json\.gz$")
+    return sorted(m.group(1) for m in map(rx.match, os.listdir(COUNTERS_ARCHIVE_DIR)) if m)
+
+
+def read_legacy_counters() -> dict:
+    """Все прежние счётчики {день: {пользователь: номер}}; совпадения — по максимуму."""
+    days: dict[str, dict] = {}
+
+    def merge(day: str, user_id, value) -> None:
+        per_day = days.setdefault(day, {})
+        per_day[str(user_id)] = max(int(value), per_day.get(str(user_id), 0))
+
+    for day, per_user in load_counters().items():
+        if isinstance(per_user, dict):
+            for user_id, value in per_user.items():
+                merge(day, user_id, value)
+    if os.path.exists(COUNTERS_DB):
+        db = sqlite3.connect(COUNTERS_DB, timeout=30)
+        try:
+            if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'counters'").fetchone():
+                for day, user_id, value in db.execute("SELECT day, user_id, value FROM counters"):
+                    merge(day, user_id, value)
+        finally:
+            db.close()
+    for month in counters_archive_months():
+        for day, per_user in read_counters_archive(month).items():
+            for user_id, value in per_user.items():
+                merge(day, user_id, value)
+    return days
+
+
+def _empty_metrics() -> dict:
+    return {"unique_users": {}, "total_count": 0, "daily_registrations": {}}
+
+
+def _apply_metrics_record(data: dict, record: dict) -> None:
+    user_id_str, date_key = record["u"], record["d"]
+    if user_id_str in data["unique_users"]:
+        return
+    data["unique_users"][user_id_str] = date_key
+    data["total_count"] = len(data["unique_users"])
+    data["daily_registrations"][date_key] = data["daily_registrations"].get(date_key, 0) + 1
+
+
+def load_metrics(journal: JsonJournal | None = None) -> dict:
+    """Прежние метрики уникальных пользователей: снимок METRICS_FILE плюс журнал."""
+    journal = journal or JsonJournal(METRICS_FILE)
+    data = journal.read_snapshot(_empty_metrics)
+    # Инициализация структуры для обратной совместимости
+    if "unique_users" not in data:
+        data["unique_users"] = {}
+    if "total_count" not in data:
+        data["total_count"] = len(data.get("unique_users", {}))
+    if "daily_registrations" not in data:
+        data["daily_registrations"] = {}
+    journal.replay(data, _apply_metrics_record)
+    return data
+
+
+# ── Архив счётчиков ──
+# В рабочем пространстве counters остаётся только сегодняшний день: закрытые дни
+# раз в COUNTERS_ARCHIVE_INTERVAL секунд (и при старте) переносятся в помесячные
+# пространства counters_archive/ГГГГ-ММ того же хранилища (ключ — день, значение —
+# {пользователь: номер}; при "json" — файл на месяц), а counters_archive_months
+# перечисляет месяцы с архивом. Выдача номера поэтому не зависит от того, сколько бот
+# уже проработал, а история за период читает только свои месяцы.
+# Сначала пишется архив, потом дни удаляются из рабочего пространства; повторный
+# перенос того же дня безопасен — значения в архиве сливаются по максимуму.
+def _counters_archive_ns(month: str) -> str:
+    return f"counters_archive/{month}"
+
+
+async def _merge_counters_archive(days: dict) -> None:
+    st = counters_storage()
+    by_month: dict[str, dict] = {}
+    for day, per_user in days.items():
+        by_month.setdefault(day[:7], {})[day] = per_user
+    for month, part in sorted(by_month.items()):
+        merged = {}
+        for day, per_user in part.items():
+            # Читаем только переносимые дни, а не весь месяц
+            data = await st.get(_counters_archive_ns(month), day, {})
+            for user_id, value in per_user.items():
+                data[user_id] = max(int(value), int(data.get(user_id, 0)))
+            merged[day] = data
+        await st.set_many(_counters_archive_ns(month), merged)
+        await st.set("counters_archive_months", month, True)
+
+
+async def counters_archive_days(start: str = "", end: str = "9999") -> dict:
+    """Архив счётчиков за дни start..end (строки ГГГГ-ММ-ДД): {день: {пользователь: номер}}."""
+    st = counters_storage()
+    data = {}
+    for month in sorted(await st.all("counters_archive_months")):
+        if start[:7] <= month <= end[:7]:
+            data.update(await st.all(_counters_archive_ns(month)))
+    return {day: per_user for day, per_user in data.items() if start <= day <= end}
+
+
+async def archive_counters(today: str | None = None) -> int:
+    """Переносит в архив все дни раньше today (по умолчанию — сегодня); возвращает их число."""
+    today = today or now_tz().strftime("%Y-%m-%d")
+    st = counters_storage()
+    days: dict[str, dict] = {}
+    for key, value in (await st.all("counters")).items():
+        day, _, user_id = key.partition(":")
+        if day < today:
+            days.setdefault(day, {})[user_id] = int(value)
+    if not days:
+        return 0
+    await _merge_counters_archive(days)
+    await st.delete_many("counters", [f"{day}:{user_id}" for day, per_user in days.items() for user_id in per_user])
+    logging.info("Счётчики: в архив перенесено дней: %s (%s – %s)", len(days), min(days), max(days))
+    return len(days)
+
+
+async def counters_archive_loop() -> None:
+    while True:
+        try:
+            await archive_counters()
+        except Exception:
+            logging.error("❌ Не удалось перенести счётчики в архив")
+            logging.error(traceback.format_exc())
+        await asyncio.sleep(COUNTERS_ARCHIVE_INTERVAL)
+
+
+def counters_history(archive: dict, user_id: str | None = None) -> dict:
+    """
+    Итоги по архиву счётчиков {день: {пользователь: номер}} (см. counters_archive_days):
+    сколько номеров выдано — всего, по месяцам и по пользователям.
+    Номер дня — последний выданный, после сброса нумерации счёт начинается заново.
+    """
+    months: dict[str, int] = {}
+    users: dict[str, int] = {}
+    days = 0
+    for day, per_user in archive.items():
+        month = day[:7]
+        counted = False
+        for uid, value in per_user.items():
+            if user_id is not None and uid != user_id:
+                continue
+            months[month] = months.get(month, 0) + int(value)
+            users[uid] = users.get(uid, 0) + int(value)
+            counted = counted or int(value) > 0
+        days += counted
+    return {"total": sum(months.values()), "days": days, "months": months, "users": users}
 
 
-def track_unique_user(user_id: int) -> bool:
+# ── Метрики уникальных пользователей ──
+# Метрики лежат в хранилище: unique_users — пользователь → день регистрации,
+# daily_registrations — день → число регистраций, registrations_total — закрытый день →
+# регистрации за все дни по него включительно (ключ "first" — первый день регистраций).
+# Регистрации за период — разность двух сумм, поэтому /stats читает несколько ключей,
+# а не все дни. Суммы дописываются при первом запросе после смены дня: от последней
+# записанной суммы по daily_registrations (обычно один день).
+async def track_unique_user(user_id: int) -> bool:
     """Отслеживает уникального пользователя. Возвращает True если пользователь новый."""
-    metrics = load_metrics()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in metrics["unique_users"]:
-        # Новый пользователь
-        now = now_tz()
-        date_key = now.strftime("%Y-%m-%d")
-        metrics["unique_users"][user_id_str] = date_key
-        metrics["total_count"] = len(metrics["unique_users"])
-        
-        # Увеличиваем счетчик регистраций за день
-        if date_key not in metrics["daily_registrations"]:
-            metrics["daily_registrations"][date_key] = 0
-        metrics["daily_registrations"][date_key] += 1
-        
-        save_metrics(metrics)
-        return True
-    return False
+    date_key = now_tz().strftime("%Y-%m-%d")
+    if not await storage().add("unique_users", str(user_id), date_key):
+        return False
+    await storage().incr("daily_registrations", date_key)
+    return True
 
 
-def get_unique_users_count() -> int:
+async def get_unique_users_count() -> int:
     """Возвращает общее количество уникальных пользователей."""
-    metrics = load_metrics()
-    return metrics.get("total_count", len(metrics.get("unique_users", {})))
+    return await storage().count("unique_users")
+
+
+# Окна статистики по умолчанию: название → число дней, включая сегодняшний
+STATS_WINDOWS = {"today": 1, "week": 7, "month": 30}
+DAY_KEY_RX = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+async def _closed_registrations_total(day: datetime.date) -> int:
+    """Регистрации за все дни по закрытый (уже прошедший) день day включительно."""
+    st = storage()
+    one_day = datetime.timedelta(days=1)
+    total = await st.get("registrations_total", day.isoformat())
+    if total is not None:
+        return int(total)
+    first = await st.get("registrations_total", "first")
+    if first is not None and day.isoformat() < first:
+        return 0
+    daily = None
+    if first is None:
+        # Сумм ещё нет — считаем с первого дня регистраций по всем дням один раз
+        daily = await st.all("daily_registrations")
+        days = sorted(key for key in daily if DAY_KEY_RX.match(key))
+        if not days:
+            return 0
+        first = days[0]
+        await st.set("registrations_total", "first", first)
+        if day.isoformat() < first:
+            return 0
+        base, total = datetime.date.fromisoformat(first) - one_day, 0
+    else:
+        # Ближайшая записанная сумма раньше day (суммы идут подряд с первого дня)
+        base, total = day - one_day, None
+        while base.isoformat() >= first:
+            total = await st.get("registrations_total", base.isoformat())
+            if total is not None:
+                break
+            base -= one_day
+        total = int(total or 0)
+    totals = {}
+    while base < day:
+        base += one_day
+        key = base.isoformat()
+        count = daily.get(key, 0) if daily is not None else await st.get("daily_registrations", key, 0)
+        total += int(count)
+        totals[key] = total
+    await st.set_many("registrations_total", totals)
+    return total
+
+
+async def _registrations_through(day: datetime.date, today: datetime.date) -> int:
+    """Регистрации за все дни по day включительно; сегодняшний день ещё идёт — из daily_registrations."""
+    if day < today:
+        return await _closed_registrations_total(day)
+    today_count = await storage().get("daily_registrations", today.isoformat(), 0)
+    return await _closed_registrations_total(today - datetime.timedelta(days=1)) + int(today_count)
+
+
+async def unique_users_stats(start: datetime.date, end: datetime.date) -> int:
+    """Новые уникальные пользователи за период [start, end] (даты по Москве)."""
+    if start > end:
+        return 0
+    today = now_tz().date()
+    before = await _registrations_through(start - datetime.timedelta(days=1), today)
+    return await _registrations_through(end, today) - before
+
+
+async def get_unique_users_stats(windows: dict | None = None) -> dict:
+    """
+    Статистика по уникальным пользователям: всего и новые за окна из windows
+    (название → число последних дней, по умолчанию STATS_WINDOWS).
+    """
+    today = now_tz().date()
+    result = {"total": await get_unique_users_count()}
+    for name, days in (windows or STATS_WINDOWS).items():
+        result[name] = await unique_users_stats(today - datetime.timedelta(days=days - 1), today)
+    return result
 
 
-def get_unique_users_stats() -> dict:
-    """Возвращает статистику по уникальным пользователям."""
-    metrics = load_metrics()
-    now = now_tz()
-    today_key = now.strftime("%Y-%m-%d")
-    
-    # Подсчет за период
-    week_ago = now - datetime.timedelta(days=7)
-    month_ago = now - datetime.timedelta(days=30)
-    
-    today_count = metrics["daily_registrations"].get(today_key, 0)
-    
-    week_count = 0
-    month_count = 0
-    for date_str, count in metrics["daily_registrations"].items():
+# ── Активность пользователей (DAU/WAU/MAU, удержание) ──
+# Каждому пользователю при первом появлении выдаётся плотный номер (0, 1, 2, …), и
+# активность за день — множество номеров в виде битовой карты в духе Roaring:
+# номера делятся на блоки по 65536, блок хранится отсортированным массивом uint16,
+# пока в нём не больше ACTIVITY_ARRAY_LIMIT номеров, и битовой картой 8 КБ после.
+# Номера выдаются по порядку, поэтому новые пользователи за любые дни — это
+# непрерывный диапазон номеров: когорты берутся без отдельного хранения.
+ACTIVITY_CHUNK_BITS = 16
+ACTIVITY_CHUNK_SIZE = 1 << ACTIVITY_CHUNK_BITS
+ACTIVITY_ARRAY_LIMIT = 4096
+ACTIVITY_BITMAP_BYTES = ACTIVITY_CHUNK_SIZE // 8
+
+
+class ActivityBitmap:
+    """Множество номеров пользователей за один день."""
+
+    __slots__ = ("chunks",)
+
+    def __init__(self):
+        self.chunks: dict[int, array | bytearray] = {}
+
+    def add(self, idx: int) -> bool:
+        """Добавляет номер; True — если его ещё не было."""
+        hi, lo = idx >> ACTIVITY_CHUNK_BITS, idx & (ACTIVITY_CHUNK_SIZE - 1)
+        chunk = self.chunks.get(hi)
+        if chunk is None:
+            self.chunks[hi] = array("H", [lo])
+            return True
+        if isinstance(chunk, bytearray):
+            mask = 1 << (lo & 7)
+            if chunk[lo >> 3] & mask:
+                return False
+            chunk[lo >> 3] |= mask
+            return True
+        pos = bisect_left(chunk, lo)
+        if pos < len(chunk) and chunk[pos] == lo:
+            return False
+        chunk.insert(pos, lo)
+        if len(chunk) > ACTIVITY_ARRAY_LIMIT:
+            bitmap = bytearray(ACTIVITY_BITMAP_BYTES)
+            for v in chunk:
+                bitmap[v >> 3] |= 1 << (v & 7)
+            self.chunks[hi] = bitmap
+        return True
+
+    def bits(self) -> dict[int, int]:
+        """Блоки как целые числа-битовые маски — для объединений и пересечений."""
+        result = {}
+        for hi, chunk in self.chunks.items():
+            if isinstance(chunk, bytearray):
+                result[hi] = int.from_bytes(chunk, "little")
+            else:
+                bitmap = bytearray(ACTIVITY_BITMAP_BYTES)
+                for v in chunk:
+                    bitmap[v >> 3] |= 1 << (v & 7)
+                result[hi] = int.from_bytes(bitmap, "little")
+        return result
+
+    def nbytes(self) -> int:
+        return sum(len(c) if isinstance(c, bytearray) else len(c) * 2 for c in self.chunks.values())
+
+    def to_bytes(self) -> bytes:
+        parts = [b"ACT1"]
+        for hi in sorted(self.chunks):
+            chunk = self.chunks[hi]
+            if isinstance(chunk, bytearray):
+                parts.append(struct.pack("<HBH", hi, 1, 0))
+                parts.append(bytes(chunk))
+            else:
+                data = array("H", chunk)
+                if sys.byteorder == "big":
+                    data.byteswap()
+                parts.append(struct.pack("<HBH", hi, 0, len(chunk)))
+                parts.append(data.tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "ActivityBitmap":
+        if raw[:4] != b"ACT1":
+            raise ValueError("неизвестный формат битовой карты активности")
+        bitmap, pos = cls(), 4
+        while pos < len(raw):
+            hi, kind, count = struct.unpack_from("<HBH", raw, pos)
+            pos += 5
+            if kind == 1:
+                bitmap.chunks[hi] = bytearray(raw[pos:pos + ACTIVITY_BITMAP_BYTES])
+                pos += ACTIVITY_BITMAP_BYTES
+            else:
+                data = array("H")
+                data.frombytes(raw[pos:pos + count * 2])
+                if sys.byteorder == "big":
+                    data.byteswap()
+                bitmap.chunks[hi] = data
+                pos += count * 2
+        return bitmap
+
+
+def bits_union(*sets: dict[int, int]) -> dict[int, int]:
+    result: dict[int, int] = {}
+    for bits in sets:
+        for hi, mask in bits.items():
+            result[hi] = result.get(hi, 0) | mask
+    return result
+
+
+def bits_intersection(a: dict[int, int], b: dict[int, int]) -> dict[int, int]:
+    return {hi: a[hi] & b[hi] for hi in a.keys() & b.keys() if a[hi] & b[hi]}
+
+
+def bits_count(bits: dict[int, int]) -> int:
+    return sum(mask.bit_count() for mask in bits.values())
+
+
+def bits_range(start: int, end: int) -> dict[int, int]:
+    """Номера start..end-1 как битовые блоки."""
+    result: dict[int, int] = {}
+    idx = start
+    while idx < end:
+        hi = idx >> ACTIVITY_CHUNK_BITS
+        lo = idx & (ACTIVITY_CHUNK_SIZE - 1)
+        n = min(end - idx, ACTIVITY_CHUNK_SIZE - lo)
+        result[hi] = ((1 << n) - 1) << lo
+        idx += n
+    return result
+
+
+def _apply_activity_user_record(data: dict, record: dict) -> None:
+    # Запись журнала: пользователь u получил следующий номер в день d
+    if record["u"] in data.setdefault("index", {}):
+        return
+    data["index"][record["u"]] = len(data["users"])
+    data["days"].setdefault(record["d"], len(data["users"]))
+    data["users"].append(record["u"])
+
+
+class ActivityStore:
+    """
+    Активность пользователей по дням в ACTIVITY_DIR: users.json — номера
+    пользователей (снимок + журнал, см. JsonJournal), <день>.bin — битовая карта дня.
+    touch() вызывается на каждое обновление и в памяти ставит один бит; изменённые
+    дни пишутся фоновым потоком раз в METRICS_FLUSH_INTERVAL секунд и при остановке.
+    """
+
+    CACHE_DAYS = 70  # сколько дней держать в памяти (окна статистики — до 60 дней)
+
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._journal = JsonJournal(os.path.join(path, "users.json"), fsync=JOURNAL_FSYNC)
+        self._users: dict | None = None
+        self._known_users: dict = {}  # пользователь → день регистрации (unique_users) для первого запуска
+        self._day_starts: list[tuple[int, int]] = []  # (ordinal дня, первый номер этого дня)
+        self._days: dict[str, ActivityBitmap] = {}
+        self._dirty_days: set[str] = set()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread_pid = None
+
+    def _index(self) -> dict:
+        # Вызывается под self._lock
+        if self._users is None:
+            data = self._journal.read_snapshot(lambda: {"users": [], "days": {}})
+            data["index"] = {uid: i for i, uid in enumerate(data["users"])}
+            self._journal.replay(data, _apply_activity_user_record, truncate=True)
+            if not data["users"]:
+                self._seed_from_known(data)
+            self._users = data
+            self._day_starts = sorted(
+                (datetime.date.fromisoformat(day).toordinal(), first) for day, first in data["days"].items()
+            )
+        return self._users
+
+    def _seed_from_known(self, data: dict) -> None:
+        # Первый запуск: номера выдаются уже известным пользователям в порядке регистрации,
+        # чтобы когорты прошлых дней были видны сразу (их активности до этого момента нет)
+        for uid, day in sorted(self._known_users.items(), key=lambda kv: kv[1]):
+            record = {"u": uid, "d": day}
+            _apply_activity_user_record(data, record)
+            self._journal.append(record)
+        if data["users"]:
+            logging.info("Активность: %s известных пользователей получили номера", len(data["users"]))
+
+    def _read_day(self, day: str) -> ActivityBitmap | None:
+        """Карта дня с диска; None — файла нет (в этот день никто не заходил)."""
+        file_path = os.path.join(self.path, f"{day}.bin")
+        if not os.path.exists(file_path):
+            return None
         try:
-            date = datetime.datetime.strptime(date_str, "%Y-%m-%d")
-            if date >= week_ago:
-                week_count += count
-            if date >= month_ago:
-                month_count += count
+            with open(file_path, "rb") as f:
+                return ActivityBitmap.from_bytes(f.read())
         except Exception:
-            continue
-    
+            logging.error(f"❌ Не удалось прочитать активность за {day}: {file_path}")
+            logging.error(traceback.format_exc())
+            return None
+
+    def _cache_day(self, day: str, bitmap: ActivityBitmap) -> ActivityBitmap:
+        # Вызывается под self._lock; если день успели загрузить, остаётся загруженный
+        bitmap = self._days.setdefault(day, bitmap)
+        while len(self._days) > self.CACHE_DAYS:
+            stale = next((d for d in self._days if d not in self._dirty_days and d != day), None)
+            if stale is None:
+                break
+            del self._days[stale]
+        return bitmap
+
+    def _day(self, day: str) -> ActivityBitmap:
+        # Вызывается под self._lock
+        bitmap = self._days.get(day)
+        if bitmap is None:
+            bitmap = self._cache_day(day, self._read_day(day) or ActivityBitmap())
+        return bitmap
+
+    def touch(self, user_id: int, day: str) -> None:
+        """Отмечает, что пользователь был активен в день day."""
+        uid = str(user_id)
+        with self._lock:
+            users = self._index()
+            idx = users["index"].get(uid)
+            if idx is None:
+                record = {"u": uid, "d": day}
+                _apply_activity_user_record(users, record)
+                idx = users["index"][uid]
+                if users["days"][day] == idx:
+                    insort(self._day_starts, (datetime.date.fromisoformat(day).toordinal(), idx))
+                self._journal.append(record)
+            if self._day(day).add(idx):
+                self._dirty_days.add(day)
+
+    def active(self, start: datetime.date, end: datetime.date) -> dict[int, int]:
+        """
+        Пользователи, активные хотя бы раз с start по end (включительно; не больше
+        ACTIVITY_MAX_DAYS последних дней периода). Дни, которых нет в памяти, читаются
+        с диска без блокировки; дни без файла пропускаются и в кэш не попадают.
+        Читает файлы — из цикла событий вызывать через asyncio.to_thread.
+        """
+        start = max(start, end - datetime.timedelta(days=ACTIVITY_MAX_DAYS - 1))
+        days = [(start + datetime.timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+        with self._lock:
+            self._index()
+            parts = [self._days[day].bits() for day in days if day in self._days]
+            missing = [day for day in days if day not in self._days]
+        recent = (end - datetime.timedelta(days=self.CACHE_DAYS - 1)).isoformat()
+        for day in missing:
+            bitmap = self._read_day(day)
+            if bitmap is None:
+                continue
+            if day >= recent:
+                with self._lock:
+                    bitmap = self._cache_day(day, bitmap)
+            parts.append(bitmap.bits())
+        return bits_union(*parts)
+
+    def cohort(self, start: datetime.date, end: datetime.date) -> dict[int, int]:
+        """Пользователи, впервые появившиеся с start по end (включительно)."""
+        with self._lock:
+            users = self._index()
+            starts = self._day_starts
+            lo = bisect_left(starts, (start.toordinal(), -1))
+            hi = bisect_left(starts, (end.toordinal() + 1, -1))
+            first = starts[lo][1] if lo < len(starts) else len(users["users"])
+            last = starts[hi][1] if hi < len(starts) else len(users["users"])
+        return bits_range(first, last)
+
+    def flush(self) -> None:
+        """Пишет изменённые дни на диск и при необходимости сжимает журнал номеров."""
+        with self._write_lock:
+            with self._lock:
+                pending = [(day, self._days[day].to_bytes()) for day in self._dirty_days]
+                self._dirty_days.clear()
+                snapshot = None
+                if self._users is not None and self._journal.records >= JOURNAL_COMPACT_RECORDS:
+                    snapshot = {"users": list(self._users["users"]), "days": dict(self._users["days"])}
+                    self._journal.rotate()
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                for day, raw in pending:
+                    file_path = os.path.join(self.path, f"{day}.bin")
+                    with open(file_path + ".tmp", "wb") as f:
+                        f.write(raw)
+                    os.replace(file_path + ".tmp", file_path)
+                if snapshot is not None:
+                    self._journal.write_snapshot(snapshot)
+            except Exception:
+                with self._lock:
+                    self._dirty_days.update(day for day, _ in pending)
+                logging.error(f"❌ Не удалось сохранить активность в {self.path}")
+                logging.error(traceback.format_exc())
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def start(self, known_users: dict | None = None) -> None:
+        """
+        Загружает номера пользователей и запускает поток записи (один раз на процесс).
+        known_users — уже известные пользователи (см. _seed_from_known).
+        """
+        with self._lock:
+            self._known_users = known_users or {}
+            self._index()
+            self._known_users = {}
+        if self.flush_interval <= 0 or self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        self._stop.clear()
+        threading.Thread(target=self._flush_loop, name="activity-flush", daemon=True).start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self.flush()
+        with self._lock:
+            self._journal.close()
+
+
+activity_store = ActivityStore(ACTIVITY_DIR, METRICS_FLUSH_INTERVAL)
+
+
+def activity_enabled() -> bool:
+    """Активность пишется в локальные файлы процесса — только при хранилище "json"."""
+    return ACTIVITY_TRACKING and not storage().shared
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """Отмечает активность автора каждого обновления (outer-middleware на dp.update)."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and activity_enabled():
+            try:
+                activity_store.touch(user.id, now_tz().strftime("%Y-%m-%d"))
+            except Exception:
+                logging.error("❌ Не удалось отметить активность пользователя")
+                logging.error(traceback.format_exc())
+        return await handler(event, data)
+
+
+def activity_stats(today: datetime.date | None = None) -> dict:
+    """
+    DAU/WAU/MAU и удержание: сколько новых пользователей прошлой недели (месяца)
+    были активны на этой неделе (в этом месяце).
+    """
+    today = today or now_tz().date()
+    day = datetime.timedelta(days=1)
+    week = activity_store.active(today - 6 * day, today)
+    month = activity_store.active(today - 29 * day, today)
+    week_cohort = activity_store.cohort(today - 13 * day, today - 7 * day)
+    month_cohort = activity_store.cohort(today - 59 * day, today - 30 * day)
     return {
-        "total": metrics["total_count"],
-        "today": today_count,
-        "week": week_count,
-        "month": month_count
+        "dau": bits_count(activity_store.active(today, today)),
+        "wau": bits_count(week),
+        "mau": bits_count(month),
+        "week_cohort": bits_count(week_cohort),
+        "week_returned": bits_count(bits_intersection(week_cohort, week)),
+        "month_cohort": bits_count(month_cohort),
+        "month_returned": bits_count(bits_intersection(month_cohort, month)),
     }
 
 
-def get_user_daily_sequence(now: datetime.datetime, user_id: int) -> str:
-    counters = load_counters()
-    date_key = now.strftime("%Y-%m-%d")
-    per_day = counters.get(date_key) or {}
-    per_day[str(user_id)] = per_day.get(str(user_id), 0) + 1
-    counters[date_key] = per_day
-    save_counters(counters)
-    return f"{per_day[str(user_id)]:02d}"
+# Счётчики нумерации — пространство counters в counters_storage() с ключами «день:пользователь»;
+# incr и getset атомарны в любом хранилище (SQLite — в потоке, цикл событий не ждёт блокировку)
+async def get_user_daily_sequence(now: datetime.datetime, user_id: int) -> str:
+    day = now.strftime("%Y-%m-%d")
+    value = await counters_storage().incr("counters", f"{day}:{user_id}")
+    return f"{value:02d}"
+
 
+async def reset_user_daily_sequence(now: datetime.datetime, user_id: int) -> int:
+    day = now.strftime("%Y-%m-%d")
+    prev = await counters_storage().getset("counters", f"{day}:{user_id}", 0)
+    return int(prev or 0)
 
-def reset_user_daily_sequence(now: datetime.datetime, user_id: int) -> int:
-    counters = load_counters()
-    date_key = now.strftime("%Y-%m-%d")
-    per_day = counters.get(date_key) or {}
-    prev = per_day.get(str(user_id), 0)
-    per_day[str(user_id)] = 0
-    counters[date_key] = per_day
-    save_counters(counters)
-    return prev
 
+async def generate_number(now: datetime.datetime, user_id: int) -> str:
+    return f"{now.strftime('%d')}-{now.strftime('%m')}-{await get_user_daily_sequence(now, user_id)}"
 
-def generate_number(now: datetime.datetime, user_id: int) -> str:
-    return f"{now.strftime('%d')}-{now.strftime('%m')}-{get_user_daily_sequence(now, user_id)}"
+
+async def import_local_state() -> None:
+    """
+    Первый запуск: переносит в хранилище прежние локальные данные — токены и состояние
+    VK.ОРД (при общем хранилище), метрики из METRICS_FILE, счётчики и их архив
+    (см. read_legacy_counters). Прежние файлы не меняются; метрики переносятся только
+    в пустое хранилище, счётчики — один раз (отметка legacy_counters в пространстве meta).
+    """
+    st = storage()
+    if st.shared:
+        local = _json_storage()
+        for ns in ("vk_ord_tokens", "vk_ord_state"):
+            if not await st.count(ns):
+                data = await local.all(ns)
+                if data:
+                    await st.set_many(ns, data)
+                    logging.info("Хранилище: перенесено %s записей %s из локальных файлов", len(data), ns)
+    if not await st.count("unique_users"):
+        metrics = await asyncio.to_thread(load_metrics)
+        if metrics["unique_users"]:
+            await st.set_many("unique_users", metrics["unique_users"])
+            await st.set_many("daily_registrations", metrics["daily_registrations"])
+            logging.info("Хранилище: перенесено %s пользователей из %s", len(metrics["unique_users"]), METRICS_FILE)
+    cst = counters_storage()
+    if await cst.get("meta", "legacy_counters") is None:
+        days = await asyncio.to_thread(read_legacy_counters)
+        today = now_tz().strftime("%Y-%m-%d")
+        # Сегодняшний номер, уже выданный в хранилище, новее прежнего — его не трогаем
+        for user_id, value in days.pop(today, {}).items():
+            await cst.add("counters", f"{today}:{user_id}", value)
+        if days:
+            await _merge_counters_archive(days)
+            logging.info("Хранилище: перенесены прежние счётчики за %s дней", len(days))
+        await cst.set("meta", "legacy_counters", datetime.datetime.now().isoformat(timespec="seconds"))
 
 
 def generate_date(now: datetime.datetime) -> str:
     return now.strftime("%d.%m.%Y")
 
 # ── Подстановка в DOCX ──
+# Метки шаблонов: {{...}} в теле и <<..>> в колонтитулах.
+TOKEN_RX = re.compile(r"\{\{[^{}]+\}\}|<<[^<>]+>>")
+
+
+class _CompiledMapping(dict):
+    """
+    Словарь подстановок, разобранный один раз на весь документ:
+    метки вида {{...}}/<<..>> ищутся одним проходом регулярки и берутся из dict,
+    а ключи другого вида (plain) заменяются по-старому, последовательно.
+    """
+
+    def __init__(self, mapping: dict):
+        super().__init__()
+        self.plain = []
+        for k, v in mapping.items():
+            if TOKEN_RX.fullmatch(k):
+                self[k] = v
+            else:
+                self.plain.append((k, v))
+
+
+def _compile_mapping(mapping: dict) -> _CompiledMapping:
+    if isinstance(mapping, _CompiledMapping):
+        return mapping
+    return _CompiledMapping(mapping)
+
+
+def _set_paragraph_text(paragraph, text: str) -> None:
+    """Весь текст абзаца — в первый run (его формат сохраняется), остальные run очищаются."""
+    if paragraph.runs:
+        paragraph.runs[0].text = text
+        for r in paragraph.runs[1:]:
+            r.text = ""
+    else:
+        paragraph.add_run(text)
+
+
 def _replace_in_paragraph(paragraph, mapping: dict):
-    if not mapping:
+    mapping = _compile_mapping(mapping)
+    if not mapping and not mapping.plain:
         return
     text = paragraph.text or ""
+    # Абзацы без маркеров меток не трогаем вовсе (если нет «нестандартных» ключей)
+    if not mapping.plain and "{{" not in text and "<<" not in text:
+        return
     orig = text
-    for k, v in mapping.items():
+    text = TOKEN_RX.sub(lambda m: mapping.get(m.group(0), m.group(0)), text)
+    for k, v in mapping.plain:
         if k in text:
             text = text.replace(k, v)
     if text != orig:
-        if paragraph.runs:
-            paragraph.runs[0].text = text
-            for r in paragraph.runs[1:]:
-                r.text = ""
-        else:
-            paragraph.add_run(text)
+        _set_paragraph_text(paragraph, text)
 
 
 def _replace_in_table(table, mapping: dict):
@@ -475,6 +1910,7 @@ def _replace_in_table(table, mapping: dict):
 
 
 def _replace_in_header_footer(hf, mapping: dict):
+    mapping = _compile_mapping(mapping)
     for p in hf.paragraphs:
         _replace_in_paragraph(p, mapping)
     for t in hf.tables:
@@ -482,6 +1918,7 @@ def _replace_in_header_footer(hf, mapping: dict):
 
 
 def _replace_in_block(container, mapping: dict):
+    mapping = _compile_mapping(mapping)
     for p in getattr(container, "paragraphs", []):
         _replace_in_paragraph(p, mapping)
     for t in getattr(container, "tables", []):
@@ -508,29 +1945,12 @@ def enforce_times12_cell(cell):
             run.font.size = Pt(12)
 
 
-def copy_cell_alignment(src_cell, dst_cell):
-    try:
-        dst_cell.vertical_alignment = getattr(src_cell, "vertical_alignment", None)
-    except Exception:
-        pass
-    if src_cell.paragraphs and dst_cell.paragraphs:
-        sp = src_cell.paragraphs[0]
-        dp = dst_cell.paragraphs[0]
-        dp.alignment = sp.alignment
-        pf_src, pf_dst = sp.paragraph_format, dp.paragraph_format
-        pf_dst.left_indent = pf_src.left_indent
-        pf_dst.right_indent = pf_src.right_indent
-        pf_dst.first_line_indent = pf_src.first_line_indent
-        pf_dst.space_before = pf_src.space_before
-        pf_dst.space_after = pf_src.space_after
-        pf_dst.line_spacing = pf_src.line_spacing
-
-
-def replace_tag_in_cell(cell, old_tag: str, new_tag_text: str, tmpl_cell):
-    new_text = (cell.text or "").replace(old_tag, new_tag_text or "")
-    cell.text = new_text
-    copy_cell_alignment(tmpl_cell, cell)
-    enforce_times12_cell(cell)
+def normalize_table_fonts(doc: Document) -> None:
+    """Times New Roman 12 для всех run во всех ячейках таблиц документа."""
+    for tbl in doc.tables:
+        for row in tbl.rows:
+            for cell in row.cells:
+                enforce_times12_cell(cell)
 
 
 def _cell_has(cell, needle: str) -> bool:
@@ -580,13 +2000,6 @@ def _find_invoice_table_and_columns(doc: Document):
     return None, None, None, None, None
 
 
-def _insert_template_row_after(table, template_row, after_row_index: int):
-    anchor_tr = table.rows[after_row_index]._tr
-    new_tr = deepcopy(template_row._tr)
-    anchor_tr.addnext(new_tr)
-    return table.rows[after_row_index + 1]
-
-
 def _infer_number_format(row1_text: str, row2_text: str):
     if row1_text.strip().endswith(".") and row2_text.strip().endswith("."):
         return lambda n: f"{n}."
@@ -599,84 +2012,367 @@ def _infer_number_format(row1_text: str, row2_text: str):
     return lambda n: f"{n}."
 
 
-def add_dynamic_rows_for_items(doc: Document, items: list):
+ROW_TAGS = (TAG_CH, TAG_PR, TAG_AM, TAG_SD)
+
+
+def _plan_row_rewrites(tmpl_tr, num_tc, num2: str, mapping=None) -> list[tuple[int, str, bool]]:
+    """
+    Один раз разбирает строку-образец (пункт 2) и возвращает, что менять в её копиях:
+    список (индекс абзаца в строке, исходный текст, это_номер_пункта).
+    num2 — номер строки-образца в том виде, как он записан в ячейке (например «2.»).
+    Если передан mapping, в план попадают все абзацы с метками (не только метки пункта).
+    """
+    num_paragraphs = set(num_tc.iter(qn("w:p"))) if num_tc is not None else set()
+    tags2 = [tag_n(t, 2) for t in ROW_TAGS]
+    plan = []
+    num_planned = False
+    for i, p_el in enumerate(tmpl_tr.iter(qn("w:p"))):
+        text = Paragraph(p_el, None).text or ""
+        if p_el in num_paragraphs and not num_planned and num2 in text:
+            plan.append((i, text, True))
+            num_planned = True
+        elif any(t in text for t in tags2):
+            plan.append((i, text, False))
+        elif mapping is not None and (TOKEN_RX.search(text) or any(k in text for k, _ in mapping.plain)):
+            plan.append((i, text, False))
+    return plan
+
+
+def _rewrite_row_text(text: str, is_num: bool, k: int, num2: str, num_k: str, mapping=None) -> str:
+    if is_num:
+        return text.replace(num2, num_k, 1)
+    if mapping is None:
+        for t in ROW_TAGS:
+            text = text.replace(tag_n(t, 2), tag_n(t, k))
+        return text
+    # Метки пункта 2 переименовываются в метки пункта k и сразу заменяются значениями
+    renames = {tag_n(t, 2): tag_n(t, k) for t in ROW_TAGS}
+
+    def _value(m):
+        tag = renames.get(m.group(0), m.group(0))
+        return mapping.get(tag, tag)
+
+    text = TOKEN_RX.sub(_value, text)
+    for key, v in mapping.plain:
+        if key in text:
+            text = text.replace(key, v)
+    return text
+
+
+def build_dynamic_rows(doc: Document, items: list, layout: tuple | None = None, mapping: dict | None = None,
+                       style_row: bool = True):
+    """
+    Готовит строки пунктов 3..N, не вставляя их в таблицу.
+    Возвращает (строка-образец, список новых строк) или None, если достраивать нечего.
+
+    Строка пункта 2 клонируется на уровне XML, в копиях переписываются только номер
+    и абзацы с метками; оформление целиком наследуется от строки-образца.
+
+    Без mapping в копиях остаются метки {{PLACEMENT_CHANNELk}}/{{SERVICE_PERIODk}}/
+    {{AMOUNTk}}/{{SERVICE_DATEk}} для последующей подстановки. С mapping значения
+    пишутся сразу, а строка-образец заранее приводится к Times New Roman 12
+    (style_row=False — если шаблон уже нормализован при загрузке) —
+    такие строки не нуждаются ни в подстановке, ни в выравнивании шрифта, и время
+    рендера большого счёта растёт линейно от числа пунктов.
+
+    layout — заранее найденная раскладка таблицы пунктов из кэша шаблонов
+    (индекс таблицы, row1, row2, col_map, num_col). Без неё таблица ищется заново.
+    """
     if len(items) <= 2:
-        return
-    tbl, r1, r2, col_map, num_col = _find_invoice_table_and_columns(doc)
+        return None
+    if layout is not None:
+        tbl_idx, r1, r2, col_map, num_col = layout
+        tbl = doc.tables[tbl_idx]
+    else:
+        tbl, r1, r2, col_map, num_col = _find_invoice_table_and_columns(doc)
     if tbl is None:
+        return None
+    if mapping is not None:
+        mapping = _compile_mapping(mapping)
+
+    row1, row2 = tbl.rows[r1], tbl.rows[r2]
+    row2_num_text = row2.cells[num_col].text
+    fmt_num = _infer_number_format(row1.cells[num_col].text, row2_num_text)
+    # В шаблонах с дополнительной первой строкой (PRO) пункт 2 имеет номер «3.» —
+    # нумеруем новые строки от фактического номера строки-образца.
+    m = re.search(r"\d+", row2_num_text or "")
+    row2_num = int(m.group(0)) if m else 2
+    num2 = fmt_num(row2_num)
+    if mapping is not None and style_row:
+        for cell in row2.cells:
+            enforce_times12_cell(cell)
+    tmpl_tr = row2._tr
+    try:
+        num_tc = row2.cells[num_col]._tc
+    except Exception:
+        num_tc = None
+    plan = _plan_row_rewrites(tmpl_tr, num_tc, num2, mapping)
+
+    new_rows = []
+    for k in range(3, min(MAX_ITEMS_FOR_TEMPLATE, len(items)) + 1):
+        num_k = fmt_num(row2_num + k - 2)
+        tr = deepcopy(tmpl_tr)
+        paragraphs = list(tr.iter(qn("w:p")))
+        for i, text, is_num in plan:
+            new_text = _rewrite_row_text(text, is_num, k, num2, num_k, mapping)
+            if new_text != text or mapping is None:
+                _set_paragraph_text(Paragraph(paragraphs[i], None), new_text)
+        new_rows.append(tr)
+    return tmpl_tr, new_rows
+
+
+def insert_dynamic_rows(built) -> None:
+    """Вставляет строки из build_dynamic_rows сразу после строки-образца одной операцией."""
+    if not built:
         return
+    tmpl_tr, new_rows = built
+    parent = tmpl_tr.getparent()
+    pos = parent.index(tmpl_tr) + 1
+    parent[pos:pos] = new_rows
+
+
+def add_dynamic_rows_for_items(doc: Document, items: list, layout: tuple | None = None):
+    """Достраивает таблицу пунктов до len(items) строк с метками пунктов в новых строках."""
+    insert_dynamic_rows(build_dynamic_rows(doc, items, layout=layout))
+
+
+# ── Кэш скомпилированных шаблонов ──
+# Каждый шаблон разбирается с диска один раз; рендер работает с глубокой копией
+# уже разобранного дерева (в разы дешевле повторного чтения zip + XML).
+TEMPLATE_CACHE_ENABLED = getattr(config, 'TEMPLATE_CACHE_ENABLED', True)
+TEMPLATES_DIR = getattr(config, 'TEMPLATES_DIR', 'templates')
+# Times New Roman 12 в таблицах проставляется один раз при загрузке шаблона.
+# False (или имя файла в TEMPLATE_STYLE_PER_RENDER) — по-старому, на каждом рендере.
+TEMPLATE_STYLE_ON_LOAD = getattr(config, 'TEMPLATE_STYLE_ON_LOAD', True)
+TEMPLATE_STYLE_PER_RENDER = set(getattr(config, 'TEMPLATE_STYLE_PER_RENDER', ()))
+# Как часто (сек) проверять шаблоны на изменения; 0 — не следить, только перезапуск
+TEMPLATE_RELOAD_INTERVAL = getattr(config, 'TEMPLATE_RELOAD_INTERVAL', 5)
+
+_TEMPLATE_CACHE: dict[str, dict] = {}
+_template_watcher_pid = None
+_template_broken: dict[str, tuple[int, int]] = {}  # версии файлов, которые не удалось разобрать
+
+
+def _iter_all_paragraphs(doc: Document):
+    """Все абзацы документа: тело, таблицы (рекурсивно), колонтитулы."""
+    def _walk(container):
+        for p in getattr(container, "paragraphs", []):
+            yield p
+        for t in getattr(container, "tables", []):
+            for row in t.rows:
+                for cell in row.cells:
+                    yield from _walk(cell)
 
-    cell1_num = tbl.rows[r1].cells[num_col].text
-    cell2_num = tbl.rows[r2].cells[num_col].text
-    fmt_num = _infer_number_format(cell1_num, cell2_num)
-    tmpl_row = tbl.rows[r2]
+    yield from _walk(doc)
+    for section in doc.sections:
+        yield from _walk(section.header)
+        yield from _walk(section.footer)
 
-    insert_after = r2
-    for k in range(3, min(MAX_ITEMS_FOR_TEMPLATE, len(items)) + 1):
-        new_row = _insert_template_row_after(tbl, tmpl_row, insert_after)
-        insert_after += 1
 
+def compile_template(template_path: str) -> dict:
+    """
+    Разбирает шаблон и запоминает всё, что не зависит от данных рендера:
+    - doc            — разобранный Document (эталон, сам не изменяется);
+    - placeholders   — набор меток {{...}} / <<..>>, найденных в шаблоне;
+    - invoice_layout — раскладка таблицы пунктов (_find_invoice_table_and_columns)
+                       в виде (индекс таблицы, row1, row2, col_map, num_col) или None;
+    - styles_normalized — шрифт в таблицах уже приведён к Times New Roman 12;
+    - mtime, size, sha256 — версия файла, из которой собран шаблон.
+    """
+    st = os.stat(template_path)
+    with open(template_path, "rb") as f:
+        content = f.read()
+    doc = Document(io.BytesIO(content))
+    styles_normalized = (
+        TEMPLATE_STYLE_ON_LOAD
+        and os.path.basename(template_path) not in TEMPLATE_STYLE_PER_RENDER
+    )
+    if styles_normalized:
+        normalize_table_fonts(doc)
+    placeholders = set()
+    for p in _iter_all_paragraphs(doc):
+        placeholders.update(TOKEN_RX.findall(p.text or ""))
+
+    tbl, r1, r2, col_map, num_col = _find_invoice_table_and_columns(doc)
+    layout = None
+    if tbl is not None:
+        tbl_idx = next(i for i, t in enumerate(doc.tables) if t._tbl is tbl._tbl)
+        layout = (tbl_idx, r1, r2, col_map, num_col)
+
+    return {
+        "path": template_path,
+        "doc": doc,
+        "placeholders": placeholders,
+        "invoice_layout": layout,
+        "styles_normalized": styles_normalized,
+        "mtime": st.st_mtime_ns,
+        "size": st.st_size,
+        "sha256": hashlib.sha256(content).hexdigest(),
+    }
+
+
+def get_compiled_template(template_path: str) -> dict:
+    """Возвращает скомпилированный шаблон из кэша (компилирует при первом обращении)."""
+    key = os.path.abspath(template_path)
+    tpl = _TEMPLATE_CACHE.get(key)
+    if tpl is None:
+        tpl = compile_template(template_path)
+        if TEMPLATE_CACHE_ENABLED:
+            _TEMPLATE_CACHE[key] = tpl
+    return tpl
+
+
+def clone_template_document(tpl: dict) -> Document:
+    """
+    Независимая копия разобранного шаблона для одного рендера.
+    Копируем именно DocumentPart (вместе со всем пакетом через связи): копия Document
+    целиком размножила бы XML-дерево, на которое ссылаются и Document, и его part.
+    """
+    return deepcopy(tpl["doc"].part).document
+
+
+def template_paths() -> list[str]:
+    """Шаблоны из папки templates/ плюс пути TEMPLATE_* из config (без дублей)."""
+    paths = [
+        TEMPLATE_INVOICE_SINGLE,
+        TEMPLATE_INVOICE_MULTI,
+        TEMPLATE_INVOICE_MULTI_PRO,
+        TEMPLATE_CONTRACT,
+        TEMPLATE_CONTRACT_MULTI,
+    ]
+    if os.path.isdir(TEMPLATES_DIR):
+        for name in sorted(os.listdir(TEMPLATES_DIR)):
+            if name.lower().endswith(".docx") and not name.startswith("~$"):
+                paths.append(os.path.join(TEMPLATES_DIR, name))
+    seen = set()
+    result = []
+    for p in paths:
+        key = os.path.abspath(p)
+        if key not in seen and os.path.exists(p):
+            seen.add(key)
+            result.append(p)
+    return result
+
+
+def preload_templates() -> int:
+    """Прогрев кэша шаблонов при старте бота. Возвращает число загруженных шаблонов."""
+    loaded = 0
+    for path in template_paths():
         try:
-            new_row.cells[num_col].text = fmt_num(k)
-            copy_cell_alignment(tmpl_row.cells[num_col], new_row.cells[num_col])
-            enforce_times12_cell(new_row.cells[num_col])
+            get_compiled_template(path)
+            loaded += 1
         except Exception:
-            pass
+            logging.error(f"❌ Не удалось разобрать шаблон: {path}")
+            logging.error(traceback.format_exc())
+    return loaded
 
-        ch2, chk = tag_n(TAG_CH, 2), tag_n(TAG_CH, k)
-        pr2, prk = tag_n(TAG_PR, 2), tag_n(TAG_PR, k)
-        am2, amk = tag_n(TAG_AM, 2), tag_n(TAG_AM, k)
-        sd2, sdk = tag_n(TAG_SD, 2), tag_n(TAG_SD, k)
 
-        if col_map['channel'] is not None:
-            replace_tag_in_cell(new_row.cells[col_map['channel']], ch2, chk, tmpl_row.cells[col_map['channel']])
-        else:
-            for ci, cell in enumerate(new_row.cells):
-                if ch2 in (cell.text or ""):
-                    replace_tag_in_cell(cell, ch2, chk, tmpl_row.cells[ci])
-                    break
+def refresh_templates() -> int:
+    """
+    Один проход проверки шаблонов на диске. Возвращает число пересобранных.
 
-        if col_map['period'] is not None:
-            replace_tag_in_cell(new_row.cells[col_map['period']], pr2, prk, tmpl_row.cells[col_map['period']])
-        else:
-            for ci, cell in enumerate(new_row.cells):
-                if pr2 in (cell.text or "") or "Срок размещения" in (cell.text or ""):
-                    replace_tag_in_cell(cell, pr2, prk, tmpl_row.cells[ci if ci < len(tmpl_row.cells) else -1])
-                    break
+    Сначала сравниваются mtime и размер; если они изменились — sha256 содержимого
+    (простое «touch» шаблон не пересобирает). Новая версия собирается целиком и только
+    потом подменяет запись в кэше: рендеры, уже взявшие старую версию, доделываются
+    на ней. Если файл не разбирается (например, ещё дописывается), остаётся старая
+    версия, а попытка повторяется на следующей проверке.
+    """
+    updated = 0
+    paths = template_paths()
+    for path in paths:
+        key = os.path.abspath(path)
+        old = _TEMPLATE_CACHE.get(key)
+        version = None
+        try:
+            st = os.stat(path)
+            version = (st.st_mtime_ns, st.st_size)
+            if old is not None and (old["mtime"], old["size"]) == version:
+                continue
+            if _template_broken.get(key) == version:
+                continue
+            if old is not None:
+                with open(path, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+                if digest == old["sha256"]:
+                    old["mtime"], old["size"] = st.st_mtime_ns, st.st_size
+                    continue
+            tpl = compile_template(path)
+        except Exception:
+            if version is not None:
+                _template_broken[key] = version
+            logging.error(f"❌ Не удалось перечитать шаблон, остаётся прежняя версия: {path}")
+            logging.error(traceback.format_exc())
+            continue
+        _template_broken.pop(key, None)
+        _TEMPLATE_CACHE[key] = tpl
+        updated += 1
+        logging.info("Шаблон %s: %s", "обновлён" if old is not None else "загружен", path)
 
-        if col_map['amount'] is not None:
-            replace_tag_in_cell(new_row.cells[col_map['amount']], am2, amk, tmpl_row.cells[col_map['amount']])
-        else:
-            for ci, cell in enumerate(new_row.cells):
-                if am2 in (cell.text or ""):
-                    replace_tag_in_cell(cell, am2, amk, tmpl_row.cells[ci])
-                    break
+    alive = {os.path.abspath(p) for p in paths}
+    for key in [k for k in _TEMPLATE_CACHE if k not in alive]:
+        _TEMPLATE_CACHE.pop(key, None)
+        logging.info("Шаблон удалён с диска, убран из кэша: %s", key)
+    return updated
 
-        if col_map['sdate'] is not None:
-            replace_tag_in_cell(new_row.cells[col_map['sdate']], sd2, sdk, tmpl_row.cells[col_map['sdate']])
-        else:
-            for ci, cell in enumerate(new_row.cells):
-                if sd2 in (cell.text or ""):
-                    replace_tag_in_cell(cell, sd2, sdk, tmpl_row.cells[ci])
-                    break
 
-        for ci, cell in enumerate(new_row.cells):
-            enforce_times12_cell(cell)
-            if ci < len(tmpl_row.cells):
-                copy_cell_alignment(tmpl_row.cells[ci], cell)
+def _template_watch_loop() -> None:
+    while True:
+        time.sleep(TEMPLATE_RELOAD_INTERVAL)
+        try:
+            refresh_templates()
+        except Exception:
+            logging.error(traceback.format_exc())
 
 
-def render_docx_with_dynamic_rows(template_path: str, output_path: str, replacements: dict, items: list | None,
-                                  enable_dynamic: bool) -> bool:
+def start_template_watcher() -> None:
+    """
+    Фоновая проверка шаблонов (поток-демон) в текущем процессе.
+    У каждого процесса пула рендеринга свой кэш, поэтому наблюдатель запускается
+    в каждом из них; повторный вызов в том же процессе ничего не делает.
+    """
+    global _template_watcher_pid
+    if not TEMPLATE_CACHE_ENABLED or TEMPLATE_RELOAD_INTERVAL <= 0 or _template_watcher_pid == os.getpid():
+        return
+    _template_watcher_pid = os.getpid()
+    threading.Thread(target=_template_watch_loop, name="template-watcher", daemon=True).start()
+
+
+def init_render_worker() -> None:
+    """Инициализация процесса пула: прогрев кэша шаблонов и наблюдение за их изменениями."""
+    preload_templates()
+    start_template_watcher()
+
+
+# Этапы рендера: загрузка шаблона из кэша, копия документа, строки пунктов 3..N,
+# подстановка в тело, в колонтитулы, выравнивание шрифта, вставка строк, сохранение
+RENDER_STAGES = ("template", "clone", "rows", "body", "headers", "fonts", "splice", "save")
+
+
+def _stage_done(stages: dict | None, name: str, started: float) -> float:
+    """Записывает длительность этапа рендера (мс) в stages и возвращает текущее время."""
+    now = time.perf_counter()
+    if stages is not None:
+        stages[name] = round((now - started) * 1000, 2)
+    return now
+
+
+def render_docx_with_dynamic_rows(template_path: str, output_path, replacements: dict, items: list | None,
+                                  enable_dynamic: bool, stages: dict | None = None) -> bool:
+    """
+    output_path — путь к файлу или файловый объект (например io.BytesIO).
+    stages — если передан, в него пишется длительность этапов в мс (RENDER_STAGES).
+    """
     try:
         if not os.path.exists(template_path):
             logging.error(f"❌ Шаблон не найден: {template_path}")
             return False
-        doc = Document(template_path)
-        if enable_dynamic and items and len(items) > 2:
-            add_dynamic_rows_for_items(doc, items)
+        t = time.perf_counter()
+        tpl = get_compiled_template(template_path)
+        t = _stage_done(stages, "template", t)
+        doc = clone_template_document(tpl)
+        t = _stage_done(stages, "clone", t)
 
-        body_map = dict(replacements)
+        body_map = _compile_mapping(replacements)
         header_map = dict(replacements)
         if "{{CONTRACT_NUMBER}}" in replacements:
             header_map["<<CN>>"] = replacements["{{CONTRACT_NUMBER}}"]
@@ -687,23 +2383,400 @@ def render_docx_with_dynamic_rows(template_path: str, output_path: str, replacem
         if "{{DATE}}" in replacements:
             header_map["<<DT>>"] = replacements["{{DATE}}"]
 
+        # Строки пунктов 3..N собираются из нетронутой строки-образца уже со значениями
+        # и вставляются после подстановки и выравнивания шрифта — эти проходы их не видят.
+        extra_rows = None
+        if enable_dynamic and items and len(items) > 2:
+            extra_rows = build_dynamic_rows(doc, items, layout=tpl["invoice_layout"], mapping=body_map,
+                                            style_row=not tpl["styles_normalized"])
+        t = _stage_done(stages, "rows", t)
+
         _replace_in_block(doc, body_map)
+        t = _stage_done(stages, "body", t)
         for section in doc.sections:
             _replace_in_header_footer(section.header, header_map)
             _replace_in_header_footer(section.footer, header_map)
+        t = _stage_done(stages, "headers", t)
 
-        for tbl in doc.tables:
-            for row in tbl.rows:
-                for cell in row.cells:
-                    enforce_times12_cell(cell)
+        if not tpl["styles_normalized"]:
+            normalize_table_fonts(doc)
+        t = _stage_done(stages, "fonts", t)
+        insert_dynamic_rows(extra_rows)
+        t = _stage_done(stages, "splice", t)
 
         doc.save(output_path)
+        _stage_done(stages, "save", t)
         return True
     except Exception:
         logging.error("❌ Ошибка подстановки/динамики в DOCX")
         logging.error(traceback.format_exc())
         return False
 
+
+def render_docx_bytes(template_path: str, replacements: dict, items: list | None,
+                      enable_dynamic: bool, stages: dict | None = None) -> bytes | None:
+    """Рендер в память: содержимое DOCX или None при ошибке."""
+    buf = io.BytesIO()
+    if not render_docx_with_dynamic_rows(template_path, buf, replacements, items, enable_dynamic, stages):
+        return None
+    return buf.getvalue()
+
+
+# ── Архив сформированных документов ──
+# Копия документа пишется в OUTPUT_DIR в фоне, уже после рендера: отправка в чат
+# её не ждёт. Архив нужен поиску по ИНН — при ARCHIVE_DOCUMENTS = False он пуст.
+_archive_tasks: set = set()
+
+
+def _write_archive_file(path: str, data: bytes) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+async def _archive_document(path: str, data: bytes) -> None:
+    try:
+        await asyncio.to_thread(_write_archive_file, path, data)
+    except Exception:
+        logging.error(f"❌ Не удалось сохранить документ в архив: {path}")
+        logging.error(traceback.format_exc())
+
+
+def archive_document(path: str, data: bytes) -> None:
+    """Ставит запись документа в архив в фон (если архив включён)."""
+    if not ARCHIVE_DOCUMENTS:
+        return
+    task = asyncio.create_task(_archive_document(path, data))
+    _archive_tasks.add(task)
+    task.add_done_callback(_archive_tasks.discard)
+
+
+async def flush_archive() -> None:
+    """Дожидается фоновой записи архива (при остановке бота)."""
+    if _archive_tasks:
+        await asyncio.gather(*list(_archive_tasks), return_exceptions=True)
+
+
+# ── Пул рендеринга DOCX ──
+class RenderQueueFull(Exception):
+    """Очередь рендеринга заполнена — новый документ сейчас не принимаем."""
+
+
+def _render_job(template_path: str, replacements: dict, items: list | None,
+                enable_dynamic: bool) -> tuple[bytes | None, float, dict]:
+    """Выполняется в процессе пула: содержимое документа, время работы в мс и этапы."""
+    started = time.perf_counter()
+    stages = {}
+    data = render_docx_bytes(template_path, replacements, items, enable_dynamic, stages)
+    return data, (time.perf_counter() - started) * 1000, stages
+
+
+class LatencyHistogram:
+    """
+    Гистограмма задержек с фиксированными логарифмическими корзинами (шаг ×1.2 от 0.5 мс):
+    память не растёт с числом замеров, перцентиль точен до ширины корзины (~20%).
+    """
+
+    BOUNDS = [0.5 * 1.2 ** k for k in range(80)]  # до ~1.1 млн мс
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms: float) -> None:
+        self.counts[bisect_left(self.BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        need = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= need:
+                return min(self.BOUNDS[i] if i < len(self.BOUNDS) else self.max, self.max)
+        return self.max
+
+
+ITEMS_BUCKETS = ((1, "1"), (2, "2"), (10, "3–10"), (50, "11–50"), (200, "51–200"), (None, "201+"))
+
+
+def items_bucket(n: int) -> str:
+    for hi, label in ITEMS_BUCKETS:
+        if hi is None or n <= hi:
+            return label
+
+
+class RenderStats:
+    """
+    Гистограммы задержек рендера с момента запуска бота по ключу
+    (шаблон, корзина числа пунктов): этапы RENDER_STAGES, render, wait, total.
+    """
+
+    def __init__(self):
+        self._hist: dict[tuple[str, str], dict[str, LatencyHistogram]] = {}
+
+    def observe(self, timing: dict) -> None:
+        key = (timing["template"], items_bucket(timing["items"]))
+        per_stage = self._hist.setdefault(key, {})
+        values = dict(timing.get("stages") or {})
+        values.update(render=timing["render_ms"], wait=timing["wait_ms"], total=timing["total_ms"])
+        for stage, ms in values.items():
+            per_stage.setdefault(stage, LatencyHistogram()).add(ms)
+
+    def report(self, template_filter: str = "") -> str:
+        """Текст для админа: p50/p95/p99 по ключам; с фильтром по шаблону — и по этапам."""
+        flt = template_filter.strip().lower()
+        order = {label: i for i, (_hi, label) in enumerate(ITEMS_BUCKETS)}
+        keys = sorted((k for k in self._hist if flt in k[0].lower()), key=lambda k: (k[0], order[k[1]]))
+        if not keys:
+            return "Рендеров с запуска бота ещё не было." if not flt else f"Нет данных по шаблону «{template_filter}»."
+
+        def _fmt(h: LatencyHistogram) -> str:
+            return (f"p50 {h.percentile(0.5):.0f} · p95 {h.percentile(0.95):.0f} · "
+                    f"p99 {h.percentile(0.99):.0f} · max {h.max:.0f} мс")
+
+        lines = ["📈 Рендер документов с запуска бота"]
+        for key in keys:
+            per_stage = self._hist[key]
+            total = per_stage["total"]
+            lines.append("")
+            lines.append(f"{key[0]} · пунктов {key[1]} · n={total.count}")
+            lines.append(f"  всего: {_fmt(total)}")
+            lines.append(f"  ожидание: {_fmt(per_stage['wait'])}")
+            if flt:
+                for stage in RENDER_STAGES:
+                    if stage in per_stage:
+                        lines.append(f"  {stage}: {_fmt(per_stage[stage])}")
+            else:
+                slowest = max((s for s in RENDER_STAGES if s in per_stage),
+                              key=lambda s: per_stage[s].percentile(0.95), default=None)
+                if slowest:
+                    lines.append(f"  дольше всего: {slowest} — {_fmt(per_stage[slowest])}")
+        if not flt:
+            lines.append("")
+            lines.append("Этапы по шаблону: /render_stats <часть имени шаблона>")
+        return "\n".join(lines)
+
+
+render_stats = RenderStats()
+
+
+class RenderService:
+    """
+    Рендер DOCX вне event loop бота.
+
+    - workers > 0  — пул процессов (каждый со своим кэшем шаблонов); процессы
+      порождаются через forkserver, а не fork: к первому рендеру в боте уже
+      работают потоки, и форк посреди чужой блокировки (например, logging) вешал бы дочерний процесс;
+      workers == 0 — рендер в одном отдельном потоке текущего процесса;
+    - одновременно принимается не больше workers + queue_limit задач,
+      сверх этого render() сразу бросает RenderQueueFull; задача, не уложившаяся
+      в timeout, занимает место, пока действительно не завершится;
+    - тайминги последних задач лежат в jobs.
+    """
+
+    def __init__(self, workers: int, queue_limit: int, timeout: float):
+        self.workers = max(0, int(workers))
+        self.queue_limit = max(0, int(queue_limit))
+        self.timeout = timeout
+        self.jobs = deque(maxlen=200)
+        self._executor = None
+        self._pending = 0
+
+    @property
+    def capacity(self) -> int:
+        return max(1, self.workers) + self.queue_limit
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def start(self) -> None:
+        if self._executor is not None:
+            return
+        if self.workers:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context, initializer=init_render_worker
+            )
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+
+    def _release(self, loop: asyncio.AbstractEventLoop) -> None:
+        # Колбэк завершения задачи в исполнителе (вызывается из его потока)
+        def release():
+            self._pending -= 1
+        try:
+            loop.call_soon_threadsafe(release)
+        except RuntimeError:
+            pass  # цикл событий уже закрыт — бот останавливается
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def render(self, template_path: str, replacements: dict, items: list | None,
+                     enable_dynamic: bool) -> tuple[bytes | None, dict]:
+        """
+        Асинхронный аналог render_docx_bytes.
+        Возвращает (data, timing): data — содержимое DOCX или None при ошибке,
+        timing — словарь с wait_ms / render_ms / total_ms.
+        """
+        if self._pending >= self.capacity:
+            raise RenderQueueFull(f"в очереди уже {self._pending} документов")
+
+        loop = asyncio.get_running_loop()
+        self._pending += 1
+        queued_at = time.perf_counter()
+        timing = {
+            "template": os.path.basename(template_path),
+            "items": len(items or []),
+            "queue_depth": self._pending,
+        }
+        data, render_ms, stages = None, 0.0, {}
+        job = None
+        try:
+            self.start()
+            job = self._executor.submit(_render_job, template_path, replacements, items, enable_dynamic)
+            # Место в очереди освобождается, когда задача завершилась на самом деле,
+            # а не когда её перестали ждать: зависший рендер продолжает занимать воркер
+            job.add_done_callback(lambda _job: self._release(loop))
+            data, render_ms, stages = await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"❌ Рендер не уложился в {self.timeout} с: {template_path}")
+        except BrokenProcessPool:
+            logging.error("❌ Пул рендеринга упал, пересоздаю")
+            self.shutdown()
+        finally:
+            if job is None:
+                self._pending -= 1
+
+        total_ms = (time.perf_counter() - queued_at) * 1000
+        timing.update(
+            ok=data is not None,
+            render_ms=round(render_ms, 1),
+            wait_ms=round(max(0.0, total_ms - render_ms), 1),
+            total_ms=round(total_ms, 1),
+            stages=stages,
+        )
+        self.jobs.append(timing)
+        render_stats.observe(timing)
+        stages_text = ", ".join(f"{k} {v:.0f}" for k, v in stages.items())
+        log = logging.warning if total_ms >= RENDER_SLOW_MS else logging.info
+        log(
+            "Рендер %s (%s пунктов): %.0f мс, из них ожидание %.0f мс [%s]",
+            timing["template"], timing["items"], timing["total_ms"], timing["wait_ms"], stages_text,
+        )
+        return data, timing
+
+
+render_service = RenderService(RENDER_WORKERS, RENDER_QUEUE_LIMIT, RENDER_TIMEOUT)
+
+
+# ── Защита от повторного «Сформировать» ──
+# Двойное нажатие или повтор апдейта от Telegram не должны рендерить документ
+# второй раз и тратить номер. Ключ — хэш данных формы и чата. Пока документ
+# формируется, такие же нажатия игнорируются. После отправки обработчик очищает
+# форму, поэтому повтор приходит уже с пустыми данными: его узнаём по последней
+# отправке этого чата (_last_submits) и в течение SUBMIT_DEDUP_WINDOW секунд
+# отдаём уже отправленный файл по file_id — без рендера и загрузки. Заново
+# заполненная форма с теми же данными — новый документ.
+_recent_submits: dict[str, dict] = {}
+_last_submits: dict[tuple[str, int], str] = {}  # (вид документа, чат) → ключ последней отправки
+
+
+def submit_key(kind: str, chat_id: int, payload: dict) -> str:
+    raw = json.dumps([kind, chat_id, payload], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _prune_submits() -> None:
+    deadline = time.monotonic() - SUBMIT_DEDUP_WINDOW
+    for key in [k for k, e in _recent_submits.items() if e["at"] < deadline]:
+        del _recent_submits[key]
+    for chat_key in [k for k, key in _last_submits.items() if key not in _recent_submits]:
+        del _last_submits[chat_key]
+
+
+async def answer_duplicate_submit(key: str, bot: Bot, chat_id: int, reply_markup=None, resend: bool = True) -> bool:
+    """
+    True — это повтор уже принятой отправки (на него ответили или его можно молча пропустить).
+    False — отправка новая; ключ занят до вызова finish_submit.
+    resend=False — завершённая отправка с тем же ключом не повтор (форму заполнили заново).
+    """
+    if SUBMIT_DEDUP_WINDOW <= 0:
+        return False
+    _prune_submits()
+    entry = _recent_submits.get(key)
+    if entry is None or (entry["done"] and not resend):
+        _recent_submits[key] = {"at": time.monotonic(), "done": False}
+        return False
+    if not entry["done"]:
+        logging.info("Повторная отправка во время формирования — пропускаю (chat=%s)", chat_id)
+        return True
+    if entry.get("file_id"):
+        await bot.send_document(
+            chat_id=chat_id,
+            document=entry["file_id"],
+            caption=entry.get("caption"),
+            caption_entities=entry.get("caption_entities"),
+            parse_mode=None,
+            reply_markup=reply_markup,
+        )
+    else:
+        await bot.send_message(chat_id, "ℹ️ Этот документ уже сформирован — он выше в чате.", parse_mode=None)
+    return True
+
+
+def finish_submit(key: str, sent: Message | bool | None) -> None:
+    """
+    Закрывает отправку: sent — отправленное сообщение с документом (запоминаем file_id),
+    True — обработано без документа, None/False — не получилось (повтор будет обработан заново).
+    """
+    if SUBMIT_DEDUP_WINDOW <= 0:
+        return
+    if not sent:
+        _recent_submits.pop(key, None)
+        return
+    entry = {"at": time.monotonic(), "done": True}
+    document = getattr(sent, "document", None)
+    if document is not None:
+        entry.update(file_id=document.file_id, caption=sent.caption, caption_entities=sent.caption_entities)
+    _recent_submits[key] = entry
+
+
+async def submit_once(kind: str, message: Message, state: FSMContext, bot: Bot, handler, reply_markup=None):
+    """Вызывает handler(message, state, bot) не чаще одного раза на одни и те же данные формы."""
+    data = await state.get_data()
+    chat_key = (kind, message.chat.id)
+    if not data:
+        # Форма уже очищена: повтор нажатия после отправки (или форму не заполняли)
+        _prune_submits()
+        key = _last_submits.get(chat_key)
+        if key is not None and SUBMIT_DEDUP_WINDOW > 0:
+            await answer_duplicate_submit(key, bot, message.chat.id, reply_markup)
+            return
+        await handler(message, state, bot)
+        return
+    key = submit_key(kind, message.chat.id, data)
+    if await answer_duplicate_submit(key, bot, message.chat.id, reply_markup, resend=False):
+        return
+    _last_submits[chat_key] = key
+    sent = None
+    try:
+        sent = await handler(message, state, bot)
+    finally:
+        finish_submit(key, sent)
+
 # ================== ТЕКСТЫ ====================
 
 INVOICE_PROMPTS = {
@@ -950,7 +3023,7 @@ async def cmd_start(message: Message, state: FSMContext):
     # Отслеживаем уникального пользователя
     user_id = message.from_user.id if message.from_user else None
     if user_id:
-        is_new = track_unique_user(user_id)
+        is_new = await track_unique_user(user_id)
         if is_new:
             logging.info(f"Новый уникальный пользователь: {user_id}")
     
@@ -1018,7 +3091,7 @@ async def cancel_reset_sequence(message: Message, state: FSMContext):
 async def reset_sequence_cmd(message: Message, state: FSMContext):
     now = now_tz()
     uid = message.from_user.id if message.from_user else 0
-    prev = reset_user_daily_sequence(now, uid)
+    prev = await reset_user_daily_sequence(now, uid)
     await state.clear()
     await message.answer(
         f"🔄 Последовательность на сегодня сброшена.\nБыло: {prev:02d} → Следующий номер будет: …-01",
@@ -1140,11 +3213,73 @@ def build_invoice_caption_wrap(invoice_number, invoice_date, org_name, inn, posi
     )
 
 
+def build_invoice_replacements(data: dict, items: list, invoice_number: str,
+                               invoice_date: str) -> tuple[dict, int, str]:
+    """
+    Метки счёта по данным формы (customer_name, customer_inn, manual_pnc_*) и пунктам.
+    Возвращает (replacements, total_sum, first_service_date).
+    """
+    manual_pnc_text = (data.get("manual_pnc_text") or "").strip()
+    manual_pnc_amount_raw = (data.get("manual_pnc_amount") or "").strip()
+
+    # Сумма по стандартным пунктам
+    total_sum = sum(int(re.sub(r"[^\d]", "", i.get("amount") or "0") or 0) for i in items)
+
+    # Плюсуем ручной пункт (если есть)
+    if manual_pnc_amount_raw:
+        total_sum += int(re.sub(r"[^\d]", "", manual_pnc_amount_raw) or 0)
+
+    total_sum_words = number_to_words_ru(total_sum)
+    if total_sum_words:
+        total_sum_words = total_sum_words[:1].upper() + total_sum_words[1:]
+
+    first_service_date = (normalize_date_for_service_date(items[0].get("period", "")) if items else None) or invoice_date
+
+    repl = {
+        "{{INVOICE_NUMBER}}": invoice_number,
+        "{{DATE}}": invoice_date,
+        "{{CUSTOMER_NAME}}": data.get("customer_name", ""),
+        "{{CUSTOMER_INN}}": data.get("customer_inn", ""),
+        "{{TOTAL_SUM}}": fmt_amount(total_sum),
+        "{{TOTAL_SUM_WORDS}}": total_sum_words,
+        "{{AMOUNT_WORDS}}": total_sum_words,
+        "{{SERVICE_DATE}}": first_service_date,
+        "<<IN>>": invoice_number,
+        "<<DT>>": invoice_date,
+    }
+
+    # Ручной пункт: текст и сумма в отдельные метки шаблона
+    if manual_pnc_text:
+        repl["{{PNC}}"] = manual_pnc_text
+    if manual_pnc_amount_raw:
+        repl["{{AMOUNT_PNC}}"] = manual_pnc_amount_raw
+
+    for idx, item in enumerate(items, start=1):
+        repl[tag_n("{{PLACEMENT_CHANNEL}}", idx)] = item.get("channel", "")
+        repl[tag_n("{{SERVICE_PERIOD}}", idx)] = item.get("period", "")
+        repl[tag_n("{{AMOUNT}}", idx)] = item.get("amount", "")
+        sd_i = normalize_date_for_service_date(item.get("period", "")) or first_service_date
+        repl[tag_n("{{SERVICE_DATE}}", idx)] = sd_i
+
+    return repl, total_sum, first_service_date
+
+
+def invoice_file_name(customer_name: str, invoice_number: str) -> str:
+    safe_name = (
+        (customer_name or "")
+        .replace('"', "")
+        .replace("«", "")
+        .replace("»", "")
+        .replace("/", "_")
+        .replace("\\", "_")
+        .replace(" ", "_")
+    )[:50]
+    return f"Счет-оферта_{safe_name}_{invoice_number}.docx"
+
+
 async def form_invoice(message: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
     items = data.get("items", [])
-    manual_pnc_text = (data.get("manual_pnc_text") or "").strip()
-    manual_pnc_amount_raw = (data.get("manual_pnc_amount") or "").strip()
 
     # Без хотя бы одного стандартного пункта счёт не формируем
     if not items:
@@ -1152,9 +3287,15 @@ async def form_invoice(message: Message, state: FSMContext, bot: Bot):
         await state.set_state(InvoiceForm.item_channel)
         return
 
+    if len(items) > MAX_ITEMS_FOR_TEMPLATE:
+        await message.answer(
+            f"❌ Слишком много пунктов: {len(items)}. В одном документе — не больше {MAX_ITEMS_FOR_TEMPLATE}."
+        )
+        return
+
     now = now_tz()
     user_id = message.from_user.id if message.from_user else 0
-    invoice_number = generate_number(now, user_id)
+    invoice_number = await generate_number(now, user_id)
     invoice_date = generate_date(now)
 
     use_multi = bool(data.get("used_add_item")) or bool(data.get("use_manual_pro_template"))
@@ -1187,95 +3328,437 @@ async def form_invoice(message: Message, state: FSMContext, bot: Bot):
             await message.answer("❌ Не найден ни один шаблон счёта.")
             return
 
-    # Сумма по стандартным пунктам
-    total_sum = sum(int(re.sub(r"[^\d]", "", i.get("amount") or "0") or 0) for i in items)
+    repl, total_sum, first_service_date = build_invoice_replacements(data, items, invoice_number, invoice_date)
+    output_path = os.path.join(OUTPUT_DIR, invoice_file_name(data.get("customer_name", ""), invoice_number))
 
-    # Плюсуем ручной пункт (если есть)
-    manual_pnc_amount_int = 0
-    if manual_pnc_amount_raw:
-        manual_pnc_amount_int = int(re.sub(r"[^\d]", "", manual_pnc_amount_raw) or 0)
-        total_sum += manual_pnc_amount_int
+    await message.answer("⏳ Формирую счёт…")
+    try:
+        doc_bytes, _timing = await render_service.render(
+            template_path,
+            replacements=repl,
+            items=items,
+            enable_dynamic=use_multi,
+        )
+    except RenderQueueFull:
+        await message.answer("⏳ Сейчас формируется слишком много документов. Попробуйте через минуту.")
+        return
+    if doc_bytes is None:
+        await message.answer("❌ Не удалось создать счёт. Проверь шаблон и теги.")
+        return
+    archive_document(output_path, doc_bytes)
 
-    total_sum_words = number_to_words_ru(total_sum)
-    if total_sum_words:
-        total_sum_words = total_sum_words[:1].upper() + total_sum_words[1:]
+    period_main = items[0].get("period", "") if items else ""
+    caption = build_unified_caption(
+        doc_kind="invoice",
+        number=invoice_number,
+        date_str=invoice_date,
+        customer_name=data.get("customer_name", "—"),
+        inn=data.get("customer_inn", "—"),
+        ogrn=data.get("customer_ogrn", ""),
+        service_start_date=first_service_date,
+        period_text=period_main,
+        services_count=len(items),
+        total_sum_digits=total_sum,
+    )
 
-    first_service_date = (normalize_date_for_service_date(items[0].get("period", "")) if items else None) or invoice_date
+    sent = await bot.send_document(
+        chat_id=message.chat.id,
+        document=BufferedInputFile(doc_bytes, filename=os.path.basename(output_path)),
+        caption=caption,
+        reply_markup=inline_new_invoice(),
+    )
+    await state.clear()
+    return sent
 
-    repl = {
-        "{{INVOICE_NUMBER}}": invoice_number,
-        "{{DATE}}": invoice_date,
-        "{{CUSTOMER_NAME}}": data.get("customer_name", ""),
-        "{{CUSTOMER_INN}}": data.get("customer_inn", ""),
-        "{{TOTAL_SUM}}": fmt_amount(total_sum),
-        "{{TOTAL_SUM_WORDS}}": total_sum_words,
-        "{{AMOUNT_WORDS}}": total_sum_words,
-        "{{SERVICE_DATE}}": first_service_date,
-        "<<IN>>": invoice_number,
-        "<<DT>>": invoice_date,
-    }
 
-    # Ручной пункт: текст и сумма в отдельные метки шаблона
-    if manual_pnc_text:
-        repl["{{PNC}}"] = manual_pnc_text
-    if manual_pnc_amount_raw:
-        repl["{{AMOUNT_PNC}}"] = manual_pnc_amount_raw
+async def form_invoice_entry(message: Message, state: FSMContext, bot: Bot):
+    await submit_once("invoice", message, state, bot, form_invoice, inline_new_invoice())
+
+
+# ——— СЧЕТА ИЗ ТАБЛИЦЫ (CSV/XLSX) ———
+# Одна строка таблицы — один пункт счёта. Строки с одинаковым номером в колонке
+# «Счёт» (а без неё — с одинаковыми заказчиком и ИНН) собираются в один счёт.
+try:
+    import openpyxl as _openpyxl_bulk
+except ImportError:
+    _openpyxl_bulk = None
+
+BULK_COLUMNS = {
+    "invoice": ("invoice", "счет", "номер счета", "№ счета", "группа"),
+    "customer_name": ("customer_name", "заказчик", "наименование", "организация", "контрагент"),
+    "customer_inn": ("customer_inn", "inn", "инн"),
+    "channel": ("channel", "канал", "площадка"),
+    "period": ("period", "период", "дата"),
+    "amount": ("amount", "сумма", "цена", "стоимость"),
+}
+BULK_TITLES = {"customer_name": "Заказчик", "customer_inn": "ИНН", "channel": "Канал",
+               "period": "Период", "amount": "Сумма"}
+
+BULK_PROMPT = (
+    "📦 *Счета из таблицы*\n\n"
+    "Пришлите файл CSV или XLSX. Первая строка — заголовки:\n"
+    "`Заказчик; ИНН; Канал; Период; Сумма` и, по желанию, `Счёт`.\n\n"
+    "Каждая строка — один пункт. Строки с одинаковым значением «Счёт» "
+    "(или, если колонки нет, с одинаковыми заказчиком и ИНН) попадут в один счёт.\n"
+    "В ответ пришлю ZIP со счетами и файл с ошибками, если они будут."
+)
+
+
+def _bulk_header_key(title) -> str | None:
+    t = re.sub(r"\s+", " ", str(title or "").strip().lower().replace("ё", "е"))
+    for key, aliases in BULK_COLUMNS.items():
+        if t in aliases:
+            return key
+    return None
+
+
+def _bulk_cell_text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.strftime("%d.%m.%Y")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def _read_bulk_rows(content: bytes, filename: str) -> list[list[str]]:
+    """Строки таблицы (включая заголовок) из CSV или XLSX."""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        if _openpyxl_bulk is None:
+            raise ValueError("Для XLSX нужен openpyxl: pip install openpyxl. Или пришлите CSV.")
+        wb = _openpyxl_bulk.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+        try:
+            return [[_bulk_cell_text(v) for v in row] for row in wb.active.iter_rows(values_only=True)]
+        finally:
+            wb.close()
+
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            text = content.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError("Не удалось прочитать CSV: сохраните его в UTF-8.")
+    try:
+        delimiter = csv.Sniffer().sniff(text[:4096], delimiters=";,\t").delimiter
+    except csv.Error:
+        delimiter = ";"
+    return [[c.strip() for c in row] for row in csv.reader(io.StringIO(text), delimiter=delimiter)]
+
+
+def parse_bulk_invoices(rows: list[list[str]]) -> tuple[list[dict], list[tuple[str, str, str]]]:
+    """
+    Разбирает и проверяет таблицу. Возвращает (invoices, errors):
+    - invoices — [{"customer_name", "customer_inn", "items", "rows"}] в порядке появления;
+    - errors   — [(строки, заказчик, описание ошибки)].
+    Счёт, в котором есть хотя бы одна ошибочная строка, не формируется целиком.
+    """
+    if not rows:
+        raise ValueError("Файл пустой.")
+    columns = {}
+    for idx, title in enumerate(rows[0]):
+        key = _bulk_header_key(title)
+        if key and key not in columns:
+            columns[key] = idx
+    missing = [k for k in BULK_TITLES if k not in columns]
+    if missing:
+        names = ", ".join(BULK_TITLES[k] for k in missing)
+        raise ValueError(f"В первой строке не найдены колонки: {names}.")
+
+    groups: dict = {}
+    errors = []
+    for row_no, row in enumerate(rows[1:], start=2):
+        if not any(row):
+            continue
+
+        def col(key):
+            i = columns.get(key)
+            return row[i].strip() if i is not None and i < len(row) else ""
+
+        name, inn = col("customer_name"), re.sub(r"\s+", "", col("customer_inn"))
+        key = col("invoice") or (name.lower(), inn)
+        group = groups.setdefault(key, {"customer_name": name, "customer_inn": inn,
+                                        "items": [], "rows": [], "bad_rows": []})
+        group["rows"].append(row_no)
+
+        problems = []
+        if not name:
+            problems.append("не указан заказчик")
+        if not re.fullmatch(r"\d{10}|\d{12}", inn):
+            problems.append("ИНН должен состоять из 10 или 12 цифр")
+        if (name, inn) != (group["customer_name"], group["customer_inn"]):
+            problems.append("заказчик/ИНН отличаются от первой строки этого счёта")
+        if not col("channel"):
+            problems.append("не указан канал")
+        if not col("period"):
+            problems.append("не указан период")
+        # Суммы — в целых рублях, как и при вводе счёта вручную
+        m = re.fullmatch(r"(\d[\d\s]*)(?:[.,](\d+))?", col("amount").replace("\u00a0", " "))
+        amount = re.sub(r"\s", "", m.group(1)) if m else ""
+        if not m or int(m.group(2) or 0) or not int(amount):
+            problems.append("сумма должна быть целым числом рублей больше нуля")
+        if problems:
+            group["bad_rows"].append(row_no)
+            errors.append((str(row_no), name, "; ".join(problems)))
+            continue
+        group["items"].append({"channel": col("channel"), "period": col("period"), "amount": amount})
+
+    invoices = []
+    for group in groups.values():
+        rows_text = ", ".join(str(r) for r in group["rows"])
+        if group["bad_rows"]:
+            if len(group["rows"]) > 1:
+                errors.append((rows_text, group["customer_name"], "счёт не сформирован из-за ошибок в строках выше"))
+            continue
+        if len(group["items"]) > MAX_ITEMS_FOR_TEMPLATE:
+            errors.append((rows_text, group["customer_name"],
+                           f"больше {MAX_ITEMS_FOR_TEMPLATE} пунктов в одном счёте"))
+            continue
+        invoices.append(group)
+    if len(invoices) > BULK_MAX_INVOICES:
+        raise ValueError(f"Слишком много счетов: {len(invoices)}. За раз — не больше {BULK_MAX_INVOICES}.")
+    return invoices, errors
+
+
+def _bulk_error_report(errors: list) -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=";")
+    writer.writerow(["Строки", "Заказчик", "Ошибка"])
+    writer.writerows(errors)
+    return buf.getvalue().encode("utf-8-sig")
+
+
+def _bulk_invoice_template(multi: bool) -> str | None:
+    primary, other = (TEMPLATE_INVOICE_MULTI, TEMPLATE_INVOICE_SINGLE) if multi else \
+        (TEMPLATE_INVOICE_SINGLE, TEMPLATE_INVOICE_MULTI)
+    for path in (primary, other):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class _BulkZip:
+    """
+    ZIP со счетами, который пишется на диск по мере готовности документов.
+    Как только следующий документ не влезает в BULK_ZIP_PART_LIMIT (лимит Telegram
+    на файлы от бота — 50 МБ), текущая часть отправляется и начинается новая.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, stamp: str):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.stamp = stamp
+        self.parts_sent = 0
+        self._zip = None
+        self._path = None
+        self._size = 0
+
+    def _open(self) -> None:
+        fd, self._path = tempfile.mkstemp(suffix=".zip")
+        os.close(fd)
+        self._zip = zipfile.ZipFile(self._path, "w", zipfile.ZIP_STORED)
+        self._size = 0
+
+    async def add(self, name: str, data: bytes) -> None:
+        if self._zip is not None and self._size and self._size + len(data) > BULK_ZIP_PART_LIMIT:
+            await self.flush()
+        if self._zip is None:
+            self._open()
+        await asyncio.to_thread(self._zip.writestr, name, data)
+        self._size += len(data)
+
+    async def flush(self, caption: str | None = None) -> None:
+        if self._zip is None:
+            return
+        self._zip.close()
+        self.parts_sent += 1
+        try:
+            await self.bot.send_document(
+                chat_id=self.chat_id,
+                document=FSInputFile(self._path, filename=f"Счета_{self.stamp}_{self.parts_sent}.zip"),
+                caption=caption,
+                parse_mode=None,
+            )
+        finally:
+            os.remove(self._path)
+            self._zip = None
+
+    def discard(self) -> None:
+        if self._zip is not None:
+            self._zip.close()
+            os.remove(self._path)
+            self._zip = None
+
+
+async def _render_bulk_invoice(invoice: dict) -> bytes | None:
+    """Рендер одного счёта через общий пул; при заполненной очереди ждём и повторяем."""
+    while True:
+        try:
+            doc_bytes, _timing = await render_service.render(
+                invoice["template_path"],
+                replacements=invoice["replacements"],
+                items=invoice["items"],
+                enable_dynamic=invoice["multi"],
+            )
+            return doc_bytes
+        except RenderQueueFull:
+            await asyncio.sleep(1)
+
+
+async def _bulk_status(status: Message, text: str) -> None:
+    try:
+        await status.edit_text(text, parse_mode=None)
+    except Exception:
+        pass
+
+
+async def run_bulk_invoices(bot: Bot, chat_id: int, user_id: int, invoices: list, errors: list,
+                            status: Message) -> None:
+    """
+    Рендерит счета параллельно через render_service, складывает в ZIP по мере
+    готовности и обновляет одно статусное сообщение. Номер (generate_number) счёт
+    получает, когда доходит до рендера; номера счетов, которые не удалось
+    сформировать, перечисляются в ошибках и в итоговом сообщении.
+    """
+    now = now_tz()
+    invoice_date = generate_date(now)
+    for invoice in invoices:
+        invoice["multi"] = len(invoice["items"]) > 1
+        invoice["template_path"] = _bulk_invoice_template(invoice["multi"])
+        invoice["number"] = None
+
+    total = len(invoices)
+    sem = asyncio.Semaphore(max(1, render_service.workers))
+
+    async def _one(invoice):
+        async with sem:
+            if not invoice["template_path"]:
+                return invoice, None
+            invoice["number"] = await generate_number(now, user_id)
+            invoice["replacements"], invoice["total_sum"], _ = build_invoice_replacements(
+                invoice, invoice["items"], invoice["number"], invoice_date)
+            invoice["file_name"] = invoice_file_name(invoice["customer_name"], invoice["number"])
+            try:
+                return invoice, await _render_bulk_invoice(invoice)
+            except Exception:
+                logging.error("❌ Счёт № %s из таблицы не сформирован", invoice["number"])
+                logging.error(traceback.format_exc())
+                return invoice, None
+
+    archive = _BulkZip(bot, chat_id, now.strftime("%d-%m-%Y"))
+    done = rendered = 0
+    skipped_numbers = []
+    last_update = time.monotonic()
+    tasks = [asyncio.create_task(_one(inv)) for inv in invoices]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            invoice, doc_bytes = await fut
+            done += 1
+            if doc_bytes is None:
+                rows_text = ", ".join(str(r) for r in invoice["rows"])
+                if invoice["number"] is None:
+                    errors.append((rows_text, invoice["customer_name"], "нет шаблона счёта"))
+                else:
+                    skipped_numbers.append(invoice["number"])
+                    errors.append((rows_text, invoice["customer_name"],
+                                   f"не удалось сформировать счёт, номер № {invoice['number']} пропущен"))
+            else:
+                archive_document(os.path.join(OUTPUT_DIR, invoice["file_name"]), doc_bytes)
+                await archive.add(invoice["file_name"], doc_bytes)
+                rendered += 1
+            if time.monotonic() - last_update >= BULK_PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                await _bulk_status(status, f"⏳ Формирую счета: {done} из {total}. Ошибок: {len(errors)}")
+
+        summary = f"✅ Готово: сформировано {rendered} из {total} счетов. Ошибок: {len(errors)}"
+        if skipped_numbers:
+            summary += f"\nПропущены номера: {', '.join(skipped_numbers)}"
+        if errors:
+            report = _bulk_error_report(errors)
+            if rendered:
+                await archive.add("Ошибки.csv", report)
+            else:
+                await bot.send_document(
+                    chat_id=chat_id,
+                    document=BufferedInputFile(report, filename="Ошибки.csv"),
+                    parse_mode=None,
+                )
+        await archive.flush(caption=summary)
+        await _bulk_status(status, summary)
+    except Exception:
+        logging.error("❌ Ошибка массового формирования счетов")
+        logging.error(traceback.format_exc())
+        for task in tasks:
+            task.cancel()
+        archive.discard()
+        await _bulk_status(status, f"❌ Формирование прервано: готово {done} из {total}.")
+
 
-    for idx, item in enumerate(items, start=1):
-        repl[tag_n("{{PLACEMENT_CHANNEL}}", idx)] = item.get("channel", "")
-        repl[tag_n("{{SERVICE_PERIOD}}", idx)] = item.get("period", "")
-        repl[tag_n("{{AMOUNT}}", idx)] = item.get("amount", "")
-        sd_i = normalize_date_for_service_date(item.get("period", "")) or first_service_date
-        repl[tag_n("{{SERVICE_DATE}}", idx)] = sd_i
+async def start_bulk_invoices(message: Message, state: FSMContext):
+    await state.clear()
+    await state.set_state(BulkInvoiceForm.waiting_file)
+    await message.answer(BULK_PROMPT, reply_markup=step_kb())
 
-    safe_name = (
-        data.get("customer_name", "")
-        .replace('"', "")
-        .replace("«", "")
-        .replace("»", "")
-        .replace("/", "_")
-        .replace("\\", "_")
-        .replace(" ", "_")
-    )[:50]
-    output_path = os.path.join(OUTPUT_DIR, f"Счет-оферта_{safe_name}_{invoice_number}.docx")
 
-    await message.answer("⏳ Формирую счёт…")
-    ok = render_docx_with_dynamic_rows(
-        template_path,
-        output_path,
-        replacements=repl,
-        items=items,
-        enable_dynamic=use_multi,
-    )
-    if not ok or not os.path.exists(output_path):
-        await message.answer("❌ Не удалось создать счёт. Проверь шаблон и теги.")
+async def bulk_invoices_file(message: Message, state: FSMContext, bot: Bot):
+    # Повтор того же апдейта от Telegram — то же сообщение; повторная загрузка файла — новая таблица
+    key = submit_key("bulk", message.chat.id, {"message": message.message_id})
+    if await answer_duplicate_submit(key, bot, message.chat.id):
+        await state.clear()
         return
+    sent = None
+    try:
+        sent = await _bulk_invoices_file(message, state, bot)
+    finally:
+        finish_submit(key, sent)
 
-    period_main = items[0].get("period", "") if items else ""
-    caption = build_unified_caption(
-        doc_kind="invoice",
-        number=invoice_number,
-        date_str=invoice_date,
-        customer_name=data.get("customer_name", "—"),
-        inn=data.get("customer_inn", "—"),
-        ogrn=data.get("customer_ogrn", ""),
-        service_start_date=first_service_date,
-        period_text=period_main,
-        services_count=len(items),
-        total_sum_digits=total_sum,
-    )
 
-    await bot.send_document(
-        chat_id=message.chat.id,
-        document=FSInputFile(output_path, filename=os.path.basename(output_path)),
-        caption=caption,
-        reply_markup=inline_new_invoice(),
-    )
+async def _bulk_invoices_file(message: Message, state: FSMContext, bot: Bot) -> bool:
+    """Разбирает таблицу и формирует счета; False — таблица не принята (повтор обработается заново)."""
+    document = message.document
+    if document.file_size and document.file_size > BULK_MAX_FILE_SIZE:
+        await message.answer("❌ Файл слишком большой. Разбейте таблицу на несколько файлов.")
+        return False
+    buf = io.BytesIO()
+    await bot.download(document, buf)
+    try:
+        rows = _read_bulk_rows(buf.getvalue(), document.file_name or "")
+        invoices, errors = parse_bulk_invoices(rows)
+    except ValueError as e:
+        await message.answer(f"❌ {e}", parse_mode=None)
+        return False
+    except Exception:
+        logging.error(traceback.format_exc())
+        await message.answer("❌ Не удалось прочитать таблицу. Нужен CSV или XLSX с заголовками в первой строке.")
+        return False
+
     await state.clear()
+    if not invoices:
+        await message.answer("❌ В таблице нет ни одного корректного счёта.", reply_markup=main_kb())
+        if errors:
+            await bot.send_document(
+                chat_id=message.chat.id,
+                document=BufferedInputFile(_bulk_error_report(errors), filename="Ошибки.csv"),
+                parse_mode=None,
+            )
+        return False
+
+    await message.answer(
+        f"📄 Таблица принята: счетов — {len(invoices)}, строк с ошибками — {len(errors)}.",
+        parse_mode=None,
+        reply_markup=main_kb(),
+    )
+    status = await message.answer(f"⏳ Формирую счета: 0 из {len(invoices)}. Ошибок: {len(errors)}",
+                                  parse_mode=None)
+    user_id = message.from_user.id if message.from_user else 0
+    await run_bulk_invoices(bot, message.chat.id, user_id, invoices, errors, status)
+    return True
 
 
-async def form_invoice_entry(message: Message, state: FSMContext, bot: Bot):
-    await form_invoice(message, state, bot)
+async def bulk_invoices_not_file(message: Message, state: FSMContext):
+    await message.answer("Жду файл CSV или XLSX с таблицей счетов.", reply_markup=step_kb())
 
 # ——— ДОГОВОР РИМ ———
 async def start_contract_flow(message: Message, state: FSMContext):
@@ -1376,9 +3859,15 @@ async def form_contract(message: Message, state: FSMContext, bot: Bot):
         await state.set_state(ContractForm.placement_channel)
         return
 
+    if len(items) > MAX_ITEMS_FOR_TEMPLATE:
+        await message.answer(
+            f"❌ Слишком много пунктов: {len(items)}. В одном документе — не больше {MAX_ITEMS_FOR_TEMPLATE}."
+        )
+        return
+
     now = now_tz()
     user_id = message.from_user.id if message.from_user else 0
-    contract_number = generate_number(now, user_id)
+    contract_number = await generate_number(now, user_id)
     contract_date = generate_date(now)
 
     use_multi = bool(data.get("used_add_item")) or (len(items) >= 2)
@@ -1443,16 +3932,20 @@ async def form_contract(message: Message, state: FSMContext, bot: Bot):
     output_path = os.path.join(OUTPUT_DIR, f"Договор_РИМ_{safe_name}_{contract_number}.docx")
 
     await message.answer("⏳ Формирую договор…")
-    ok = render_docx_with_dynamic_rows(
-        template_path,
-        output_path,
-        replacements=repl,
-        items=norm_items,
-        enable_dynamic=use_multi,
-    )
-    if not ok or not os.path.exists(output_path):
+    try:
+        doc_bytes, _timing = await render_service.render(
+            template_path,
+            replacements=repl,
+            items=norm_items,
+            enable_dynamic=use_multi,
+        )
+    except RenderQueueFull:
+        await message.answer("⏳ Сейчас формируется слишком много документов. Попробуйте через минуту.")
+        return
+    if doc_bytes is None:
         await message.answer("❌ Не удалось создать договор. Проверьте шаблон и метки.")
         return
+    archive_document(output_path, doc_bytes)
 
     period_main = items[0].get("period", "") if items else ""
     caption = build_unified_caption(
@@ -1468,13 +3961,18 @@ async def form_contract(message: Message, state: FSMContext, bot: Bot):
         total_sum_digits=total_sum,
     )
 
-    await bot.send_document(
+    sent = await bot.send_document(
         chat_id=message.chat.id,
-        document=FSInputFile(output_path, filename=os.path.basename(output_path)),
+        document=BufferedInputFile(doc_bytes, filename=os.path.basename(output_path)),
         caption=caption,
         reply_markup=inline_new_contract(),
     )
     await state.clear()
+    return sent
+
+
+async def form_contract_entry(message: Message, state: FSMContext, bot: Bot):
+    await submit_once("contract", message, state, bot, form_contract, inline_new_contract())
 
 # ——— Навигация ———
 async def handle_cancel(message: Message, state: FSMContext):
@@ -1487,6 +3985,61 @@ async def vk_lk_no(message: Message, state: FSMContext):
 
 
 # ================== МЕТРИКИ И СТАТИСТИКА ====================
+def parse_stats_period(text: str) -> tuple[datetime.date, datetime.date] | None:
+    """
+    Период из аргументов /stats: «/stats 14» — последние 14 дней,
+    «/stats 01.10.2026 15.10.2026» — с даты по дату. None — без периода.
+    """
+    args = (text or "").split()[1:]
+    today = now_tz().date()
+    try:
+        if len(args) == 1 and args[0].isdigit() and int(args[0]) > 0:
+            return today - datetime.timedelta(days=int(args[0]) - 1), today
+        if len(args) == 2:
+            start, end = (datetime.datetime.strptime(a, "%d.%m.%Y").date() for a in args)
+            return (start, end) if start <= end else (end, start)
+    except ValueError:
+        pass
+    return None
+
+
+async def stats_text(period: tuple[datetime.date, datetime.date] | None = None) -> str:
+    """Текст статистики уникальных пользователей (общий для /stats и автоотправки)."""
+    stats = await get_unique_users_stats()
+    lines = [
+        "📊 *Статистика уникальных пользователей*",
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━",
+        f"👥 *Всего:* {stats['total']}",
+        f"📅 *Сегодня:* {stats['today']}",
+        f"📆 *За неделю:* {stats['week']}",
+        f"📆 *За месяц:* {stats['month']}",
+    ]
+    if activity_enabled():
+        act = await asyncio.to_thread(activity_stats)
+        lines += [
+            "━━━━━━━━━━━━━━━━━━━━━━━━━━",
+            f"🔥 *Активны сегодня / 7 дн. / 30 дн.:* {act['dau']} / {act['wau']} / {act['mau']}",
+            f"🔁 *Вернулись на этой неделе:* {act['week_returned']} из {act['week_cohort']} новых прошлой недели",
+            f"🔁 *Вернулись за 30 дн.:* {act['month_returned']} из {act['month_cohort']} новых за 30 дн. до этого",
+        ]
+    if period:
+        start, end = period
+        lines.append(
+            f"🗓 *{start.strftime('%d.%m.%Y')} – {end.strftime('%d.%m.%Y')}:* {await unique_users_stats(start, end)}"
+        )
+        if activity_enabled():
+            active = bits_count(await asyncio.to_thread(activity_store.active, start, end))
+            if (end - start).days >= ACTIVITY_MAX_DAYS:
+                lines.append(f"🔥 *Активны за последние {ACTIVITY_MAX_DAYS} дн. периода:* {active}")
+            else:
+                lines.append(f"🔥 *Активны за период:* {active}")
+    lines += [
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━",
+        f"🕐 *Обновлено:* {now_tz().strftime('%d.%m.%Y %H:%M')}",
+    ]
+    return "\n".join(lines)
+
+
 async def cmd_stats(message: Message, state: FSMContext):
     """Команда для отправки статистики уникальных пользователей в админ чат."""
     await state.clear()
@@ -1496,27 +4049,14 @@ async def cmd_stats(message: Message, state: FSMContext):
         return
     
     try:
-        stats = get_unique_users_stats()
-        now = now_tz()
-        date_str = now.strftime("%d.%m.%Y %H:%M")
-        
-        stats_text = (
-            f"📊 *Статистика уникальных пользователей*\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"👥 *Всего:* {stats['total']}\n"
-            f"📅 *Сегодня:* {stats['today']}\n"
-            f"📆 *За неделю:* {stats['week']}\n"
-            f"📆 *За месяц:* {stats['month']}\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"🕐 *Обновлено:* {date_str}"
-        )
+        text = await stats_text(parse_stats_period(message.text or ""))
         
         # Отправляем в админ чат
         bot_instance = Bot(token=BOT_TOKEN)
         try:
             await bot_instance.send_message(
                 chat_id=ADMIN_CHAT_ID,
-                text=stats_text,
+                text=text,
                 parse_mode=ParseMode.MARKDOWN
             )
             await message.answer("✅ Статистика отправлена в админ чат")
@@ -1538,26 +4078,13 @@ async def send_stats_to_admin_chat():
         return
     
     try:
-        stats = get_unique_users_stats()
-        now = now_tz()
-        date_str = now.strftime("%d.%m.%Y %H:%M")
-        
-        stats_text = (
-            f"📊 *Статистика уникальных пользователей*\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"👥 *Всего:* {stats['total']}\n"
-            f"📅 *Сегодня:* {stats['today']}\n"
-            f"📆 *За неделю:* {stats['week']}\n"
-            f"📆 *За месяц:* {stats['month']}\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"🕐 *Обновлено:* {date_str}"
-        )
+        text = await stats_text()
         
         bot_instance = Bot(token=BOT_TOKEN)
         try:
             await bot_instance.send_message(
                 chat_id=ADMIN_CHAT_ID,
-                text=stats_text,
+                text=text,
                 parse_mode=ParseMode.MARKDOWN
             )
             logging.info(f"Статистика отправлена в админ чат {ADMIN_CHAT_ID}")
@@ -1568,6 +4095,74 @@ async def send_stats_to_admin_chat():
         logging.error(f"Ошибка отправки статистики в админ чат: {e}")
 
 
+def is_admin_message(message: Message) -> bool:
+    """Сообщение из админ-чата (ADMIN_CHAT_ID) или от пользователя из ADMIN_USER_IDS."""
+    if ADMIN_CHAT_ID and str(message.chat.id) == str(ADMIN_CHAT_ID):
+        return True
+    return bool(message.from_user) and str(message.from_user.id) in ADMIN_USER_IDS
+
+
+async def cmd_render_stats(message: Message, state: FSMContext):
+    """/render_stats [шаблон] — перцентили времени рендера (только для админов)."""
+    if not is_admin_message(message):
+        return
+    parts = (message.text or "").split(maxsplit=1)
+    text = render_stats.report(parts[1] if len(parts) > 1 else "")
+    # Лимит Telegram — 4096 символов на сообщение
+    chunk = ""
+    for line in text.split("\n"):
+        if len(chunk) + len(line) + 1 > 4000:
+            await message.answer(chunk, parse_mode=None)
+            chunk = ""
+        chunk += line + "\n"
+    if chunk.strip():
+        await message.answer(chunk, parse_mode=None)
+
+
+async def cmd_storage_stats(message: Message, state: FSMContext):
+    """/storage_stats — число и время операций хранилища состояния (только для админов)."""
+    if not is_admin_message(message):
+        return
+    st = storage()
+    await message.answer(st.stats.report(st.name, st.cache_ttl), parse_mode=None)
+
+
+COUNTERS_PERIOD_RX = re.compile(r"^\d{4}(-\d{2}(-\d{2})?)?$")
+
+
+async def cmd_counters_history(message: Message, state: FSMContext):
+    """
+    /counters_history [период [конец]] [id пользователя] — сколько номеров документов
+    выдано по архивам счётчиков. Период: ГГГГ, ГГГГ-ММ или ГГГГ-ММ-ДД (только для админов).
+    """
+    if not is_admin_message(message):
+        return
+    periods, user_id = [], None
+    for arg in (message.text or "").split()[1:]:
+        if COUNTERS_PERIOD_RX.match(arg):
+            periods.append(arg)
+        elif arg.isdigit():
+            user_id = arg
+    # Границы как строки: «2026-09» — с «2026-09» до «2026-09-99» включительно
+    start = periods[0] if periods else ""
+    end = (periods[1] if len(periods) > 1 else start) + "-99" if periods else "9999"
+    history = counters_history(await counters_archive_days(start, end), user_id)
+
+    title = f"📚 Нумерация по архиву: {' – '.join(periods[:2]) if periods else 'всё время'}"
+    if user_id:
+        title += f", пользователь {user_id}"
+    lines = [title, f"Номеров выдано: {history['total']} · дней: {history['days']} · пользователей: {len(history['users'])}"]
+    if history["months"]:
+        lines.append("")
+        lines.extend(f"{month}: {count}" for month, count in sorted(history["months"].items()))
+    if not user_id and history["users"]:
+        top = sorted(history["users"].items(), key=lambda kv: -kv[1])[:10]
+        lines.append("")
+        lines.append("Больше всех:")
+        lines.extend(f"{uid}: {count}" for uid, count in top)
+    await message.answer("\n".join(lines), parse_mode=None)
+
+
 # ================== ЗАПУСК ====================
 async def main() -> None:
     session = AiohttpSession(timeout=30)
@@ -1578,6 +4173,19 @@ async def main() -> None:
     )
     dp = Dispatcher()
 
+    # Прогрев кэша шаблонов DOCX, чтобы первый счёт не платил за разбор файла
+    logging.info("Шаблонов в кэше: %s", preload_templates())
+    start_template_watcher()
+    render_service.start()
+    vk_ord_client.start()
+    await import_local_state()
+    counters_archive_task = asyncio.create_task(counters_archive_loop())
+    if activity_enabled():
+        activity_store.start(await storage().all("unique_users"))
+        dp.update.outer_middleware(ActivityMiddleware())
+    elif ACTIVITY_TRACKING:
+        logging.warning("Активность пользователей не отслеживается: её файлы локальны, а хранилище %s общее", storage().name)
+
     # старт / меню
     dp.message.register(cmd_start, CommandStart())
     dp.message.register(cmd_feedback, match_contains("обратная связь"))
@@ -1586,6 +4194,9 @@ async def main() -> None:
     # статистика
     dp.message.register(cmd_stats, Command("stats"))
     dp.message.register(cmd_stats, match_contains("статистика"))
+    dp.message.register(cmd_render_stats, Command("render_stats"))
+    dp.message.register(cmd_storage_stats, Command("storage_stats"))
+    dp.message.register(cmd_counters_history, Command("counters_history"))
 
     dp.message.register(offer_vk_lk_subscription, match_contains("подключить кабинет"))
     dp.message.register(offer_vk_lk_subscription, match_contains("vk.орд"))
@@ -1617,6 +4228,12 @@ async def main() -> None:
     dp.message.register(manual_pnc_amount, InvoiceForm.manual_amount)
     dp.message.register(form_invoice_entry, match_contains("сформировать сч"))
 
+    # счета из таблицы
+    dp.message.register(start_bulk_invoices, match_contains("счета из таблиц"))
+    dp.message.register(start_bulk_invoices, Command("bulk"))
+    dp.message.register(bulk_invoices_file, BulkInvoiceForm.waiting_file, F.document)
+    dp.message.register(bulk_invoices_not_file, BulkInvoiceForm.waiting_file)
+
     # договор РИМ
     dp.message.register(start_contract_flow, match_contains("договор рим"))
     dp.callback_query.register(cb_new_contract, F.data == "new_contract")
@@ -1632,7 +4249,7 @@ async def main() -> None:
     dp.message.register(contract_service_period, ContractForm.service_period)
     dp.message.register(contract_amount, ContractForm.amount)
     dp.message.register(contract_add_item_start, match_contains("добавить пункт"), ContractForm.confirm)
-    dp.message.register(form_contract, match_contains("сформировать дог"))
+    dp.message.register(form_contract_entry, match_contains("сформировать дог"))
 
     try:
         me = await bot.get_me()
@@ -1691,9 +4308,11 @@ async def main() -> None:
                         # Справочник ККТУ
         dp.message.register(vk_ord_kktu_show, F.text.lower().contains('справочник ккту'))
         dp.message.register(vk_ord_kktu_show, match_contains("справочник ккту"))
-        dp.message.register(vk_ord_kktu_prev, match_contains("пред. страница"))
-        dp.message.register(vk_ord_kktu_next, match_contains("след. страница"))
+        # Кнопки прежней (текстовой) клавиатуры справочника — открываем его заново
+        dp.message.register(vk_ord_kktu_show, match_contains("пред. страница"))
+        dp.message.register(vk_ord_kktu_show, match_contains("след. страница"))
         dp.message.register(vk_ord_kktu_back_to_menu, match_contains("vk.орд меню"))
+        dp.callback_query.register(vk_ord_kktu_page, F.data.startswith("kktu:"))
 
 # шаги мастера VK.ОРД — контрагент
         dp.message.register(vk_ord_person_type_step,   StateFilter("vk_ord_person_type"))
@@ -1721,6 +4340,7 @@ async def main() -> None:
         dp.message.register(vk_ord_service_comment_step,     StateFilter("vk_ord_service_comment"))
         dp.message.register(vk_ord_service_client_step,      StateFilter("vk_ord_service_client"))
         dp.message.register(vk_ord_service_contractor_step,  StateFilter("vk_ord_service_contractor"))
+        dp.callback_query.register(vk_ord_person_pick, F.data.startswith("vkperson:"))
         dp.message.register(vk_ord_service_subject_step,     StateFilter("vk_ord_service_subject"))
         dp.message.register(vk_ord_service_date_step,        StateFilter("vk_ord_service_date"))
         dp.message.register(vk_ord_service_amount_step,      StateFilter("vk_ord_service_amount"))
@@ -1741,6 +4361,13 @@ async def main() -> None:
 
         await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
     finally:
+        counters_archive_task.cancel()
+        render_service.shutdown()
+        await vk_ord_client.close()
+        await flush_archive()
+        if activity_enabled():
+            activity_store.close()
+        await close_storage()
         await bot.session.close()
 
 # ================== VK.ОРД ИНТЕГРАЦИЯ ====================
@@ -1753,6 +4380,8 @@ import asyncio as _asyncio_vk
 import re as _re_vk
 from logging import getLogger as _getLogger_vk
 from aiogram.types import Message as _Message_vk, ReplyKeyboardMarkup as _ReplyKeyboardMarkup_vk, KeyboardButton as _KeyboardButton_vk
+from aiogram.types import InlineKeyboardMarkup as _InlineKeyboardMarkup_vk, InlineKeyboardButton as _InlineKeyboardButton_vk, CallbackQuery as _CallbackQuery_vk
+from aiogram.exceptions import TelegramBadRequest as _TelegramBadRequest_vk
 from aiogram.fsm.context import FSMContext as _FSMContext_vk
 
 VK_ORD_TOKENS_FILE = "secrets/vk_ord_tokens.json"
@@ -2059,122 +4688,100 @@ KKTU_CODES: list[str] = [
 ]
 
 KKTU_PAGE_SIZE = 15  # по умолчанию показываем до 15 кодов на странице
-  # по умолчанию показываем до 20 кодов на странице
-
-
-def _get_kktu_page(user_id: str) -> int:
-    """
-    Возвращает сохранённый номер страницы справочника ККТУ для пользователя.
-    Сохраняем его в общем VK_ORD_STATE_FILE.
-    """
-    st = _get_user_state(user_id)
-    try:
-        page = int(st.get("kktu_page") or 1)
-    except Exception:
-        page = 1
-    if page < 1:
-        page = 1
-    total_pages = max(1, (len(KKTU_CODES) + KKTU_PAGE_SIZE - 1) // KKTU_PAGE_SIZE)
-    if page > total_pages:
-        page = total_pages
-    return page
-
 
-def _set_kktu_page(user_id: str, page: int) -> None:
-    st = _get_user_state(user_id)
-    st["kktu_page"] = int(max(1, page))
-    _set_user_state(user_id, st)
 
-
-def _build_kktu_page_text(page: int) -> tuple[str, int, int]:
+def _build_kktu_pages() -> list[str]:
     """
-    Собирает текст для страницы справочника ККТУ.
-    Возвращает (text, page, total_pages).
+    Тексты всех страниц справочника ККТУ (собираются один раз при запуске).
     """
     total_items = len(KKTU_CODES)
     if total_items == 0:
-        return "Справочник ККТУ пока пуст. Позже здесь появятся коды категорий.", 1, 1
+        return ["Справочник ККТУ пока пуст. Позже здесь появятся коды категорий."]
 
     total_pages = (total_items + KKTU_PAGE_SIZE - 1) // KKTU_PAGE_SIZE
-    if page < 1:
-        page = 1
-    if page > total_pages:
-        page = total_pages
-
-    start = (page - 1) * KKTU_PAGE_SIZE
-    end = min(start + KKTU_PAGE_SIZE, total_items)
-    items = KKTU_CODES[start:end]
-
-    # Заголовок страницы + аккуратный маркдаун-список
-    lines: list[str] = [f"*Справочник ККТУ* (стр. {page}/{total_pages})", ""]
-    for item in items:
-        code, title = (item.split(" ", 1) + [""])[:2]
-        code = code.strip()
-        title = title.strip()
-        if title:
-            lines.append(f"- `{code}` {title}")
-        else:
-            lines.append(f"- {code}")
-    return "\n".join(lines), page, total_pages
-
+    pages: list[str] = []
+    for page in range(1, total_pages + 1):
+        start = (page - 1) * KKTU_PAGE_SIZE
+        items = KKTU_CODES[start:start + KKTU_PAGE_SIZE]
+
+        # Заголовок страницы + аккуратный маркдаун-список
+        lines: list[str] = [f"*Справочник ККТУ* (стр. {page}/{total_pages})", ""]
+        for item in items:
+            code, title = (item.split(" ", 1) + [""])[:2]
+            code = code.strip()
+            title = title.strip()
+            if title:
+                lines.append(f"- `{code}` {title}")
+            else:
+                lines.append(f"- {code}")
+        pages.append("\n".join(lines))
+    return pages
 
 
-def vk_ord_kktu_kb(page: int, total_pages: int) -> _ReplyKeyboardMarkup_vk:
+def vk_ord_kktu_kb(page: int, total_pages: int) -> _InlineKeyboardMarkup_vk:
     """
-    Клавиатура навигации по справочнику ККТУ.
+    Инлайн-клавиатура навигации по справочнику ККТУ: номер страницы — в callback_data.
     """
-    nav_row: list[_KeyboardButton_vk] = []
+    nav_row: list[_InlineKeyboardButton_vk] = []
     if page > 1:
-        nav_row.append(_KeyboardButton_vk(text="◀️ Пред. страница"))
+        nav_row.append(_InlineKeyboardButton_vk(text="◀️ Пред. страница", callback_data=f"kktu:{page - 1}"))
     if page < total_pages:
-        nav_row.append(_KeyboardButton_vk(text=" След. страница ➡️"))
+        nav_row.append(_InlineKeyboardButton_vk(text="След. страница ➡️", callback_data=f"kktu:{page + 1}"))
 
-    if not nav_row:
-        nav_row.append(_KeyboardButton_vk(text="Обновить страницу"))
+    rows = [nav_row] if nav_row else []
+    rows.append([_InlineKeyboardButton_vk(text="🔙 В VK.ОРД меню", callback_data="kktu:menu")])
+    return _InlineKeyboardMarkup_vk(inline_keyboard=rows)
 
-    return _ReplyKeyboardMarkup_vk(
-        keyboard=[
-            nav_row,
-            [_KeyboardButton_vk(text="🔙 В VK.ОРД меню")],
-        ],
-        resize_keyboard=True,
-    )
+
+KKTU_PAGES: list[str] = _build_kktu_pages()
+KKTU_KEYBOARDS: list[_InlineKeyboardMarkup_vk] = [
+    vk_ord_kktu_kb(page, len(KKTU_PAGES)) for page in range(1, len(KKTU_PAGES) + 1)
+]
 
 
-async def vk_ord_kktu_show(message: _Message_vk, state: _FSMContext_vk):
+def _build_kktu_page_text(page: int) -> tuple[str, int, int]:
     """
-    Старт показа справочника ККТУ из меню VK.ОРД.
-    Всегда открывает первую страницу.
+    Текст страницы справочника ККТУ (из заранее собранных KKTU_PAGES).
+    Возвращает (text, page, total_pages).
     """
-    user_id = str(message.from_user.id)
-    page = 1
-    text, page, total_pages = _build_kktu_page_text(page)
-    _set_kktu_page(user_id, page)
-    await message.answer(text, reply_markup=vk_ord_kktu_kb(page, total_pages))
+    total_pages = len(KKTU_PAGES)
+    page = min(max(1, page), total_pages)
+    return KKTU_PAGES[page - 1], page, total_pages
 
 
-async def vk_ord_kktu_prev(message: _Message_vk, state: _FSMContext_vk):
+async def vk_ord_kktu_show(message: _Message_vk, state: _FSMContext_vk):
     """
-    Переход на предыдущую страницу справочника ККТУ.
+    Старт показа справочника ККТУ из меню VK.ОРД.
+    Всегда открывает первую страницу; листание — инлайн-кнопками (vk_ord_kktu_page).
     """
-    user_id = str(message.from_user.id)
-    current_page = _get_kktu_page(user_id)
-    new_page = max(1, current_page - 1)
-    text, page, total_pages = _build_kktu_page_text(new_page)
-    _set_kktu_page(user_id, page)
-    await message.answer(text, reply_markup=vk_ord_kktu_kb(page, total_pages))
+    text, page, _total_pages = _build_kktu_page_text(1)
+    await message.answer(text, reply_markup=KKTU_KEYBOARDS[page - 1])
 
 
-async def vk_ord_kktu_next(message: _Message_vk, state: _FSMContext_vk):
+async def vk_ord_kktu_page(callback: _CallbackQuery_vk, state: _FSMContext_vk):
     """
-    Переход на следующую страницу справочника ККТУ.
+    Листание справочника ККТУ: страница берётся из callback_data, сообщение
+    редактируется на месте — без обращений к хранилищу.
     """
-    user_id = str(message.from_user.id)
-    current_page = _get_kktu_page(user_id)
-    new_page = current_page + 1
-    text, page, total_pages = _build_kktu_page_text(new_page)
-    _set_kktu_page(user_id, page)
-    await message.answer(text, reply_markup=vk_ord_kktu_kb(page, total_pages))
+    value = (callback.data or "").split(":", 1)[1]
+    if value == "menu":
+        await callback.answer()
+        await vk_ord_kktu_back_to_menu(callback.message, state)
+        return
+    try:
+        requested = int(value)
+    except ValueError:
+        await callback.answer()
+        return
+
+    text, page, _total_pages = _build_kktu_page_text(requested)
+    try:
+        await callback.message.edit_text(text, reply_markup=KKTU_KEYBOARDS[page - 1])
+    except _TelegramBadRequest_vk as e:
+        # Повторное нажатие той же кнопки: страница уже показана
+        if "message is not modified" not in str(e):
+            await callback.message.answer(text, reply_markup=KKTU_KEYBOARDS[page - 1])
+    await callback.answer()
 
 
 async def vk_ord_kktu_back_to_menu(message: _Message_vk, state: _FSMContext_vk):
@@ -2195,142 +4802,351 @@ if not VK_ORD_API_TOKEN:
 
 # ---------- ХРАНЕНИЕ ТОКЕНОВ И СОСТОЯНИЯ ----------
 
-def load_vk_ord_tokens() -> dict:
-    if not _os_vk.path.exists(VK_ORD_TOKENS_FILE):
-        return {}
-    try:
-        with open(VK_ORD_TOKENS_FILE, "r", encoding="utf-8") as f:
-            return _json_vk.load(f)
-    except Exception:
-        return {}
+# Токены и состояние пользователей — пространства vk_ord_tokens и vk_ord_state
+# хранилища (см. storage()); при STORAGE_BACKEND = "json" это прежний файл
+# VK_ORD_TOKENS_FILE и по файлу состояния на пользователя в STORAGE_DIR/vk_ord_state/.
+# Файл токенов читается один раз и держится в памяти (JsonStorage): set_vk_ord_token
+# обновляет его сразу, правка файла вне бота подхватывается по времени изменения.
+# Попадания и промахи — в /storage_stats.
+# Изменения состояния одного пользователя идут по очереди (_update_user_state),
+# пользователи друг друга не ждут.
 
+async def get_vk_ord_token(user_id: int | str) -> str | None:
+    return await storage().get("vk_ord_tokens", str(user_id))
 
-def save_vk_ord_tokens(data: dict) -> None:
-    with open(VK_ORD_TOKENS_FILE, "w", encoding="utf-8") as f:
-        _json_vk.dump(data, f, ensure_ascii=False, indent=2)
 
+async def set_vk_ord_token(user_id: int | str, token: str) -> None:
+    await storage().set("vk_ord_tokens", str(user_id), token)
 
-def user_is_authorized(user_id: int | str) -> bool:
-    tokens = load_vk_ord_tokens()
-    return str(user_id) in tokens
 
+async def user_is_authorized(user_id: int | str) -> bool:
+    return await get_vk_ord_token(user_id) is not None
 
-def load_vk_ord_state() -> dict:
-    if not _os_vk.path.exists(VK_ORD_STATE_FILE):
-        return {}
-    try:
-        with open(VK_ORD_STATE_FILE, "r", encoding="utf-8") as f:
-            return _json_vk.load(f)
-    except Exception:
-        return {}
+
+async def _get_user_state(user_id: str) -> dict:
+    return await storage().get("vk_ord_state", user_id, {})
 
 
-def save_vk_ord_state(data: dict) -> None:
-    with open(VK_ORD_STATE_FILE, "w", encoding="utf-8") as f:
-        _json_vk.dump(data, f, ensure_ascii=False, indent=2)
+async def _set_user_state(user_id: str, new_state: dict) -> None:
+    await storage().set("vk_ord_state", user_id, new_state)
 
 
-def _get_user_state(user_id: str) -> dict:
-    state = load_vk_ord_state()
-    return state.get(user_id, {})
+_user_state_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
 
 
-def _set_user_state(user_id: str, new_state: dict) -> None:
-    state = load_vk_ord_state()
-    state[user_id] = new_state
-    save_vk_ord_state(state)
+@asynccontextmanager
+async def _update_user_state(user_id: str):
+    """Чтение-изменение-запись состояния пользователя под его блокировкой."""
+    async with _user_state_locks.setdefault(user_id, asyncio.Lock()):
+        st = await _get_user_state(user_id)
+        yield st
+        await _set_user_state(user_id, st)
 
 
-def _get_last_person(user_id: str) -> dict | None:
-    st = _get_user_state(user_id)
+async def _get_last_person(user_id: str) -> dict | None:
+    st = await _get_user_state(user_id)
     return st.get("last_person")
 
 
-def _set_last_person(user_id: str, external_id: str, name: str, inn: str) -> None:
-    st = _get_user_state(user_id)
-    st["last_person"] = {"external_id": external_id, "name": name, "inn": inn}
-    _set_user_state(user_id, st)
+async def _set_last_person(user_id: str, external_id: str, name: str, inn: str) -> None:
+    async with _update_user_state(user_id) as st:
+        st["last_person"] = {"external_id": external_id, "name": name, "inn": inn}
 
-def _add_person_to_registry(user_id: str, external_id: str, name: str, inn: str) -> None:
+_PERSON_QUOTES_RX = _re_vk.compile(r"[«»\"'“”„]")
+_PERSON_SPACES_RX = _re_vk.compile(r"\s+")
+_NON_DIGITS_RX = _re_vk.compile(r"\D")
+
+
+def _norm_person_name(s: str) -> str:
+    s = (s or "").lower()
+    # убираем кавычки и лишнюю пунктуацию вокруг названия
+    s = _PERSON_QUOTES_RX.sub("", s)
+    # схлопываем пробелы
+    return _PERSON_SPACES_RX.sub(" ", s).strip()
+
+
+def _trigrams(s: str) -> set[str]:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class ContractorIndex:
+    """
+    Индекс справочника контрагентов одного пользователя: ИНН → запись, нормализованное
+    название → запись и триграммы названий для поиска по вхождению и подсказок похожих
+    названий. Из нескольких подходящих записей побеждает первая в справочнике, как при переборе.
+    rev — ревизия справочника (persons_rev в состоянии), по которой индекс построен.
+    """
+
+    FUZZY_MIN = 0.6  # минимальное сходство триграмм (Жаккар) для подсказки
+
+    def __init__(self, persons: list[dict], rev: int = 0):
+        self.rev = rev
+        self.persons: list[dict] = []
+        self.names: list[str] = []  # нормализованные названия по позициям
+        self.by_inn: dict[str, int] = {}
+        self.by_name: dict[str, int] = {}
+        self.name_lengths: set[int] = set()
+        self.grams: dict[str, list[int]] = {}  # триграмма → позиции по возрастанию
+        self.name_grams: list[set[str]] = []
+        for person in persons:
+            self.add(person)
+
+    def add(self, person: dict) -> None:
+        pos = len(self.persons)
+        self.persons.append(person)
+        inn = _NON_DIGITS_RX.sub("", person.get("inn") or "")
+        if inn:
+            self.by_inn.setdefault(inn, pos)
+        name = _norm_person_name(person.get("name") or "")
+        self.names.append(name)
+        grams = _trigrams(name)
+        self.name_grams.append(grams)
+        if name:
+            self.by_name.setdefault(name, pos)
+            self.name_lengths.add(len(name))
+        for gram in grams:
+            self.grams.setdefault(gram, []).append(pos)
+
+    def _find_substring(self, q: str) -> int | None:
+        best = None
+        # Названия, входящие в запрос: все подстроки запроса подходящей длины
+        for length in self.name_lengths:
+            for i in range(len(q) - length + 1):
+                pos = self.by_name.get(q[i:i + length])
+                if pos is not None and (best is None or pos < best):
+                    best = pos
+        # Запрос, входящий в название: кандидаты — по самой редкой триграмме запроса
+        grams = _trigrams(q)
+        if grams:
+            candidates = min((self.grams.get(gram, []) for gram in grams), key=len)
+        else:
+            candidates = range(len(self.names))  # запрос короче трёх символов
+        for pos in candidates:
+            if best is not None and pos >= best:
+                break
+            if self.names[pos] and q in self.names[pos]:
+                return pos
+        return best
+
+    def _find_fuzzy(self, q: str, limit: int) -> list[int]:
+        grams = _trigrams(q)
+        if not grams:
+            return []
+        # Со сходством не ниже FUZZY_MIN у названия не меньше need общих триграмм с запросом,
+        # значит, оно есть хотя бы в одном из len - need + 1 самых редких списков
+        need = max(1, math.ceil(self.FUZZY_MIN * len(grams)))
+        rare = sorted(grams, key=lambda gram: len(self.grams.get(gram, ())))[:len(grams) - need + 1]
+        candidates = {pos for gram in rare for pos in self.grams.get(gram, ())}
+        scored = []
+        for pos in candidates:
+            shared = len(grams & self.name_grams[pos])
+            score = shared / (len(grams) + len(self.name_grams[pos]) - shared)
+            if score >= self.FUZZY_MIN:
+                scored.append((-score, pos))
+        return [pos for _score, pos in sorted(scored)[:limit]]
+
+    def suggest(self, query: str, limit: int = 3) -> list[dict]:
+        """
+        Записи с названием, похожим на запрос (опечатки), — лучшие первыми. Только для
+        подсказки «Вы имели в виду…?»: сами по себе такие совпадения не выбираются.
+        """
+        q_norm = _norm_person_name((query or "").strip().lower())
+        return [self.persons[pos] for pos in self._find_fuzzy(q_norm, limit)]
+
+    def find(self, query: str) -> dict | None:
+        q = (query or "").strip().lower()
+        inn_digits = _NON_DIGITS_RX.sub("", q)
+        if inn_digits and inn_digits in self.by_inn:
+            return self.persons[self.by_inn[inn_digits]]
+        q_norm = _norm_person_name(q)
+        if not q_norm:
+            return None
+        pos = self.by_name.get(q_norm)
+        if pos is None:
+            pos = self._find_substring(q_norm)
+        return self.persons[pos] if pos is not None else None
+
+
+# Индексы справочников недавних пользователей (столько же, сколько состояний в памяти)
+_contractor_indexes: OrderedDict[str, ContractorIndex] = OrderedDict()
+
+
+def _contractor_index(user_id: str, st: dict, added: dict | None = None) -> ContractorIndex:
+    """
+    Индекс справочника пользователя по ревизии persons_rev. added — запись, только что
+    добавленная новым ключом: её дописываем в индекс, при других изменениях он строится заново.
+    """
+    rev = st.get("persons_rev", 0)
+    index = _contractor_indexes.get(user_id)
+    if index is not None and added is not None and index.rev == rev - 1:
+        index.add(added)
+        index.rev = rev
+    elif index is None or index.rev != rev:
+        index = ContractorIndex(list((st.get("persons_registry") or {}).values()), rev)
+    _contractor_indexes[user_id] = index
+    _contractor_indexes.move_to_end(user_id)
+    while len(_contractor_indexes) > max(1, STORAGE_STATE_CACHE_USERS):
+        _contractor_indexes.popitem(last=False)
+    return index
+
+
+def _person_key(person: dict) -> str:
+    """Ключ записи справочника: ИНН (только цифры), для записи без ИНН — external_id."""
+    return _NON_DIGITS_RX.sub("", person.get("inn") or "") or f"id:{person.get('external_id')}"
+
+
+def _persons_registry(user_id: str, st: dict) -> dict[str, dict]:
+    """
+    Справочник контрагентов из состояния: {ключ: запись} (пустой заводится в st).
+    Прежний справочник-список переводится в словарь: из дублей остаётся самая новая
+    запись (на месте первой).
+    """
+    registry = st.get("persons_registry") or {}
+    if isinstance(registry, list):
+        persons = registry
+        registry = {}
+        for person in persons:
+            registry[_person_key(person)] = person
+        st["persons_rev"] = st.get("persons_rev", 0) + 1
+        if len(persons) > len(registry):
+            logging.info(
+                "Справочник контрагентов %s: убрано дублей %s, осталось записей %s",
+                user_id, len(persons) - len(registry), len(registry),
+            )
+    st["persons_registry"] = registry
+    return registry
+
+
+async def _add_person_to_registry(user_id: str, external_id: str, name: str, inn: str) -> None:
     """
     Добавляем контрагента в локальный справочник бота для последующего поиска по названию или ИНН.
+    Контрагент с тем же ИНН (без ИНН — с тем же external_id) заменяется новой записью.
     """
-    st = _get_user_state(user_id)
-    persons = st.get("persons_registry", [])
-    persons.append(
-        {
-            "external_id": external_id,
-            "name": name,
-            "inn": _re_vk.sub(r"\D", "", inn or ""),
-        }
-    )
-    st["persons_registry"] = persons
-    _set_user_state(user_id, st)
+    person = {
+        "external_id": external_id,
+        "name": name,
+        "inn": _NON_DIGITS_RX.sub("", inn or ""),
+    }
+    async with _update_user_state(user_id) as st:
+        registry = _persons_registry(user_id, st)
+        key = _person_key(person)
+        replaced = key in registry
+        registry[key] = person
+        st["persons_rev"] = st.get("persons_rev", 0) + 1
+    # Индекс переводим на новую ревизию только после того, как состояние записано
+    _contractor_index(user_id, st, added=None if replaced else person)
 
 
-def _find_person_external_id(user_id: str, query: str) -> tuple[str | None, dict | None]:
+async def _find_person_external_id(user_id: str, query: str) -> tuple[str | None, dict | None]:
     """
-    Ищем external_id по названию или ИНН из локального справочника.
+    Ищем external_id по названию или ИНН из локального справочника (через ContractorIndex).
     Возвращаем (external_id, запись_контрагента) или (None, None).
 
     Приоритет поиска:
     1) Точное совпадение ИНН.
     2) Точное совпадение по названию (нормализованному).
     3) "Мягкий" поиск: по вхождению названия (нормализованного).
+    Похожие названия (опечатки) здесь не находятся — их предлагает _suggest_persons.
     """
-    st = _get_user_state(user_id)
-    persons = st.get("persons_registry", [])
-    q = (query or "").strip().lower()
-    inn_digits = _re_vk.sub(r"\D", "", q)
-
-    def _norm_name(s: str) -> str:
-        s = (s or "").lower()
-        # убираем кавычки и лишнюю пунктуацию вокруг названия
-        s = _re_vk.sub(r"[«»\"'“”„]", "", s)
-        # схлопываем пробелы
-        s = _re_vk.sub(r"\s+", " ", s).strip()
-        return s
-
-    q_norm = _norm_name(q)
-
-    # 1. Сначала пробуем найти по ИНН — самое надёжное.
-    if inn_digits:
-        for p in persons:
-            p_inn = _re_vk.sub(r"\D", "", p.get("inn") or "")
-            if p_inn and p_inn == inn_digits:
-                return p.get("external_id"), p
-
-    # 2. Затем — точное совпадение названия (нормализованное).
-    if q_norm:
-        for p in persons:
-            name_raw = (p.get("name") or "")
-            name_norm = _norm_name(name_raw)
-            if name_norm and name_norm == q_norm:
-                return p.get("external_id"), p
-
-    # 3. Мягкий поиск: вхождение строки.
-    if q_norm:
-        for p in persons:
-            name_raw = (p.get("name") or "")
-            name_norm = _norm_name(name_raw)
-            if not name_norm:
-                continue
-            if q_norm in name_norm or name_norm in q_norm:
-                return p.get("external_id"), p
+    st = await _get_user_state(user_id)
+    if isinstance(st.get("persons_registry"), list):
+        async with _update_user_state(user_id) as st:
+            _persons_registry(user_id, st)
+    person = _contractor_index(user_id, st).find(query)
+    if person is None:
+        return None, None
+    return person.get("external_id"), person
+
+
+async def _suggest_persons(user_id: str, query: str) -> list[dict]:
+    """
+    Контрагенты с названием, похожим на запрос, — для подтверждения пользователем.
+    Вызывается после _find_person_external_id (справочник уже переведён в словарь).
+    """
+    st = await _get_user_state(user_id)
+    return _contractor_index(user_id, st).suggest(query)
+
+
+async def _find_person_by_external_id(user_id: str, external_id: str) -> dict | None:
+    st = await _get_user_state(user_id)
+    registry = st.get("persons_registry") or {}
+    persons = registry.values() if isinstance(registry, dict) else registry
+    return next((person for person in persons if person.get("external_id") == external_id), None)
+
+
+def vk_ord_person_suggestions_kb(persons: list[dict]) -> _InlineKeyboardMarkup_vk:
+    """
+    Подсказки «Вы имели в виду…?»: по кнопке на контрагента, в callback_data — номер
+    подсказки (сами external_id лежат в данных FSM и в лимит callback_data не упираются).
+    """
+    rows = []
+    for i, person in enumerate(persons):
+        label = person.get("name") or person.get("external_id") or "?"
+        if person.get("inn"):
+            label += f" · ИНН {person['inn']}"
+        rows.append([_InlineKeyboardButton_vk(text=label, callback_data=f"vkperson:{i}")])
+    return _InlineKeyboardMarkup_vk(inline_keyboard=rows)
+
+
+async def _vk_ord_offer_persons(
+    message: _Message_vk, state: _FSMContext_vk, user_id: str, query: str, not_found: str
+) -> None:
+    """
+    Точного совпадения нет: предлагаем похожих контрагентов на выбор кнопками
+    (vk_ord_person_pick), а если и похожих нет — отвечаем not_found.
+    """
+    suggestions = await _suggest_persons(user_id, query)
+    if not suggestions:
+        await message.answer(not_found, reply_markup=step_kb())
+        return
+    await state.update_data(vk_ord_person_suggestions=[person.get("external_id") for person in suggestions])
+    await message.answer(
+        f"Точного совпадения для «{query}» нет. Вы имели в виду:\n\n"
+        "Если никто не подходит — введите название или ИНН ещё раз.",
+        reply_markup=vk_ord_person_suggestions_kb(suggestions),
+        parse_mode=None,
+    )
 
-    return None, None
+
+async def vk_ord_person_pick(callback: _CallbackQuery_vk, state: _FSMContext_vk):
+    """
+    Выбор контрагента из подсказок «Вы имели в виду…?»: шаг мастера продолжается
+    так же, как при точном совпадении.
+    """
+    steps = {
+        "vk_ord_service_client": _vk_ord_service_client_chosen,
+        "vk_ord_service_contractor": _vk_ord_service_contractor_chosen,
+    }
+    step = steps.get(await state.get_state())
+    suggestions = (await state.get_data()).get("vk_ord_person_suggestions") or []
+    person = None
+    try:
+        external_id = suggestions[int((callback.data or "").split(":", 1)[1])]
+    except (ValueError, IndexError):
+        external_id = None
+    if step and external_id:
+        person = await _find_person_by_external_id(str(callback.from_user.id), external_id)
+    if person is None:
+        await callback.answer("Подсказка устарела — введите название или ИНН ещё раз.", show_alert=True)
+        return
+    await callback.answer()
+    try:
+        await callback.message.edit_reply_markup(reply_markup=None)
+    except _TelegramBadRequest_vk:
+        pass
+    await state.update_data(vk_ord_person_suggestions=None)
+    await step(callback.message, state, person)
 
 
 
-def _get_last_contract(user_id: str) -> dict | None:
-    st = _get_user_state(user_id)
+async def _get_last_contract(user_id: str) -> dict | None:
+    st = await _get_user_state(user_id)
     return st.get("last_contract")
 
 
-def _set_last_contract(user_id: str, external_id: str, number: str, date: str) -> None:
-    st = _get_user_state(user_id)
-    st["last_contract"] = {"external_id": external_id, "number": number, "date": date}
-    _set_user_state(user_id, st)
+async def _set_last_contract(user_id: str, external_id: str, number: str, date: str) -> None:
+    async with _update_user_state(user_id) as st:
+        st["last_contract"] = {"external_id": external_id, "number": number, "date": date}
 
 
 # ---------- КЛАВИАТУРЫ VK.ОРД ----------
@@ -2434,7 +5250,7 @@ def vk_ord_creative_type_kb() -> _ReplyKeyboardMarkup_vk:
 
 async def connect_vk_ord_lk(message: _Message_vk, state: _FSMContext_vk):
     user_id = str(message.from_user.id)
-    if user_is_authorized(user_id):
+    if await user_is_authorized(user_id):
         await message.answer(
             "Ой, кажется Вы уже авторизовались..\n\n"
             "Выберите действие, которое хотите совершить в «VK.ОРД»:",
@@ -2472,9 +5288,7 @@ async def vk_ord_start_choice(message: _Message_vk, state: _FSMContext_vk):
 async def save_vk_ord_token(message: _Message_vk, state: _FSMContext_vk):
     token = (message.text or "").strip()
     user_id = str(message.from_user.id)
-    tokens = load_vk_ord_tokens()
-    tokens[user_id] = token
-    save_vk_ord_tokens(tokens)
+    await set_vk_ord_token(user_id, token)
     await state.clear()
     await message.answer("🎉 Поздравляю! Теперь Вы подключены к VK.ОРД.")
     await message.answer("Выберите действие, которое хотите совершить:", reply_markup=vk_ord_menu_kb())
@@ -2483,6 +5297,59 @@ async def save_vk_ord_token(message: _Message_vk, state: _FSMContext_vk):
 # ---------- ОБЩИЙ КЛИЕНТ VK.ОРД API ----------
 
 
+class VkOrdClient:
+    """
+    Одна долгоживущая HTTP-сессия VK.ОРД на процесс: TCP/TLS-соединения (keep-alive)
+    и ответы DNS переиспользуются между запросами — мастер креатива делает 2–3 вызова
+    подряд. Открывается в main() и закрывается при остановке бота; обращение до
+    start() (скрипты, тесты) откроет сессию само.
+    deadline — предел (сек) на один вызов API вместе с повторами и паузами между ними.
+    """
+
+    DNS_CACHE_TTL = 300  # сек
+
+    def __init__(self, limit_per_host: int, keepalive: float, connect_timeout: float, read_timeout: float,
+                 deadline: float):
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self._session: _aiohttp_vk.ClientSession | None = None
+
+    def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = _aiohttp_vk.TCPConnector(
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive,
+            use_dns_cache=True,
+            ttl_dns_cache=self.DNS_CACHE_TTL,
+        )
+        self._session = _aiohttp_vk.ClientSession(
+            connector=connector,
+            timeout=_aiohttp_vk.ClientTimeout(
+                total=self.deadline, sock_connect=self.connect_timeout, sock_read=self.read_timeout
+            ),
+        )
+
+    @property
+    def session(self) -> _aiohttp_vk.ClientSession:
+        self.start()
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+vk_ord_client = VkOrdClient(
+    VK_ORD_HTTP_LIMIT_PER_HOST, VK_ORD_HTTP_KEEPALIVE, VK_ORD_HTTP_CONNECT_TIMEOUT, VK_ORD_HTTP_READ_TIMEOUT,
+    VK_ORD_HTTP_DEADLINE,
+)
+
+
 async def vk_ord_api_request(user_id: str, method: str, path: str | list, json_body: dict | None = None):
     """
     Универсальный помощник для вызова VK.ОРД API.
@@ -2495,10 +5362,9 @@ async def vk_ord_api_request(user_id: str, method: str, path: str | list, json_b
        со swagger-документацией VK.ОРД (sandbox/prod).
     """
     log = _getLogger_vk(__name__)
-    tokens = load_vk_ord_tokens()
     # Пытаемся сначала взять персональный токен пользователя, если он сохранён,
     # иначе используем глобальный VK_ORD_API_TOKEN.
-    token = tokens.get(str(user_id)) or VK_ORD_API_TOKEN
+    token = await get_vk_ord_token(user_id) or VK_ORD_API_TOKEN
     if not token:
         return False, "API-токен VK.ОРД для этого пользователя не найден. Переподключите кабинет."
 
@@ -2529,45 +5395,62 @@ async def vk_ord_api_request(user_id: str, method: str, path: str | list, json_b
                 data = None
             return resp.status, txt, data, url, dict(resp.headers)
 
-    async with _aiohttp_vk.ClientSession() as session:
-        last = None
-        backoff = 0
-        for attempt in range(3):
-            if backoff:
-                await _asyncio_vk.sleep(backoff)
-
-            status, txt, data, used, resp_headers = await _do(session, url)
+    session = vk_ord_client.session
+    loop = _asyncio_vk.get_running_loop()
+    # Общий срок на все попытки: пользователь ждёт ответа не дольше VK_ORD_HTTP_DEADLINE
+    deadline = loop.time() + vk_ord_client.deadline
+    last = None
+    backoff = 0
+    for attempt in range(3):
+        if backoff:
+            if loop.time() + backoff >= deadline:
+                break  # пауза перед повтором не укладывается в срок
+            await _asyncio_vk.sleep(backoff)
 
-            if status == 429:
-                ra = None
-                if isinstance(resp_headers, dict):
-                    ra = resp_headers.get("Retry-After") or resp_headers.get("retry-after")
-                try:
-                    backoff = max(1, int(ra)) if ra else (2 ** attempt)
-                except Exception:
-                    backoff = 2 ** attempt
-                last = (status, txt, data, used)
-                continue
+        try:
+            status, txt, data, used, resp_headers = await _asyncio_vk.wait_for(
+                _do(session, url), deadline - loop.time()
+            )
+        except (_aiohttp_vk.ClientError, _asyncio_vk.TimeoutError) as e:
+            if loop.time() >= deadline:
+                log.warning("VK.ОРД API: %s %s — нет ответа за %s с", method.upper(), url, vk_ord_client.deadline)
+                return False, f"VK.ОРД не ответил за {vk_ord_client.deadline:g} с. Попробуйте позже."
+            # Сеть или таймаут — повторяем, как при 5xx
+            log.warning("VK.ОРД API: %s %s — %r", method.upper(), url, e)
+            backoff = 2 ** attempt
+            last = (None, f"VK.ОРД не ответил ({type(e).__name__})", None, url)
+            continue
 
-            if 500 <= status < 600:
+        if status == 429:
+            ra = None
+            if isinstance(resp_headers, dict):
+                ra = resp_headers.get("Retry-After") or resp_headers.get("retry-after")
+            try:
+                backoff = max(1, int(ra)) if ra else (2 ** attempt)
+            except Exception:
                 backoff = 2 ** attempt
-                last = (status, txt, data, used)
-                continue
-
-            if 200 <= status < 300:
-                return True, data or txt
+            last = (status, txt, data, used)
+            continue
 
+        if 500 <= status < 600:
+            backoff = 2 ** attempt
             last = (status, txt, data, used)
-            break
+            continue
 
-        if last:
-            status, txt, data, used = last
-            log.error(
-                "VK.ОРД API error: status=%s url=%s body=%r json=%r",
-                status, used, txt, data
-            )
-            return False, data or txt or f"HTTP {status}"
-        return False, "Не удалось вызвать VK.ОРД API: пустой ответ/нет попыток."
+        if 200 <= status < 300:
+            return True, data or txt
+
+        last = (status, txt, data, used)
+        break
+
+    if last:
+        status, txt, data, used = last
+        log.error(
+            "VK.ОРД API error: status=%s url=%s body=%r json=%r",
+            status, used, txt, data
+        )
+        return False, data or txt or f"HTTP {status}"
+    return False, "Не удалось вызвать VK.ОРД API: пустой ответ/нет попыток."
 def _normalize_roles_to_codes(text: str) -> list[str]:
     """
     Преобразует человекочитаемые роли в коды ролей VK.ОРД.
@@ -2711,8 +5594,7 @@ async def vk_ord_upload_media(
     где result = external_id (если ok=True) или тело ошибки/ответа.
     """
     log = _getLogger_vk(__name__)
-    tokens = load_vk_ord_tokens()
-    token = tokens.get(str(user_id)) or VK_ORD_API_TOKEN
+    token = await get_vk_ord_token(user_id) or VK_ORD_API_TOKEN
 
     base_raw = VK_ORD_API_BASE.rstrip("/")
     if not base_raw:
@@ -2733,27 +5615,30 @@ async def vk_ord_upload_media(
         "Authorization": f"Bearer {token}",
     }
 
-    async with _aiohttp_vk.ClientSession() as session:
-        async with session.put(url, data=form, headers=headers) as resp:
+    try:
+        async with vk_ord_client.session.put(url, data=form, headers=headers) as resp:
             txt = await resp.text()
             try:
                 data = await resp.json()
             except Exception:
                 data = None
+    except (_aiohttp_vk.ClientError, _asyncio_vk.TimeoutError) as e:
+        log.error("VK.ОРД media upload error: url=%s %r", url, e)
+        return False, f"VK.ОРД не ответил ({type(e).__name__})"
 
-            if 200 <= resp.status < 300:
-                if isinstance(data, dict):
-                    eid = data.get("external_id") or data.get("id") or external_id
-                else:
-                    eid = external_id
-                log.info("VK.ОРД media uploaded: status=%s url=%s external_id=%s", resp.status, url, eid)
-                return True, eid
+    if 200 <= resp.status < 300:
+        if isinstance(data, dict):
+            eid = data.get("external_id") or data.get("id") or external_id
+        else:
+            eid = external_id
+        log.info("VK.ОРД media uploaded: status=%s url=%s external_id=%s", resp.status, url, eid)
+        return True, eid
 
-            log.error(
-                "VK.ОРД media upload error: status=%s url=%s body=%r json=%r",
-                resp.status, url, txt, data
-            )
-            return False, data or txt or f"HTTP {resp.status}"
+    log.error(
+        "VK.ОРД media upload error: status=%s url=%s body=%r json=%r",
+        resp.status, url, txt, data
+    )
+    return False, data or txt or f"HTTP {resp.status}"
 
 async def vk_ord_add_contractor(message: _Message_vk, state: _FSMContext_vk):
     """
@@ -2761,7 +5646,7 @@ async def vk_ord_add_contractor(message: _Message_vk, state: _FSMContext_vk):
     На этом шаге пользователь выбирает тип контрагента.
     """
     user_id = str(message.from_user.id)
-    if not user_is_authorized(user_id):
+    if not await user_is_authorized(user_id):
         await message.answer(
             "Сначала подключите личный кабинет VK.ОРД через главное меню.",
             reply_markup=vk_lk_subscribe_kb(),
@@ -2987,8 +5872,8 @@ async def vk_ord_person_confirm_step(message: _Message_vk, state: _FSMContext_vk
         await state.clear()
         return
 
-    _set_last_person(user_id, ext_id, data.get("vk_ord_person_name", ""), inn_digits)
-    _add_person_to_registry(user_id, ext_id, data.get("vk_ord_person_name", ""), inn_digits)
+    await _set_last_person(user_id, ext_id, data.get("vk_ord_person_name", ""), inn_digits)
+    await _add_person_to_registry(user_id, ext_id, data.get("vk_ord_person_name", ""), inn_digits)
     text = "✅ Контрагент успешно создан и *отправлен в ЕРИР* на проверку!\n"
     if isinstance(resp, dict):
         vk_id = resp.get("id")
@@ -3008,7 +5893,7 @@ async def vk_ord_add_contract(message: _Message_vk, state: _FSMContext_vk):
     Пока все типы работают как заглушки, но сама развилка остаётся для дальнейшей доработки.
     """
     user_id = str(message.from_user.id)
-    if not user_is_authorized(user_id):
+    if not await user_is_authorized(user_id):
         await message.answer(
             "Сначала подключите личный кабинет VK.ОРД через главное меню.",
             reply_markup=vk_lk_subscribe_kb(),
@@ -3167,7 +6052,7 @@ async def vk_ord_additional_date_step(message: _Message_vk, state: _FSMContext_v
     await state.update_data(vk_ord_additional_date_raw=date_raw)
     data = await state.get_data()
     user_id = str(message.from_user.id)
-    last_contract = _get_last_contract(user_id)
+    last_contract = await _get_last_contract(user_id)
 
     parent_info = ""
     if last_contract:
@@ -3221,7 +6106,7 @@ async def vk_ord_additional_confirm_step(message: _Message_vk, state: _FSMContex
     user_id = str(message.from_user.id)
     ext_id = f"tg-{user_id}-additional-{int(_time_vk.time())}"
 
-    last_contract = _get_last_contract(user_id)
+    last_contract = await _get_last_contract(user_id)
     if not last_contract:
         await state.clear()
         await message.answer(
@@ -3349,18 +6234,24 @@ async def vk_ord_service_client_step(message: _Message_vk, state: _FSMContext_vk
     user_id = str(message.from_user.id)
     query = (message.text or "").strip()
 
-    ext_id, person = _find_person_external_id(user_id, query)
+    ext_id, person = await _find_person_external_id(user_id, query)
     if not ext_id:
-        await message.answer(
+        await _vk_ord_offer_persons(
+            message, state, user_id, query,
             "Не удалось найти контрагента с таким названием или ИНН.\n"
             "Сначала создайте контрагента через «➕ Добавить контрагента», "
             "а затем повторите ввод заказчика.",
-            reply_markup=step_kb(),
         )
         return
+    await _vk_ord_service_client_chosen(message, state, person)
+
 
+async def _vk_ord_service_client_chosen(message: _Message_vk, state: _FSMContext_vk, person: dict):
+    """
+    Заказчик найден (или выбран из подсказок) — переходим к шагу 4/7.
+    """
     await state.update_data(
-        vk_ord_service_client_external_id=ext_id,
+        vk_ord_service_client_external_id=person.get("external_id"),
         vk_ord_service_client_name=person.get("name"),
     )
     await state.set_state("vk_ord_service_contractor")
@@ -3381,19 +6272,24 @@ async def vk_ord_service_contractor_step(message: _Message_vk, state: _FSMContex
     user_id = str(message.from_user.id)
     query = (message.text or "").strip()
 
-    ext_id, person = _find_person_external_id(user_id, query)
+    ext_id, person = await _find_person_external_id(user_id, query)
     if not ext_id:
-        await message.answer(
+        await _vk_ord_offer_persons(
+            message, state, user_id, query,
             "Не удалось найти исполнителя с таким названием или ИНН.\n"
             "Сначала создайте этого контрагента через «➕ Добавить контрагента», "
             "а затем повторите ввод исполнителя.",
-            reply_markup=step_kb(),
         )
         return
+    await _vk_ord_service_contractor_chosen(message, state, person)
 
 
+async def _vk_ord_service_contractor_chosen(message: _Message_vk, state: _FSMContext_vk, person: dict):
+    """
+    Исполнитель найден (или выбран из подсказок) — переходим к шагу 5/7.
+    """
     await state.update_data(
-        vk_ord_service_contractor_external_id=ext_id,
+        vk_ord_service_contractor_external_id=person.get("external_id"),
         vk_ord_service_contractor_name=person.get("name"),
     )
     await state.set_state("vk_ord_service_subject")
@@ -3667,7 +6563,7 @@ async def vk_ord_service_confirm_step(message: _Message_vk, state: _FSMContext_v
         return
 
     # Сохраняем договор как последний, чтобы можно было создавать доп. соглашения
-    _set_last_contract(
+    await _set_last_contract(
         user_id,
         ext_id,
         serial,
@@ -3730,7 +6626,7 @@ async def vk_ord_contract_amount_step(message: _Message_vk, state: _FSMContext_v
     await state.update_data(vk_ord_contract_amount_raw=raw)
 
     data = await state.get_data()
-    last_person = _get_last_person(str(message.from_user.id)) or {}
+    last_person = await _get_last_person(str(message.from_user.id)) or {}
     text = (
         "Проверьте данные договора:\n"
         f"• Номер: *{data.get('vk_ord_contract_number', '')}*\n"
@@ -3789,7 +6685,7 @@ async def vk_ord_contract_confirm_step(message: _Message_vk, state: _FSMContext_
         await state.clear()
         return
 
-    _set_last_contract(
+    await _set_last_contract(
         user_id,
         ext_id,
         data.get("vk_ord_contract_number", ""),
@@ -3809,8 +6705,8 @@ async def vk_ord_contract_confirm_step(message: _Message_vk, state: _FSMContext_
 
 async def vk_ord_add_creative(message: _Message_vk, state: _FSMContext_vk):
     user_id = str(message.from_user.id)
-    last_contract = _get_last_contract(user_id)
-    last_person = _get_last_person(user_id)
+    last_contract = await _get_last_contract(user_id)
+    last_person = await _get_last_person(user_id)
 
     if not last_contract and not last_person:
         await message.answer(
@@ -3825,8 +6721,8 @@ async def vk_ord_add_creative(message: _Message_vk, state: _FSMContext_vk):
     # дальше — остальной код функции без изменения отступов
 
 
-    last_contract = _get_last_contract(user_id)
-    last_person = _get_last_person(user_id)
+    last_contract = await _get_last_contract(user_id)
+    last_person = await _get_last_person(user_id)
     if not last_contract and not last_person:
         await message.answer(
             "Чтобы оформить креатив и получить ERID, сначала нужно:\n"
@@ -4106,7 +7002,7 @@ async def vk_ord_creative_confirm_step(message: _Message_vk, state: _FSMContext_
     user_id = str(user.id) if user else "0"
 
     # Проверяем, авторизован ли пользователь в VK.ОРД
-    if not user_is_authorized(user_id):
+    if not await user_is_authorized(user_id):
         await message.answer(
             "Для оформления креатива сначала подключите кабинет VK.ОРД через кнопку "
             "«➦ Перейти в кабинет «VK.ОРД»».",
@@ -4156,7 +7052,7 @@ async def vk_ord_creative_confirm_step(message: _Message_vk, state: _FSMContext_
         return
 
     # Привязка к последнему договору VK.ОРД
-    last_contract = _get_last_contract(user_id)
+    last_contract = await _get_last_contract(user_id)
     if not last_contract or not last_contract.get("external_id"):
         await message.answer(
             "❌ Не найден последний договор в VK.ОРД.\n\n"
@@ -0,0 +1,202 @@
+# bench_render.py — замеры рендера DOCX (render_docx_with_dynamic_rows) по шаблонам
+# и числу пунктов: время по этапам, пиковый RSS и размер готового документа.
+#
+# Запуск из корня проекта (нужен config.py, как для бота; BOT_TOKEN может быть любым):
+#   python bench_render.py                                 — все шаблоны × 1, 2, 10, 50, 100, 500, 1000 пунктов
+#   python bench_render.py --items 10 100 1000 --repeat 5
+#   python bench_render.py --templates templates/schet-oferta2-multi.docx --out my.json
+#   python bench_render.py --compare bench_results/old.json bench_results/new.json
+#
+# Каждый случай (шаблон × число пунктов) выполняется в отдельном процессе, чтобы
+# пиковый RSS относился только к нему. Результаты сохраняются в JSON (по умолчанию
+# в bench_results/), два таких файла можно сравнить через --compare.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+
+DEFAULT_TEMPLATES = [
+    "templates/schet-oferta.docx",
+    "templates/schet-oferta2-multi.docx",
+    "templates/schet-oferta2-multiPRO.docx",
+    "templates/dogovor_rim.docx",
+    "templates/dogovor_rim2-multi.docx",
+]
+DEFAULT_ITEMS = [1, 2, 10, 50, 100, 500, 1000]
+STAGES = ["template", "clone", "rows", "body", "headers", "fonts", "splice", "save"]
+
+
+def peak_rss_kb() -> int:
+    """Пиковый RSS текущего процесса в КБ (на macOS ru_maxrss в байтах)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+class StageProbe(dict):
+    """stages для render_docx_with_dynamic_rows: вместе со временем этапа запоминает пиковый RSS."""
+
+    def __init__(self):
+        super().__init__()
+        self.rss = {}
+
+    def __setitem__(self, stage, ms):
+        super().__setitem__(stage, ms)
+        self.rss[stage] = peak_rss_kb()
+
+
+def make_case_data(z, template_path: str, n: int) -> tuple[dict, list, bool]:
+    """Данные формы как в боте: (replacements, items, enable_dynamic)."""
+    items = [
+        {
+            "channel": f"@channel_{i}",
+            "period": f"{(i % 28) + 1:02d}.03.2025",
+            "sdate": f"{(i % 28) + 1:02d}.03.2025",
+            "amount": str(1000 + i * 10),
+        }
+        for i in range(1, n + 1)
+    ]
+    data = {"customer_name": "ООО «Показательный»", "customer_inn": "7701234567"}
+    repl, _total, _first = z.build_invoice_replacements(data, items, "17-03-01", "17.03.2025")
+    if os.path.basename(template_path).startswith("dogovor"):
+        repl.update({
+            "{{CONTRACT_NUMBER}}": "РИМ/17-03-01",
+            "{{CONTRACT_DATE}}": "17.03.2025",
+            "{{CUSTOMER_OGRN}}": "1027700000000",
+        })
+        for idx, item in enumerate(items, start=1):
+            repl[z.tag_n("{{SERVICE_DATE}}", idx)] = item["sdate"]
+    return repl, items, "multi" in os.path.basename(template_path).lower()
+
+
+def run_case(template_path: str, n: int, repeat: int) -> dict:
+    """Один случай в текущем процессе: прогрев кэша шаблона и repeat рендеров."""
+    import time
+    import ZAPUSK as z
+
+    rss_before = peak_rss_kb()
+    started = time.perf_counter()
+    z.get_compiled_template(template_path)
+    compile_ms = (time.perf_counter() - started) * 1000
+
+    repl, items, dynamic = make_case_data(z, template_path, n)
+    runs, output_bytes = [], 0
+    stage_rss = {}
+    for _ in range(repeat):
+        probe = StageProbe()
+        started = time.perf_counter()
+        data = z.render_docx_bytes(template_path, repl, items, dynamic, stages=probe)
+        total_ms = (time.perf_counter() - started) * 1000
+        if data is None:
+            raise RuntimeError(f"рендер не удался: {template_path} × {n}")
+        output_bytes = len(data)
+        runs.append((total_ms, dict(probe)))
+        for stage, rss in probe.rss.items():
+            stage_rss[stage] = max(stage_rss.get(stage, 0), rss)
+
+    totals = [r[0] for r in runs]
+    return {
+        "template": os.path.basename(template_path),
+        "items": n,
+        "dynamic": dynamic,
+        "repeat": repeat,
+        "compile_ms": round(compile_ms, 1),
+        "total_ms": round(statistics.median(totals), 1),
+        "total_ms_min": round(min(totals), 1),
+        "stages_ms": {s: round(statistics.median(r[1].get(s, 0.0) for r in runs), 2) for s in STAGES},
+        "stage_peak_rss_kb": {s: stage_rss.get(s, 0) for s in STAGES},
+        "rss_before_kb": rss_before,
+        "peak_rss_kb": peak_rss_kb(),
+        "output_bytes": output_bytes,
+    }
+
+
+def run_case_subprocess(template_path: str, n: int, repeat: int) -> dict:
+    cmd = [sys.executable, os.path.abspath(__file__), "--case", template_path, str(n), "--repeat", str(repeat)]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{template_path} × {n}: {proc.stderr.strip().splitlines()[-1:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def print_results(results: list[dict]) -> None:
+    head = f"{'шаблон':<30} {'пункты':>6} {'всего мс':>9} " + " ".join(f"{s:>10}" for s in STAGES)
+    print(head + f" {'RSS МБ':>7} {'размер КБ':>9}")
+    for r in results:
+        stages = " ".join(f"{r['stages_ms'][s]:>10.1f}" for s in STAGES)
+        print(f"{r['template']:<30} {r['items']:>6} {r['total_ms']:>9.1f} {stages} "
+              f"{r['peak_rss_kb'] / 1024:>7.1f} {r['output_bytes'] / 1024:>9.0f}")
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path, encoding="utf-8") as f:
+        old = {(r["template"], r["items"]): r for r in json.load(f)["results"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)["results"]
+    print(f"{'шаблон':<30} {'пункты':>6} {'было мс':>9} {'стало мс':>9} {'Δ%':>7} {'RSS было':>9} {'RSS стало':>9}")
+    for r in new:
+        o = old.get((r["template"], r["items"]))
+        if o is None:
+            continue
+        delta = (r["total_ms"] - o["total_ms"]) / o["total_ms"] * 100 if o["total_ms"] else 0.0
+        print(f"{r['template']:<30} {r['items']:>6} {o['total_ms']:>9.1f} {r['total_ms']:>9.1f} {delta:>+7.1f} "
+              f"{o['peak_rss_kb'] / 1024:>9.1f} {r['peak_rss_kb'] / 1024:>9.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк рендера DOCX по шаблонам и числу пунктов")
+    parser.add_argument("--templates", nargs="+", default=DEFAULT_TEMPLATES)
+    parser.add_argument("--items", nargs="+", type=int, default=DEFAULT_ITEMS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", help="куда сохранить JSON (по умолчанию bench_results/render_<время>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="сравнить два файла результатов")
+    parser.add_argument("--case", nargs=2, metavar=("TEMPLATE", "ITEMS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.case:
+        print(json.dumps(run_case(args.case[0], int(args.case[1]), args.repeat), ensure_ascii=False))
+        return
+
+    results = []
+    for template_path in args.templates:
+        if not os.path.exists(template_path):
+            print(f"⚠️ нет шаблона, пропускаю: {template_path}", file=sys.stderr)
+            continue
+        for n in args.items:
+            results.append(run_case_subprocess(template_path, n, args.repeat))
+            print_results(results[-1:])
+
+    now = datetime.datetime.now()
+    out = args.out or os.path.join("bench_results", f"render_{now.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({
+            "created": now.isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "results": results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты: {out}")
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,8 +16,19 @@ VK_ORD_PERSON_TYPE_IP = "ip"  # Индивидуальный предприни
 VK_ORD_PERSON_TYPE_INDIVIDUAL = "physical"  # Физическое лицо
 VK_ORD_PERSON_TYPE_DEFAULT = "juridical"  # Тип по умолчанию
 
+# HTTP-клиент VK.ОРД: одна сессия на процесс с keep-alive соединениями.
+# Таймауты (сек) установки соединения и ожидания данных, соединений на хост, keep-alive (сек)
+VK_ORD_HTTP_CONNECT_TIMEOUT = 10
+VK_ORD_HTTP_READ_TIMEOUT = 60
+# Предел (сек) на один вызов VK.ОРД вместе с повторами: дольше пользователь получает «не ответил»
+VK_ORD_HTTP_DEADLINE = 90
+VK_ORD_HTTP_LIMIT_PER_HOST = 10
+VK_ORD_HTTP_KEEPALIVE = 30
+
 # ID группы Telegram для отправки метрик (бот должен быть админом)
 ADMIN_CHAT_ID = "1003460901654"
+# Telegram ID пользователей, которым доступны админ-команды (/render_stats) вне админ-чата
+ADMIN_USER_IDS = []
 
 # Пути к шаблонам (относительно корня проекта или абсолютные)
 TEMPLATE_INVOICE_SINGLE = "templates/schet-oferta.docx"
@@ -25,11 +36,89 @@ TEMPLATE_INVOICE_MULTI = "templates/schet-oferta2-multi.docx"
 TEMPLATE_INVOICE_MULTI_PRO = "templates/schet-oferta2-multiPRO.docx"
 TEMPLATE_CONTRACT = "templates/dogovor_rim.docx"
 TEMPLATE_CONTRACT_MULTI = "templates/dogovor_rim2-multi.docx"
+# Папка с шаблонами (все .docx из неё разбираются один раз при старте)
+TEMPLATES_DIR = "templates"
+# Кэш разобранных шаблонов в памяти процесса (False — читать шаблон с диска на каждый документ)
+TEMPLATE_CACHE_ENABLED = True
+
+# Шрифт Times New Roman 12 в таблицах шаблона проставляется один раз при загрузке.
+# False — выравнивать шрифт на каждом рендере; либо перечислите такие шаблоны по имени файла
+TEMPLATE_STYLE_ON_LOAD = True
+TEMPLATE_STYLE_PER_RENDER = []
+
+# Как часто (сек) проверять шаблоны на изменения: правка .docx подхватывается без
+# перезапуска бота (0 — не следить, новые версии шаблонов только после перезапуска)
+TEMPLATE_RELOAD_INTERVAL = 5
 
 # Прочие настройки
 OUTPUT_DIR = "generated"
+# Счётчики номеров документов и метрики лежат в хранилище (STORAGE_BACKEND). При "json"
+# нумерацию можно вынести в отдельную базу: COUNTERS_BACKEND = "sqlite" — база COUNTERS_DB,
+# номер выдаётся одной транзакцией (можно несколько процессов бота); "json" — в STORAGE_DIR.
+# При "sqlite"/"redis" в STORAGE_BACKEND нумерация всегда в общем хранилище
+COUNTERS_BACKEND = "sqlite"
+COUNTERS_DB = "secrets/counters.sqlite3"
+# Закрытые дни счётчиков переносятся в архив в том же хранилище — в рабочем остаётся только
+# сегодняшний день. Проверка раз в столько секунд и при старте
+COUNTERS_ARCHIVE_INTERVAL = 3600
+# Прежние файлы счётчиков, их архивов и метрик: при первом запуске переносятся в хранилище
 COUNTERS_FILE = "secrets/counters.json"
+COUNTERS_ARCHIVE_DIR = "secrets/counters_archive"
 METRICS_FILE = "secrets/metrics.json"
-MAX_ITEMS_FOR_TEMPLATE = 50
+# При "json" счётчики и метрики пишутся журналом: на каждое событие — одна строка
+# в <файл>.journal, а сам файл (снимок) переписывается, когда в журнале набирается
+# JOURNAL_COMPACT_RECORDS записей, и при остановке бота.
+# Как часто (сек) фоновый поток записывает активность пользователей (0 — сразу при записи)
+METRICS_FLUSH_INTERVAL = 5
+JOURNAL_COMPACT_RECORDS = 1000
+# fsync после каждой записи: переживает и отключение питания, но медленнее
+JOURNAL_FSYNC = False
+# Активность пользователей по дням (DAU/WAU/MAU и удержание в /stats): битовые карты
+# в ACTIVITY_DIR, несколько КБ на день; False — не отслеживать. Файлы локальны, поэтому
+# при STORAGE_BACKEND "sqlite"/"redis" (несколько процессов) активность не отслеживается
+ACTIVITY_TRACKING = True
+ACTIVITY_DIR = "secrets/activity"
+# Самый длинный период (дней) для «Активны за период» в /stats — дольше считаются последние дни
+ACTIVITY_MAX_DAYS = 366
+# Предельное число пунктов в одном счёте/договоре (строки 3..N строятся сразу со значениями)
+MAX_ITEMS_FOR_TEMPLATE = 2000
+
+# Рендер документов: число процессов пула (0 — рендер в потоке без пула),
+# сколько документов может ждать в очереди и таймаут одного рендера (сек)
+RENDER_WORKERS = 4
+RENDER_QUEUE_LIMIT = 16
+RENDER_TIMEOUT = 120
+# Рендер дольше этого (мс) пишется в лог как предупреждение с разбивкой по этапам
+RENDER_SLOW_MS = 5000
+
+# Копия каждого документа пишется в OUTPUT_DIR в фоне, после отправки в чат.
+# Поиск по ИНН ищет документы именно там — без архива он ничего не найдёт
+ARCHIVE_DOCUMENTS = True
+
+# Повторное «Сформировать» с теми же данными в течение этого времени (сек) не рендерит
+# документ заново и не тратит номер — пользователь получает уже отправленный файл (0 — выключить)
+SUBMIT_DEDUP_WINDOW = 600
+
+# Счета из таблицы (CSV/XLSX): максимум счетов за один файл, размер файла (байт),
+# размер одной части ZIP (лимит Telegram для ботов — 50 МБ) и период обновления статуса (сек)
+BULK_MAX_INVOICES = 500
+BULK_MAX_FILE_SIZE = 10 * 1024 * 1024
+BULK_ZIP_PART_LIMIT = 45 * 1024 * 1024
+BULK_PROGRESS_INTERVAL = 2
 CAPTION_LIMIT = 1024
 
+# Хранилище состояния (токены и состояние VK.ОРД, нумерация документов и метрики):
+# "json"   — JSON-файлы в STORAGE_DIR и прежние файлы VK.ОРД, один процесс бота;
+# "sqlite" — одна база STORAGE_SQLITE_PATH, можно запускать несколько процессов на одной машине;
+# "redis"  — сервер Redis (или совместимый) по STORAGE_REDIS_URL, нужен пакет redis.
+# При первом запуске с "sqlite"/"redis" локальные данные переносятся в хранилище
+STORAGE_BACKEND = "json"
+STORAGE_DIR = "secrets"
+STORAGE_SQLITE_PATH = "secrets/state.sqlite3"
+STORAGE_REDIS_URL = "redis://localhost:6379/0"
+STORAGE_REDIS_PREFIX = "promo:"
+# Кэш чтения (сек): с несколькими процессами чужие изменения видны с этой задержкой (0 — без кэша)
+STORAGE_CACHE_TTL = 0
+# При "json" состояние VK.ОРД лежит по файлу на пользователя в STORAGE_DIR/vk_ord_state/
+# (прежний vk_ord_state.json раскладывается туда сам); столько пользователей держится в памяти
+STORAGE_STATE_CACHE_USERS = 1000